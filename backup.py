@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 from backup_lib import *
+import sys
 import textwrap as tw
 
 def main():
@@ -50,9 +51,134 @@ def main():
       unimportant ones, so that they're not lost if a backup is interrupted or
       fails. If you don't wish to back up all the files in --src, simply omit
       the \"...\" argument.""")))
+  arg_parser.add_argument('--dedup', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Keep an index of file contents in
+      --backup_drive, and hardlink files that were renamed or moved since an
+      earlier backup to the earlier copy instead of storing them again.""")))
+  arg_parser.add_argument('--resume', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Continue an interrupted backup into the same destination (with
+      --backup_drive, today's backup). Commands that already finished are
+      skipped, and partially copied files are appended to.""")))
+  arg_parser.add_argument('--change_journal', type=str,
+      help=tw.fill(tw.dedent("""\
+      The journal written by backup_watch.py for --src. If it has recorded
+      every change since the previous backup, only the changed paths are
+      copied, and everything else is hardlinked from the previous backup
+      without scanning --src. Otherwise, the backup does a full scan.""")))
+  arg_parser.add_argument('--jobs', type=int, default=1,
+      help=tw.fill(tw.dedent("""\
+      The maximum number of rsync commands to run at once. Entries in
+      --backup_order are started in order, so high-priority files are still
+      backed up first, but independent entries are copied in parallel.
+      (default: 1)""")))
+  arg_parser.add_argument('--progress', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Print the bytes and files backed up so far, the throughput and an ETA
+      to stderr while rsync runs.""")))
+  arg_parser.add_argument('--throttle', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Run rsync under nice and ionice (best-effort, lowest priority), and
+      slow it down or pause it while the source or destination disk, or the
+      CPUs, are busier than --max_disk_util and --max_load.""")))
+  arg_parser.add_argument('--max_bwlimit', type=int,
+      help=tw.fill(tw.dedent("""\
+      With --throttle, the highest --bwlimit (KiB/s) passed to rsync. It's
+      lowered while the machine is busy. (default: no limit)""")))
+  arg_parser.add_argument('--max_disk_util', type=float, default=70.0,
+      help="Disk utilisation (%%) above which --throttle backs off "
+           "(default: 70)")
+  arg_parser.add_argument('--max_load', type=float, default=1.0,
+      help="Load average per CPU above which --throttle backs off "
+           "(default: 1.0)")
+  arg_parser.add_argument('--file_classes', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Copy large files (with --inplace) and VM images, databases and other
+      sparse files (with --sparse) with separate rsync commands, tuned for
+      them. Per-class times are written to the backup's report.""")))
+  arg_parser.add_argument('--engine', choices=["rsync", "reflink"],
+      default="rsync",
+      help=tw.fill(tw.dedent("""\
+      How files are copied. "reflink" (for btrfs and XFS backup drives) clones
+      files that haven't changed since --prev_backup, sharing their data
+      blocks instead of hardlinking them, and copies the others with
+      copy_file_range. It falls back to rsync if the drive doesn't support
+      reflinks. (default: rsync)""")))
+  arg_parser.add_argument('--shard_files', type=int,
+      help=tw.fill(tw.dedent("""\
+      Split directories with more than this many files into several rsync
+      commands, each with at most this many files. This bounds the memory
+      used by rsync on huge trees.""")))
+  arg_parser.add_argument('--shard_bytes', type=int,
+      help=tw.fill(tw.dedent("""\
+      Like --shard_files, but limits the total size (in bytes) of the files
+      copied by each rsync command.""")))
+  arg_parser.add_argument('--prune', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Delete the backups in --backup_drive
+      that aren't kept by --keep_daily, --keep_weekly and --keep_monthly
+      (after taking a new backup, if --src is set). The most recent completed
+      backup is always kept.""")))
+  arg_parser.add_argument('--keep_daily', type=int, default=7,
+      help="Number of most recent backups kept by --prune (default: 7)")
+  arg_parser.add_argument('--keep_weekly', type=int, default=4,
+      help=tw.fill(tw.dedent("""\
+      Number of most recent weeks of which --prune keeps the newest backup
+      (default: 4)""")))
+  arg_parser.add_argument('--keep_monthly', type=int, default=12,
+      help=tw.fill(tw.dedent("""\
+      Number of most recent months of which --prune keeps the newest backup
+      (default: 12)""")))
+  arg_parser.add_argument('--space_report', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Print how much space each backup in
+      --backup_drive uses by itself (exclusive) and shares with other backups
+      through hardlinks. Scans of completed backups are cached in
+      --backup_drive, so only new backups are scanned.""")))
+  arg_parser.add_argument('--catalog', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Record every backup's files (and
+      rsync's itemized changes) in catalog.sqlite in --backup_drive, which
+      --versions, --containing and --changed query without reading the
+      backups.""")))
+  arg_parser.add_argument('--versions', type=str, metavar="PATH",
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Print every version of PATH (relative
+      to --src) in the catalog, and the backups that hold it.""")))
+  arg_parser.add_argument('--containing', type=str, metavar="PATH",
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Print the backups in the catalog that
+      hold PATH (relative to --src).""")))
+  arg_parser.add_argument('--changed', type=str, metavar="START[,END]",
+      help=tw.fill(tw.dedent("""\
+      Only valid with --backup_drive. Print the files added, modified or
+      deleted by the backups taken after START and up to END (default:
+      today). Dates are written like backup names, e.g. 30-Jan-2014.""")))
+  arg_parser.add_argument('--verify', action='store_true',
+      help=tw.fill(tw.dedent("""\
+      After the backup, check that every backed up file's contents match
+      --src, printing the files that don't. If the destination already holds a
+      completed backup (and --resume isn't set), only verify it.""")))
+  arg_parser.add_argument('--verify_workers', type=int,
+      help="Processes used by --verify to hash files (default: one per CPU)")
   args = arg_parser.parse_args()
 
   # Validate flag values
+  assert args.backup_drive or not args.prune, \
+      "--prune requires --backup_drive. Run `./backup.py --help` for usage info"
+  assert args.backup_drive or not args.space_report, \
+      "--space_report requires --backup_drive. Run `./backup.py --help` for " \
+      "usage info"
+  queries = args.versions or args.containing or args.changed
+  assert args.backup_drive or not (args.catalog or queries), \
+      "--catalog, --versions, --containing and --changed require " \
+      "--backup_drive. Run `./backup.py --help` for usage info"
+  if (args.prune or args.space_report or queries) and not args.src:
+    if args.prune: prune(args)
+    if args.space_report: space_report(args)
+    if queries: query_catalog(args)
+    return
   assert args.src, "Must specify --src. Run `./backup.py --help` for usage info"
   assert args.backup_drive or args.dst, \
       "Must specify exactly one of --dst or --backup_drive. Run " \
@@ -63,24 +189,121 @@ def main():
   assert not args.backup_drive or not args.prev_backup, \
       "Must specify at most one of --prev_backup or --backup_drive. Run " \
       "`./backup.py --help` for usage info"
+  assert args.jobs >= 1, "--jobs must be at least 1"
+  assert args.backup_drive or not args.dedup, \
+      "--dedup requires --backup_drive. Run `./backup.py --help` for usage info"
 
   # Create function arguments to Backup constructor depending on flag values
-  backup_args = {"src": args.src}
+  backup_args = {"src": args.src, "shard_max_files": args.shard_files,
+                 "shard_max_bytes": args.shard_bytes,
+                 "change_journal": args.change_journal,
+                 "file_classes": args.file_classes, "engine": args.engine}
+  if args.throttle:
+    backup_args["throttle"] = Throttle(
+        max_bwlimit=args.max_bwlimit, max_disk_util=args.max_disk_util,
+        max_load=args.max_load)
   backup_order = [
-      s for s in args.backup_order.strip().split(",") if len(s) > 0 ]
+      s for s in (args.backup_order or "").strip().split(",") if len(s) > 0 ]
   if len(backup_order) > 0:
     backup_args["backup_order"] = backup_order
 
-  # Create Backup object
-  if args.backup_drive:
-    backup = Backup.FromBackupDrive(drive=args.backup_drive, **backup_args)
+  # A destination that already holds a completed backup is only verified.
+  # This has to be decided before creating a Backup, which refuses such a
+  # destination
+  dst = args.dst or join(args.backup_drive,
+                         datetime.today().strftime(Backup._DATE_FORMAT))
+  if args.verify and not args.resume and exists(join(dst, Backup._DONE_FILE)):
+    if not verify(verify_completed(args, dst, backup_order), args):
+      raise SystemExit(1)
   else:
-    if args.prev_backup: backup_args["prev_backup"] = args.prev_backup
-    backup = Backup(dst=args.dst, **backup_args)
+    # Create Backup object
+    if args.backup_drive:
+      backup = Backup.FromBackupDrive(drive=args.backup_drive, dedup=args.dedup,
+                                      catalog=args.catalog, **backup_args)
+    else:
+      if args.prev_backup: backup_args["prev_backup"] = args.prev_backup
+      backup = Backup(dst=args.dst, **backup_args)
+
+    # Perform backup
+    backup.run_rsync_cmds(jobs=args.jobs, resume=args.resume,
+                          progress=sys.stderr if args.progress else None)
+    print("\033[1;32mDONE!\033[0m")
+    if args.verify and \
+        not verify(backup.verify(workers=args.verify_workers), args):
+      raise SystemExit(1)
+  if args.prune: prune(args)
+  if args.space_report: space_report(args)
+  if queries: query_catalog(args)
+
+def verify_completed(args, dst, backup_order):
+  """
+    Returns Backup.Verify() of the completed backup in "dst". Like
+    FromBackupDrive(), the previous backup (whose hardlinked files needn't be
+    hashed again) is the most recent other completed backup in --backup_drive
+  """
+  prev_backup = args.prev_backup
+  if args.backup_drive:
+    done = [p for t, p in Backup._list_snapshots(args.backup_drive)
+            if abspath(p) != abspath(dst) and
+            exists(join(p, Backup._DONE_FILE))]
+    prev_backup = done[0] if done else None
+  backup_order = [f if f == "..." else normpath(f) for f in backup_order]
+  return Backup.Verify(args.src, dst, prev_backup, backup_order or ["..."],
+                       workers=args.verify_workers)
+
+def verify(problems, args):
+  """
+    Prints the files in "problems" (the results of Backup.Verify()), which
+    don't match --src. Returns True if there were none
+  """
+  ok = True
+  for path, problem in problems:
+    print("\033[1;31mMISMATCH\033[0m {}: {}".format(path, problem))
+    ok = False
+  if ok: print("\033[1;32mVERIFIED\033[0m")
+  return ok
+
+def prune(args):
+  """ Prunes --backup_drive according to the --keep_* flags """
+  for path in Backup.Prune(args.backup_drive, daily=args.keep_daily,
+                           weekly=args.keep_weekly, monthly=args.keep_monthly):
+    print("Deleted {}".format(path))
+
+def space_report(args):
+  """ Prints Backup.SpaceReport() for --backup_drive """
+  gb = lambda n: "{:.2f} GB".format(n / 1e9)
+  report = Backup.SpaceReport(args.backup_drive)
+  print("{:14} {:>12} {:>14} {:>14}".format(
+      "backup", "files", "exclusive", "shared"))
+  for b in report["backups"]:
+    print("{:14} {:>12} {:>14} {:>14}{}".format(
+        b["name"], b["files"], gb(b["exclusive_bytes"]), gb(b["shared_bytes"]),
+        "" if b["complete"] else "  (incomplete)"))
+  print("Total space used: {}".format(gb(report["unique_bytes"])))
 
-  # Perform backup
-  backup.run_rsync_cmds()
-  print("\033[1;32mDONE!\033[0m")
+def query_catalog(args):
+  """ Prints the answers to --versions, --containing and --changed """
+  path = join(args.backup_drive, Backup._CATALOG_FILE)
+  assert exists(path), "{} doesn't exist. Take a backup with --catalog " \
+      "first".format(path)
+  catalog = Catalog(path)
+  try:
+    if args.versions:
+      for v in catalog.versions(args.versions):
+        print("{} {:>14} bytes  {} .. {}{}".format(
+            v["digest"], v["size"], v["first"], v["last"],
+            "  ({})".format(v["item"]) if v["item"] else ""))
+    if args.containing:
+      for name, _ in catalog.snapshots(path=args.containing):
+        print(name)
+    if args.changed:
+      dates = [datetime.strptime(d.strip(), Backup._DATE_FORMAT).date()
+               for d in args.changed.split(",")]
+      start, end = dates[0], dates[1] if len(dates) > 1 else date.today()
+      for name, p, change in catalog.changes(start, end):
+        print("{} {:8} {}".format(name, change, p))
+  finally:
+    catalog.close()
 
 if __name__ == "__main__":
   main()
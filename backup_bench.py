@@ -0,0 +1,281 @@
+#!/usr/bin/python
+
+from backup_lib import *
+import multiprocessing
+import random
+import resource
+import textwrap as tw
+
+class TreeSpec:
+  """ Parameters of a synthetic source tree (see generate_tree) """
+
+  def __init__(self, small_files=10000, small_file_size=4096, huge_files=2,
+               huge_file_size=256 << 20, depth=4, fanout=8, seed=0):
+    """
+      Keyword arguments:
+      small_files -- number of small files, spread over the directory tree
+      small_file_size -- maximum size of a small file, in bytes (sizes are
+          uniformly distributed between 0 and this)
+      huge_files -- number of huge files, in the top-level directory
+      huge_file_size -- size of each huge file, in bytes
+      depth -- depth of the directory tree
+      fanout -- number of subdirectories of each directory above "depth"
+      seed -- seed for all random choices, so that trees are reproducible
+    """
+    self.small_files = small_files
+    self.small_file_size = small_file_size
+    self.huge_files = huge_files
+    self.huge_file_size = huge_file_size
+    self.depth = depth
+    self.fanout = fanout
+    self.seed = seed
+
+  def as_dict(self):
+    return dict(self.__dict__)
+
+def _dirs(spec):
+  """ The directories of a tree (relative paths), parents first """
+  dirs = [""]
+  level = [""]
+  for _ in range(spec.depth):
+    level = [join(d, "d{:02}".format(i)) if d else "d{:02}".format(i)
+             for d in level for i in range(spec.fanout)]
+    dirs += level
+  return dirs
+
+def _write_file(path, size, rng, block=None):
+  """
+    Writes "size" bytes to "path": random data, or repetitions of "block"
+    (with a random prefix, so files differ) for huge files
+  """
+  with open(path, "wb") as f:
+    if block is None:
+      f.write(rng.randbytes(size))
+      return
+    f.write(rng.randbytes(64))
+    written = 64
+    while written < size:
+      n = min(len(block), size - written)
+      f.write(block[:n])
+      written += n
+
+def generate_tree(root, spec):
+  """
+    Creates the synthetic tree described by "spec" under "root" (which must
+    not exist). The same spec always produces the same file names and
+    contents. Returns the list of regular files created (relative paths)
+  """
+  rng = random.Random(spec.seed)
+  dirs = _dirs(spec)
+  for d in dirs:
+    os.mkdir(join(root, d) if d else root)
+  files = []
+  for i in range(spec.small_files):
+    d = dirs[rng.randrange(len(dirs))]
+    p = join(d, "f{:08}".format(i)) if d else "f{:08}".format(i)
+    _write_file(join(root, p), rng.randrange(spec.small_file_size + 1), rng)
+    files.append(p)
+  block = rng.randbytes(1 << 20)
+  for i in range(spec.huge_files):
+    p = "huge{:02}".format(i)
+    _write_file(join(root, p), spec.huge_file_size, rng, block)
+    files.append(p)
+  return files
+
+def mutate_tree(root, files, change_rate, seed=1):
+  """
+    Simulates the changes between two backups of a tree created by
+    generate_tree: of the small files in "files", a "change_rate" fraction is
+    rewritten, the same number of new files is added and of files deleted,
+    and one directory is renamed. Huge files have one block rewritten with
+    the same probability. Returns the new list of files
+  """
+  rng = random.Random(seed)
+  files = list(files)
+  n = int(len(files) * change_rate)
+  for p in rng.sample(files, n):
+    path = join(root, p)
+    if os.path.basename(p).startswith("huge"):
+      with open(path, "r+b") as f:
+        f.seek(rng.randrange(max(1, os.path.getsize(path) - 4096)))
+        f.write(rng.randbytes(4096))
+    else:
+      _write_file(path, rng.randrange(4096), rng)
+  for p in rng.sample(files, n):
+    if os.path.basename(p).startswith("huge"): continue
+    os.remove(join(root, p))
+    files.remove(p)
+  for i in range(n):
+    p = "new{:08}".format(i)
+    _write_file(join(root, p), rng.randrange(4096), rng)
+    files.append(p)
+  # Rename one directory, to exercise moved-file handling
+  subdirs = sorted(d for d in os.listdir(root) if isdir(join(root, d)))
+  if subdirs:
+    old = subdirs[rng.randrange(len(subdirs))]
+    os.rename(join(root, old), join(root, old + "_moved"))
+    files = [old + "_moved" + p[len(old):] if p.startswith(old + "/") else p
+             for p in files]
+  return files
+
+def _proc_io():
+  """
+    I/O counters of this process, including children that have been waited
+    for (so this covers rsync). Empty if /proc isn't available
+  """
+  counters = {}
+  try:
+    with open("/proc/self/io") as f:
+      for line in f:
+        k, v = line.split(":")
+        counters[k] = int(v)
+  except (IOError, OSError):
+    pass
+  return counters
+
+def _timed_backup(backup_args, drive, queue):
+  """
+    Runs in a child process: takes one backup of backup_args["src"] into
+    "drive" and puts its measurements on "queue". Using a fresh process keeps
+    the peak RSS of one run from leaking into the next
+  """
+  jobs = backup_args.pop("jobs", 1)
+  io_before = _proc_io()
+  start = monotonic()
+  b = Backup.FromBackupDrive(drive=drive, **backup_args)
+  b.run_rsync_cmds(jobs=jobs)
+  wall = monotonic() - start
+  io_after = _proc_io()
+  with open(join(b.destination(), Backup._REPORT_FILE)) as f:
+    report = json.load(f)
+  rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  result = {
+    "wall_seconds": wall,
+    "rsync_invocations": len(report["commands"]),
+    "peak_rss_kb": rss,
+    "bytes_transferred": report["totals"]["bytes_transferred"],
+    "files_transferred": report["totals"]["files_transferred"],
+  }
+  for k in ["read_bytes", "write_bytes", "rchar", "wchar"]:
+    if k in io_after:
+      result[k] = io_after[k] - io_before.get(k, 0)
+  queue.put(result)
+
+def run_backup(backup_args, drive):
+  """ Takes one backup in a child process, and returns its measurements """
+  queue = multiprocessing.Queue()
+  p = multiprocessing.Process(target=_timed_backup,
+                              args=(dict(backup_args), drive, queue))
+  p.start()
+  p.join()
+  assert p.exitcode == 0, "backup of {} failed".format(backup_args["src"])
+  return queue.get()
+
+# Backup modes to benchmark: name -> extra arguments to Backup (plus "jobs",
+# which is passed to run_rsync_cmds)
+SCENARIOS = {
+  "default": {},
+  "jobs4": {"jobs": 4},
+  "sharded": {"shard_max_files": 5000},
+  "dedup": {"dedup": True},
+}
+
+def run_scenario(name, workdir, spec, change_rate):
+  """
+    Benchmarks one scenario: a full backup of a freshly generated tree, then
+    (after mutate_tree) an incremental backup against it. The full backup is
+    moved to an older date so that the incremental one links against it
+  """
+  src = join(workdir, "src")
+  drive = join(workdir, "drive")
+  files = generate_tree(src, spec)
+  os.mkdir(drive)
+  backup_args = dict(SCENARIOS[name], src=src)
+  result = {"full": run_backup(backup_args, drive)}
+  today = datetime.today().strftime(Backup._DATE_FORMAT)
+  os.rename(join(drive, today), join(drive, "01-Jan-2000"))
+  mutate_tree(src, files, change_rate)
+  result["incremental"] = run_backup(backup_args, drive)
+  return result
+
+def compare(results, baseline, tolerance):
+  """
+    Prints each measurement next to the baseline's, flagging ones that got
+    worse by more than "tolerance" (a fraction). Returns the number of
+    regressions
+  """
+  regressions = 0
+  for scenario in sorted(results):
+    for run in ["full", "incremental"]:
+      for k, v in sorted(results[scenario][run].items()):
+        old = baseline.get(scenario, {}).get(run, {}).get(k)
+        line = "{:10} {:12} {:18} {:>16}".format(scenario, run, k, v)
+        if old:
+          change = (v - old) / float(old)
+          line += " {:+7.1%}".format(change)
+          if change > tolerance:
+            line += "  REGRESSION"
+            regressions += 1
+        print(line)
+  return regressions
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+      description="Benchmark backup modes on reproducible synthetic trees.",
+      epilog=tw.dedent("""\
+      Examples:
+          ./backup_bench.py --workdir=/mnt/scratch --out=bench.json
+          ./backup_bench.py --workdir=/mnt/scratch --baseline=bench.json \\
+              --small_files=1000000 --scenarios=default,sharded
+      """),
+      formatter_class=argparse.RawTextHelpFormatter)
+  arg_parser.add_argument('--workdir', type=str, required=True,
+      help="Scratch directory for the generated trees and backups")
+  arg_parser.add_argument('--scenarios', type=str, default="default",
+      help="Comma-separated list of: {}".format(", ".join(sorted(SCENARIOS))))
+  arg_parser.add_argument('--small_files', type=int, default=10000)
+  arg_parser.add_argument('--small_file_size', type=int, default=4096)
+  arg_parser.add_argument('--huge_files', type=int, default=2)
+  arg_parser.add_argument('--huge_file_size', type=int, default=256 << 20)
+  arg_parser.add_argument('--depth', type=int, default=4)
+  arg_parser.add_argument('--fanout', type=int, default=8)
+  arg_parser.add_argument('--seed', type=int, default=0)
+  arg_parser.add_argument('--change_rate', type=float, default=0.01,
+      help="Fraction of files changed between the full and incremental runs")
+  arg_parser.add_argument('--out', type=str,
+      help="Write the results (as JSON) to this file")
+  arg_parser.add_argument('--baseline', type=str,
+      help="Compare the results with this file (written by --out)")
+  arg_parser.add_argument('--tolerance', type=float, default=0.1,
+      help="Fraction by which a measurement may exceed the baseline")
+  args = arg_parser.parse_args()
+
+  scenarios = [s for s in args.scenarios.split(",") if s]
+  for s in scenarios:
+    assert s in SCENARIOS, "unknown scenario {}".format(s)
+  assert isdir(args.workdir), "--workdir ({}) is not a dir".format(args.workdir)
+  spec = TreeSpec(args.small_files, args.small_file_size, args.huge_files,
+                  args.huge_file_size, args.depth, args.fanout, args.seed)
+
+  results = {}
+  for s in scenarios:
+    workdir = tempfile.mkdtemp(prefix="bench.{}.".format(s), dir=args.workdir)
+    try:
+      results[s] = run_scenario(s, workdir, spec, args.change_rate)
+    finally:
+      proc.check_call(["rm", "-rf", workdir])
+  results["tree"] = spec.as_dict()
+  if args.out:
+    with open(args.out, "w") as f:
+      json.dump(results, f, indent=2)
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  del results["tree"]
+  if compare(results, baseline, args.tolerance) > 0:
+    raise SystemExit(1)
+
+if __name__ == "__main__":
+  main()
@@ -1,12 +1,27 @@
 #!/usr/bin/python
 
 import argparse
+import collections
+import errno
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, \
+    ThreadPoolExecutor, wait
 from datetime import date, time, datetime
+import fcntl
+import gzip
+import hashlib
+import json
 import os
 from os.path import abspath, exists, isabs, isdir, join, normpath
 import re
+import shutil
+import signal
+import sqlite3
+import stat
 import subprocess as proc
 from sys import stdin
+import tempfile
+import threading
+from time import monotonic, sleep
 
 _fixed_rsync_args = [
   # Archive mode (preserves most file attributes) and verbose logging
@@ -16,20 +31,1605 @@ _fixed_rsync_args = [
   # sockets)
   '--no-D',
 
-  # Use checksum to determine file equality (see man page; default bahavior
-  # in rysnc is to compare timestamp and file size to determine equality,
-  # but that's fragile. This is much slower though, so perhaps this should
-  # be disabled later)
-  '--checksum',
+  # Lists of paths passed to rsync (--files-from, --exclude-from) are
+  # NUL-separated, so that file names may contain newlines
+  '--from0',
 
-  # output lines:
+  # output lines (parsed by _CommandStats):
   # %n The filename
   # %b The number of bytes actually transferred
   # %l The actual size of the file
   # %i info line (http://stackoverflow.com/questions/1113948/rsync-output)
-  '--out-format="%n (%b/%l) %i"',
+  '--out-format=%n (%b/%l) %i',
+
+  # Itemize twice, so that rsync also outputs a line for files that it
+  # didn't transfer (i.e. unchanged and hardlinked files)
+  '-ii',
+
+  # rsync's output goes to a pipe, which it would otherwise fully buffer.
+  # Flushing every line lets the output be parsed (e.g. for --progress) as
+  # files finish, rather than in bursts
+  '--outbuf=L',
+
+  # Keep partially transferred files if rsync is interrupted, so that a
+  # resumed backup (see Backup.run_rsync_cmds) can append to them
+  '--partial',
 ]
 
+# rsync exit codes that still count as a successful backup. 24 means "some
+# source files vanished before they could be transferred", which is normal
+# when backing up a live directory tree
+_RSYNC_OK_CODES = (0, 24)
+
+# One rsync invocation generated by Backup. "entry" is the element of
+# "backup_order" that the command backs up, and "order" is its index in
+# "backup_order" (several commands may back up parts of one entry). "label"
+# identifies the command in the backup's journal, so it must be the same every
+# time the backup is planned, and must change if the command's contents do
+# "file_class" is the class of the files that the command copies (see
+# _file_class()). With Backup.engine set to "reflink", jobs are run in-process
+# instead (see Backup._reflink_jobs())
+_RsyncJob = collections.namedtuple(
+    "_RsyncJob", ["label", "entry", "order", "cmd", "file_class"],
+    defaults=["default"])
+
+# Use checksum to determine file equality (see man page; default bahavior in
+# rysnc is to compare timestamp and file size to determine equality, but that's
+# fragile). This is much slower, so it's only used when the previous backup has
+# no manifest (see Backup._scan_src) to tell us which files changed
+_checksum_rsync_arg = '--checksum'
+
+# One file in a backup's manifest: the size, mtime, inode and content hash
+# that the source file had when it was backed up. ctime is recorded too, so
+# that a file rewritten in place with its mtime reset (e.g. by "touch -r")
+# still counts as changed
+_ManifestEntry = collections.namedtuple(
+    "_ManifestEntry", ["size", "mtime_ns", "ctime_ns", "ino", "digest"])
+
+# With Backup.file_classes set, files are split into classes that are copied
+# by separate rsync commands, with arguments tuned for them:
+# - "default": everything not in the classes below (copied by each
+#   backup_order entry's main command). Source and destination are local, so
+#   there's nothing to gain from the delta algorithm
+# - "large": files of at least _LARGE_FILE_BYTES. --inplace writes them
+#   straight to their final name, instead of to a temporary copy that is then
+#   renamed, so the destination doesn't need room for two copies. Only used
+#   when the destination file doesn't exist yet (see Backup._rsync_jobs())
+# - "sparse": VM images and database files (by extension), and files with
+#   holes, of at least _SPARSE_MIN_BYTES. --sparse keeps their holes
+_FILE_CLASS_ARGS = collections.OrderedDict([
+  ("default", ["--whole-file"]),
+  ("large", ["--whole-file", "--inplace"]),
+  ("sparse", ["--whole-file", "--sparse"]),
+])
+_LARGE_FILE_BYTES = 1 << 30
+_SPARSE_MIN_BYTES = 1 << 20
+_SPARSE_SUFFIXES = (".qcow2", ".vmdk", ".vdi", ".vhd", ".vhdx", ".img",
+                    ".raw", ".sqlite", ".db", ".ibd", ".mdf", ".ldf")
+
+def _file_class_args(cls, resume=False):
+  """
+    The rsync arguments of the file class "cls" (see _FILE_CLASS_ARGS). When
+    resuming, --inplace is left out, as the files in the destination may be
+    hardlinks into earlier backups, and so is --whole-file, which rsync
+    refuses together with --append-verify
+  """
+  return [a for a in _FILE_CLASS_ARGS[cls]
+          if not (resume and a in ["--inplace", "--whole-file"])]
+
+def _file_class(path, st):
+  """ The class (see _FILE_CLASS_ARGS) of the file "path" with stat "st" """
+  if st.st_size >= _SPARSE_MIN_BYTES and (
+      path.lower().endswith(_SPARSE_SUFFIXES) or
+      st.st_blocks * 512 < st.st_size):
+    return "sparse"
+  if st.st_size >= _LARGE_FILE_BYTES:
+    return "large"
+  return "default"
+
+# rsync accepts at most this many --link-dest directories (MAX_BASIS_DIRS)
+_MAX_LINK_DESTS = 20
+
+# Header of manifest files. Manifests with a different header are ignored
+_MANIFEST_HEADER = {"format": 1, "hash": "blake2b-128"}
+
+def _hash_file(path):
+  """
+    Returns the hex content hash of the file at "path", as in manifests.
+    The file is read in chunks of up to 8 MiB into a buffer that is reused
+    for the whole file, and sized to fit small files, which are the most
+    common. (Mapping it into memory instead would crash the process with
+    SIGBUS if the file were truncated while being hashed, as source files
+    may be)
+  """
+  h = hashlib.blake2b(digest_size=16)
+  with open(path, "rb", buffering=0) as f:
+    buf = bytearray(min(8 << 20, os.fstat(f.fileno()).st_size + 1))
+    view = memoryview(buf)
+    for n in iter(lambda: f.readinto(buf), 0):
+      h.update(view[:n])
+  return h.hexdigest()
+
+def _iter_manifest(path):
+  """
+    Yields (path, _ManifestEntry) for every file in a manifest written by
+    _save_manifest. Yields nothing if "path" doesn't exist or isn't a manifest
+    that this version understands
+  """
+  if not exists(path): return
+  with gzip.open(path, "rt") as f:
+    if json.loads(f.readline() or "null") != _MANIFEST_HEADER: return
+    for line in f:
+      record = json.loads(line)
+      yield record[0], _ManifestEntry(*record[1:])
+
+def _load_manifest(path):
+  """
+    Reads a manifest written by _save_manifest, returning a dict from path to
+    _ManifestEntry, or None if "path" doesn't exist or isn't a manifest that
+    this version understands
+  """
+  if not exists(path): return None
+  with gzip.open(path, "rt") as f:
+    if json.loads(f.readline() or "null") != _MANIFEST_HEADER: return None
+  return dict(_iter_manifest(path))
+
+def _save_manifest(path, manifest):
+  """
+    Writes "manifest" (a dict from path to _ManifestEntry) to "path": one JSON
+    record per line, gzipped. JSON escapes any undecodable bytes in file
+    names, so the file itself is plain ASCII
+  """
+  with gzip.open(path + ".tmp", "wt") as f:
+    f.write(json.dumps(_MANIFEST_HEADER) + "\n")
+    for p in sorted(manifest):
+      f.write(json.dumps([p] + list(manifest[p])) + "\n")
+  os.rename(path + ".tmp", path)
+
+def _walk_files(root, rel=""):
+  """
+    Yields (path, stat) for every regular file under join(root, rel), where
+    "path" is relative to "root". Symlinks are not followed, and directories
+    that can't be read are skipped (rsync reports those itself). If "rel" is
+    a regular file, only that file is yielded
+  """
+  try:
+    st = os.lstat(join(root, rel))
+  except OSError:
+    return
+  if stat.S_ISREG(st.st_mode):
+    yield rel, st
+    return
+  stack = [rel] if stat.S_ISDIR(st.st_mode) else []
+  while stack:
+    d = stack.pop()
+    try:
+      it = os.scandir(join(root, d))
+    except OSError:
+      continue
+    with it:
+      for e in it:
+        p = join(d, e.name) if d else e.name
+        try:
+          if e.is_dir(follow_symlinks=False):
+            stack.append(p)
+          elif e.is_file(follow_symlinks=False):
+            yield p, e.stat(follow_symlinks=False)
+        except OSError:
+          continue
+
+def _scan_files(root, rel="", workers=16):
+  """
+    Like _walk_files(), but returns a list, and lists and stats directories
+    with "workers" threads (see _parallel_walk()), which is several times
+    faster on trees that don't fit in the inode cache
+  """
+  try:
+    st = os.lstat(join(root, rel))
+  except OSError:
+    return []
+  if not stat.S_ISDIR(st.st_mode): return list(_walk_files(root, rel))
+  prefix = len(root.rstrip("/")) + 1
+  files = []
+  lock = threading.Lock()
+  def visit(d, entries):
+    found = []
+    for e in entries:
+      try:
+        if e.is_file(follow_symlinks=False):
+          found.append((e.path[prefix:], e.stat(follow_symlinks=False)))
+      except OSError:
+        continue
+    with lock: files.extend(found)
+  _parallel_walk(join(root, rel) if rel else root, visit, workers,
+                 skip_unreadable=True)
+  return files
+
+def _write_path_list(path, paths, anchored=False):
+  """
+    Writes "paths" to the file "path" in the NUL-separated format read by
+    rsync's --files-from and --exclude-from (see --from0). If "anchored" is
+    set, the paths are written as filter patterns anchored at the root of the
+    transfer, with any wildcard characters escaped
+  """
+  with open(path, "wb") as f:
+    for p in paths:
+      if anchored: p = "/" + _escape_pattern(p)
+      f.write(os.fsencode(p) + b"\0")
+
+def _add_parent_dirs(dirs, paths):
+  """
+    Adds the parent directories of every path in "paths" (all the way up,
+    but not "" for the root) to the set "dirs"
+  """
+  for p in paths:
+    p = os.path.dirname(p)
+    while p and p not in dirs:
+      dirs.add(p)
+      p = os.path.dirname(p)
+
+# A line of rsync output in the --out-format above. Older logs have the format
+# wrapped in quotes
+_OUT_FORMAT_RE = re.compile(
+    r'^"?(?P<name>.*) \((?P<bytes>\d+)/(?P<size>\d+)\) (?P<item>\S+?)\s*"?$')
+
+class _CommandStats:
+  """
+    Statistics about one rsync command, built up by feeding it the command's
+    output line by line
+  """
+
+  def __init__(self, entry, cmd, progress=None):
+    self.entry = entry
+    self.cmd = cmd
+    self.progress = progress  # A _Progress to report each file to, or None
+    # If a dict, the files that the command copied or created (rather than
+    # found unchanged or hardlinked) are added to it, as path -> (itemized
+    # changes, bytes transferred). See Catalog
+    self.transfers = None
+    self.file_class = "default"
+    self.files_seen = 0
+    self.files_transferred = 0
+    self.files_hardlinked = 0
+    self.bytes_transferred = 0
+    self.bytes_logical = 0
+    self.start = self.end = None
+
+  def feed(self, line):
+    """ Parses one line (bytes or str) of rsync output """
+    if isinstance(line, bytes):
+      line = line.decode("utf-8", "surrogateescape")
+    m = _OUT_FORMAT_RE.match(line.rstrip("\n"))
+    # The second character of the info line is the file type
+    if not m or m.group("item")[1:2] != "f": return
+    self.files_seen += 1
+    self.bytes_transferred += int(m.group("bytes"))
+    self.bytes_logical += int(m.group("size"))
+    if self.progress:
+      self.progress.add(self.entry, int(m.group("size")), int(m.group("bytes")))
+    update = m.group("item")[0]
+    if update in "<>":
+      self.files_transferred += 1
+    elif update == "h":
+      self.files_hardlinked += 1
+    if self.transfers is not None and update not in ".h":
+      self.transfers[m.group("name")] = (m.group("item"), int(m.group("bytes")))
+
+  def wall_seconds(self):
+    return (self.end - self.start) if self.end is not None else 0.0
+
+  def as_dict(self):
+    wall = self.wall_seconds()
+    return {
+      "entry": self.entry,
+      "file_class": self.file_class,
+      "cmd": self.cmd,
+      "files_seen": self.files_seen,
+      "files_transferred": self.files_transferred,
+      "files_hardlinked": self.files_hardlinked,
+      "bytes_transferred": self.bytes_transferred,
+      "bytes_logical": self.bytes_logical,
+      "wall_seconds": wall,
+      "throughput_bytes_per_second":
+          self.bytes_transferred / wall if wall > 0 else 0.0,
+    }
+
+def _format_bytes(n):
+  """ Formats "n" bytes for humans, e.g. "1.5 GB" """
+  for unit in ["B", "kB", "MB", "GB", "TB"]:
+    if abs(n) < 1000 or unit == "TB": break
+    n /= 1000.0
+  return "{:.1f} {}".format(n, unit) if unit != "B" else "{} B".format(int(n))
+
+class _Progress:
+  """
+    Live progress of a backup run. The totals (per backup_order entry) come
+    from the scan that precedes rsync, and the pipe readers of the rsync
+    commands report each file as rsync finishes it (see _CommandStats). A
+    daemon thread prints a status line with the aggregate bytes and files
+    done, the current throughput and an ETA every "interval" seconds.
+    Since a file only counts once it's finished, the bytes done (and so the
+    ETA) don't move while a very large file is being copied.
+    Reporting a file only updates a few counters under a lock, so the pipe
+    readers never wait on the display.
+  """
+
+  def __init__(self, totals, out, interval=1.0, window=10.0):
+    """
+      Keyword arguments:
+      totals -- dict from backup_order entry to (files, bytes) that its
+          commands will see
+      out -- file to print the status line to. If it's a terminal, the line
+          is redrawn in place
+      interval -- seconds between status lines
+      window -- the throughput (and so the ETA) is averaged over this many
+          seconds
+    """
+    self.totals = totals
+    self.out = out
+    self.interval = interval
+    self.window = window
+    self.done = collections.defaultdict(lambda: [0, 0])  # entry -> files, bytes
+    self.transferred = 0
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+    self._samples = collections.deque()  # (time, bytes done, transferred)
+
+  def add(self, entry, size, transferred):
+    """ Records that rsync finished one file of "entry" """
+    with self._lock:
+      done = self.done[entry]
+      done[0] += 1
+      done[1] += size
+      self.transferred += transferred
+
+  def status(self, now=None):
+    """
+      Returns a dict with the files and bytes done and in total, the
+      throughput over the last `self.window` seconds (of files seen by rsync,
+      and of bytes it actually copied), and the ETA in seconds (None if it's
+      not known yet)
+    """
+    now = monotonic() if now is None else now
+    with self._lock:
+      files = sum(d[0] for d in self.done.values())
+      size = sum(d[1] for d in self.done.values())
+      transferred = self.transferred
+    self._samples.append((now, size, transferred))
+    while now - self._samples[0][0] > self.window and len(self._samples) > 2:
+      self._samples.popleft()
+    t0, size0, transferred0 = self._samples[0]
+    elapsed = now - t0
+    total_files = sum(t[0] for t in self.totals.values())
+    total_size = sum(t[1] for t in self.totals.values())
+    rate = (size - size0) / elapsed if elapsed > 0 else 0.0
+    return {
+      "files_done": files, "files_total": total_files,
+      "bytes_done": size, "bytes_total": total_size,
+      "bytes_per_second": rate,
+      "transferred_bytes_per_second":
+          (transferred - transferred0) / elapsed if elapsed > 0 else 0.0,
+      "eta_seconds": max(0.0, total_size - size) / rate if rate > 0 else None,
+    }
+
+  def line(self, now=None):
+    """ The status line printed by the display thread """
+    st = self.status(now)
+    eta = "--:--:--"
+    if st["eta_seconds"] is not None:
+      m, sec = divmod(int(st["eta_seconds"]), 60)
+      eta = "{}:{:02}:{:02}".format(m // 60, m % 60, sec)
+    percent = 100.0 * st["bytes_done"] / st["bytes_total"] \
+        if st["bytes_total"] else 100.0
+    return "{} / {} ({:.0f}%), {}/{} files, {}/s ({}/s copied), ETA {}".format(
+        _format_bytes(st["bytes_done"]), _format_bytes(st["bytes_total"]),
+        min(percent, 100.0), st["files_done"], st["files_total"],
+        _format_bytes(st["bytes_per_second"]),
+        _format_bytes(st["transferred_bytes_per_second"]), eta)
+
+  def _show(self, end):
+    tty = getattr(self.out, "isatty", lambda: False)()
+    if tty: self.out.write("\r\033[K" + self.line() + end)
+    else: self.out.write(self.line() + "\n")
+    self.out.flush()
+
+  def start(self):
+    def run():
+      while not self._stop.wait(self.interval):
+        self._show("")
+    self._thread = threading.Thread(target=run, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    """ Stops the display thread, and prints the final status line """
+    self._stop.set()
+    if self._thread: self._thread.join()
+    self._show("\n")
+
+def _disk_busy_ms(devices):
+  """
+    Returns a dict from each of the block devices "devices" (a set of
+    (major, minor)) listed in /proc/diskstats to the time (ms) it has spent
+    doing I/O, or None if none of them are listed there (e.g. tmpfs, or not
+    Linux)
+  """
+  busy = {}
+  try:
+    with open("/proc/diskstats") as f:
+      for line in f:
+        fields = line.split()
+        dev = (int(fields[0]), int(fields[1]))
+        if dev in devices: busy[dev] = int(fields[12])  # io_ticks
+  except (IOError, OSError, IndexError, ValueError):
+    return None
+  return busy or None
+
+def _disk_util(busy, new_busy, seconds):
+  """
+    The utilisation (%) of the busiest device over "seconds", given two
+    samples of _disk_busy_ms(), or None if it can't be told. Devices are
+    each busy at most 100% of the time, so adding them up would make a
+    backup across two disks look up to twice as busy as its busiest disk
+  """
+  if busy is None or new_busy is None or seconds <= 0: return None
+  deltas = [new_busy[d] - busy[d] for d in new_busy if d in busy]
+  if not deltas: return None
+  return 100.0 * max(deltas) / (seconds * 1000)
+
+def _load_per_cpu():
+  """ The 1-minute load average per CPU, or None if it can't be read """
+  try:
+    with open("/proc/loadavg") as f:
+      return float(f.read().split()[0]) / (os.cpu_count() or 1)
+  except (IOError, OSError, IndexError, ValueError):
+    return None
+
+def _descendants(pid):
+  """ "pid" and the pids of all of its descendants, found through /proc """
+  children = collections.defaultdict(list)
+  for d in os.listdir("/proc"):
+    if not d.isdigit(): continue
+    try:
+      with open(join("/proc", d, "stat")) as f:
+        # The command name (2nd field) may contain spaces, but not ")"
+        ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+      continue
+    children[ppid].append(int(d))
+  pids = [pid]
+  for p in pids: pids.extend(children[p])
+  return pids
+
+class Throttle:
+  """
+    Scheduling policy for the rsync commands of a backup, so that a backup
+    taken during the day uses spare I/O capacity without hurting the latency
+    of other work on the same disks.
+
+    Commands run under nice and ionice. Every "interval" seconds, a monitor
+    thread samples the utilisation of the disks holding the backup's source
+    and destination (from /proc/diskstats) and the load average (from
+    /proc/loadavg). While either is above its ceiling, the --bwlimit given to
+    new rsync commands is halved, down to "min_bwlimit"; once it's there (or
+    if there's no "max_bwlimit"), running commands are paused (SIGSTOP) until
+    the load drops. While there is headroom, the limit grows back towards
+    "max_bwlimit" by a tenth of it per interval. rsync can't change its
+    bandwidth limit while running, so with few, long commands pausing does
+    most of the work; --shard_files makes the limit adapt more finely.
+
+    Utilisation includes the backup's own I/O, so rather than detecting
+    foreground load as such, the backup keeps the disks at most
+    "max_disk_util" busy on average.
+  """
+
+  def __init__(self, nice=10, ionice_class=2, ionice_level=7,
+               max_bwlimit=None, min_bwlimit=1024, max_disk_util=70.0,
+               max_load=1.0, interval=5.0):
+    """
+      Keyword arguments:
+      nice -- niceness of the rsync processes (None: don't change it)
+      ionice_class, ionice_level -- I/O scheduling class (1: realtime, 2:
+          best-effort, 3: idle) and priority within the class (0-7, lowest
+          priority last) of the rsync processes (None: don't change them)
+      max_bwlimit, min_bwlimit -- range of the --bwlimit passed to rsync, in
+          KiB/s. If "max_bwlimit" is None, rsync's bandwidth isn't limited
+      max_disk_util -- ceiling on the utilisation (%) of the busier of the
+          source and destination disks
+      max_load -- ceiling on the 1-minute load average, per CPU
+      interval -- seconds between samples
+    """
+    assert ionice_class in (None, 1, 2, 3), \
+        "ionice_class ({}) must be 1, 2 or 3".format(ionice_class)
+    assert max_bwlimit is None or max_bwlimit >= min_bwlimit > 0, \
+        "need max_bwlimit >= min_bwlimit > 0"
+    self.nice = nice
+    self.ionice_class = ionice_class
+    self.ionice_level = ionice_level
+    self.max_bwlimit = max_bwlimit
+    self.min_bwlimit = min_bwlimit
+    self.max_disk_util = max_disk_util
+    self.max_load = max_load
+    self.interval = interval
+    self.bwlimit = max_bwlimit
+    self.paused = False
+    self.paused_seconds = 0.0
+    self._paused_at = None
+    self._pids = set()
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+
+  def wrap(self, cmd):
+    """
+      Returns the rsync command "cmd", run under nice and ionice with the
+      current --bwlimit (inserted before the source and destination)
+    """
+    if self.bwlimit:
+      cmd = cmd[:-2] + ["--bwlimit={}".format(self.bwlimit)] + cmd[-2:]
+    if self.ionice_class:
+      prefix = ["ionice", "-c", str(self.ionice_class)]
+      if self.ionice_class != 3 and self.ionice_level is not None:
+        prefix += ["-n", str(self.ionice_level)]
+      cmd = prefix + cmd
+    if self.nice is not None:
+      cmd = ["nice", "-n", str(self.nice)] + cmd
+    return cmd
+
+  def register(self, pid):
+    """ Adds a running rsync command, to be paused with the others """
+    with self._lock:
+      self._pids.add(pid)
+      if self.paused: self._signal([pid], signal.SIGSTOP)
+
+  def unregister(self, pid):
+    with self._lock:
+      self._pids.discard(pid)
+
+  def _signal(self, pids, sig):
+    for pid in pids:
+      for p in _descendants(pid):
+        try:
+          os.kill(p, sig)
+        except OSError:
+          continue  # Already exited
+
+  def adjust(self, util, load, now=None):
+    """
+      Updates the bandwidth limit, and pauses or resumes the running
+      commands, given the disk utilisation "util" (%) and load per CPU
+      "load" (either may be None if unknown)
+    """
+    now = monotonic() if now is None else now
+    busy = (util is not None and util > self.max_disk_util) or \
+           (load is not None and load > self.max_load)
+    with self._lock:
+      if busy and self.bwlimit and self.bwlimit > self.min_bwlimit:
+        self.bwlimit = max(self.min_bwlimit, self.bwlimit // 2)
+      elif busy and not self.paused:
+        self.paused = True
+        self._paused_at = now
+        self._signal(self._pids, signal.SIGSTOP)
+      elif not busy and self.paused:
+        self._resume(now)
+      elif not busy and self.bwlimit:
+        self.bwlimit = min(self.max_bwlimit,
+                           self.bwlimit + max(1, self.max_bwlimit // 10))
+
+  def _resume(self, now):
+    self.paused = False
+    self.paused_seconds += now - self._paused_at
+    self._signal(self._pids, signal.SIGCONT)
+
+  def start(self, paths):
+    """
+      Starts the monitor thread, watching the disks that hold "paths" (the
+      backup's source and destination). The busiest of them is held to
+      "max_disk_util"
+    """
+    devices = set()
+    for p in paths:
+      dev = os.stat(p).st_dev
+      devices.add((os.major(dev), os.minor(dev)))
+    def run():
+      busy, t = _disk_busy_ms(devices), monotonic()
+      while not self._stop.wait(self.interval):
+        new_busy, new_t = _disk_busy_ms(devices), monotonic()
+        util = _disk_util(busy, new_busy, new_t - t)
+        busy, t = new_busy, new_t
+        self.adjust(util, _load_per_cpu(), new_t)
+    self._stop.clear()
+    self._thread = threading.Thread(target=run, daemon=True)
+    self._thread.start()
+
+  def stop(self):
+    """ Stops the monitor thread, and resumes any paused commands """
+    self._stop.set()
+    if self._thread: self._thread.join()
+    with self._lock:
+      if self.paused: self._resume(monotonic())
+
+def _write_report(report_file, metrics_file, stats, scan_seconds, wall_seconds,
+                  extra_totals={}):
+  """
+    Writes the statistics of a backup run ("stats" is a list of
+    _CommandStats, in backup_order order) as a JSON report to "report_file"
+    and as an OpenMetrics textfile (e.g. for node_exporter's textfile
+    collector) to "metrics_file". "extra_totals" is a dict of other per-run
+    figures, which are added to the report's totals and exported as gauges
+    named "rsync_backup_<key>"
+  """
+  commands = [s.as_dict() for s in stats]
+  totals = {}
+  for k in ["files_seen", "files_transferred", "files_hardlinked",
+            "bytes_transferred", "bytes_logical"]:
+    totals[k] = sum(c[k] for c in commands)
+  totals.update(extra_totals)
+  totals["scan_seconds"] = scan_seconds
+  totals["wall_seconds"] = wall_seconds
+  totals["throughput_bytes_per_second"] = \
+      totals["bytes_transferred"] / wall_seconds if wall_seconds > 0 else 0.0
+  # Per file class (see _FILE_CLASS_ARGS), to check how each is tuned
+  classes = {}
+  for c in commands:
+    cls = classes.setdefault(c["file_class"], {
+        "commands": 0, "files_seen": 0, "bytes_transferred": 0,
+        "bytes_logical": 0, "wall_seconds": 0.0})
+    cls["commands"] += 1
+    for k in ["files_seen", "bytes_transferred", "bytes_logical",
+              "wall_seconds"]:
+      cls[k] += c[k]
+  with open(report_file, "w") as f:
+    json.dump({"finished": datetime.now().isoformat(), "totals": totals,
+               "classes": classes, "commands": commands}, f, indent=2)
+    f.write("\n")
+
+  def label(v):
+    v = v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return '"{}"'.format(v)
+  lines = []
+  def family(name, kind, help_text, samples):
+    lines.append("# TYPE {} {}".format(name, kind))
+    lines.append("# HELP {} {}".format(name, help_text))
+    for labels, value in samples:
+      labels = ",".join("{}={}".format(k, label(v)) for k, v in labels)
+      lines.append("{}{{{}}} {}".format(name, labels, value) if labels
+                   else "{} {}".format(name, value))
+  per_cmd = lambda key: [
+      ([("command", str(i)), ("entry", c["entry"])], c[key])
+      for i, c in enumerate(commands) ]
+  family("rsync_backup_files", "gauge", "Files seen by each rsync command",
+         per_cmd("files_seen"))
+  family("rsync_backup_files_transferred", "gauge",
+         "Files copied by each rsync command", per_cmd("files_transferred"))
+  family("rsync_backup_files_hardlinked", "gauge",
+         "Files hardlinked to the previous backup by each rsync command",
+         per_cmd("files_hardlinked"))
+  family("rsync_backup_transferred_bytes", "gauge",
+         "Bytes copied by each rsync command", per_cmd("bytes_transferred"))
+  family("rsync_backup_logical_bytes", "gauge",
+         "Total size of the files seen by each rsync command",
+         per_cmd("bytes_logical"))
+  family("rsync_backup_command_duration_seconds", "gauge",
+         "Wall time of each rsync command", per_cmd("wall_seconds"))
+  family("rsync_backup_command_throughput_bytes_per_second", "gauge",
+         "Bytes copied per second by each rsync command",
+         per_cmd("throughput_bytes_per_second"))
+  family("rsync_backup_class_duration_seconds", "gauge",
+         "Total wall time of the rsync commands for each file class",
+         [([("class", k)], classes[k]["wall_seconds"])
+          for k in sorted(classes)])
+  family("rsync_backup_scan_duration_seconds", "gauge",
+         "Time spent scanning the source directory before running rsync",
+         [([], scan_seconds)])
+  family("rsync_backup_duration_seconds", "gauge",
+         "Wall time of the whole backup run", [([], wall_seconds)])
+  for k in sorted(extra_totals):
+    family("rsync_backup_" + k, "gauge", k.replace("_", " ").capitalize(),
+           [([], extra_totals[k])])
+  family("rsync_backup_last_success_timestamp_seconds", "gauge",
+         "Time at which the backup finished",
+         [([], datetime.now().timestamp())])
+  lines.append("# EOF")
+  with open(metrics_file, "w") as f:
+    f.write("\n".join(lines) + "\n")
+
+def _dedup_files(dst, manifest, index_path):
+  """
+    Replaces files in "dst" that were copied by rsync (i.e. aren't hardlinks)
+    with hardlinks to an identical file in an earlier backup, found through
+    the content-hash index at "index_path" (an SQLite database mapping content
+    hash to one existing copy). This catches files that --link-dest misses
+    because they were renamed or moved. Hashes come from "manifest" (this
+    backup's manifest), so no file contents are read.
+
+    Files are only linked to copies outside "dst", whose inode isn't already
+    in "dst", and whose size, mtime, mode and owner match, so that the backup
+    restores exactly as the source was. Copies made by this run are added to
+    the index. Returns (files linked, bytes saved)
+  """
+  base = os.path.dirname(abspath(index_path))
+  db = sqlite3.connect(index_path, timeout=600)
+  db.execute("CREATE TABLE IF NOT EXISTS files (digest TEXT PRIMARY KEY, "
+             "path TEXT NOT NULL, dev INTEGER, ino INTEGER)")
+  # Stat everything first, so that no two files in "dst" end up sharing an
+  # inode that they don't share in the source
+  files = []
+  dst_inodes = set()
+  for p, e in manifest.items():
+    try:
+      st = os.lstat(join(dst, p))
+    except OSError:
+      continue
+    dst_inodes.add(st.st_ino)
+    # The file may have changed between hashing and copying
+    if stat.S_ISREG(st.st_mode) and st.st_size == e.size and \
+        st.st_mtime_ns // 10**9 == e.mtime_ns // 10**9:
+      files.append((p, e, st))
+
+  linked = saved = 0
+  with db:
+    for p, e, st in files:
+      path = join(dst, p)
+      row = db.execute("SELECT path, dev, ino FROM files WHERE digest = ?",
+                       (e.digest,)).fetchone()
+      target = join(base, row[0]) if row else None
+      try:
+        tst = os.lstat(target) if target else None
+      except OSError:
+        tst = None  # The indexed copy was deleted (e.g. by pruning)
+      if tst is None or (tst.st_dev, tst.st_ino) != (row[1], row[2]):
+        # Nothing (valid) indexed yet -- index this copy
+        db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                   (e.digest, os.path.relpath(path, base), st.st_dev, st.st_ino))
+        continue
+      if st.st_nlink > 1 or tst.st_ino in dst_inodes or \
+          tst.st_dev != st.st_dev or \
+          (tst.st_size, tst.st_mtime_ns // 10**9, tst.st_mode, tst.st_uid,
+           tst.st_gid) != (st.st_size, st.st_mtime_ns // 10**9, st.st_mode,
+                           st.st_uid, st.st_gid):
+        continue
+      tmp = path + ".dedup.tmp"
+      try:
+        os.link(target, tmp)
+        os.rename(tmp, path)
+      except OSError:
+        continue  # e.g. too many links to "target"
+      dst_inodes.add(tst.st_ino)
+      linked += 1
+      saved += st.st_size
+  db.close()
+  return linked, saved
+
+class Catalog:
+  """
+    An SQLite index of the files in every backup in a backup drive, so that
+    the history of a file can be looked up without walking the backups.
+
+    Each version of a file (a path with given contents) is one row, with the
+    first and last backup that hold it: backups are numbered in the order
+    they were added, and a version is in every backup in between. So adding
+    a backup only inserts rows for the files that changed (and extends the
+    others with one set-based UPDATE), and the catalog grows with the number
+    of changes rather than of files times backups. Rows of new versions also
+    keep rsync's itemized changes and bytes transferred, if the backup that
+    added them was cataloged as it ran.
+
+    Contents are identified by the hashes in the backups' manifests, so only
+    backups with a manifest can be cataloged.
+  """
+
+  def __init__(self, path):
+    """
+      Keyword arguments:
+      path -- the SQLite database (e.g. catalog.sqlite in the backup drive),
+          created if it doesn't exist
+    """
+    self.path = abspath(path)
+    self.db = sqlite3.connect(self.path, timeout=600)
+    with self.db:
+      self.db.execute(
+          "CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, "
+          "name TEXT UNIQUE NOT NULL, taken TEXT NOT NULL, files INTEGER, "
+          "pruned INTEGER NOT NULL DEFAULT 0)")
+      self.db.execute(
+          "CREATE TABLE IF NOT EXISTS versions (id INTEGER PRIMARY KEY, "
+          "path TEXT NOT NULL, digest TEXT NOT NULL, size INTEGER, "
+          "mtime_ns INTEGER, first INTEGER NOT NULL, last INTEGER NOT NULL, "
+          "item TEXT, bytes_transferred INTEGER)")
+      for column in ["path", "digest", "first", "last"]:
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_{0} ON versions "
+                        "({0})".format(column))
+
+  def close(self):
+    self.db.close()
+
+  def add(self, name, taken, manifest, transfers=None):
+    """
+      Adds the backup "name", taken on "taken" (a date), whose files are in
+      "manifest" (see _save_manifest()). It must be newer than every backup
+      already in the catalog. "transfers" is a dict from path to (itemized
+      changes, bytes transferred) for the files that rsync copied (see
+      _CommandStats.transfers)
+    """
+    transfers = transfers or {}
+    with self.db:
+      latest = self.db.execute(
+          "SELECT id, taken FROM snapshots ORDER BY id DESC LIMIT 1").fetchone()
+      assert latest is None or latest[1] < taken.isoformat(), \
+          "{} isn't newer than the cataloged backups".format(name)
+      prev = latest[0] if latest else None
+      cur = self.db.execute(
+          "INSERT INTO snapshots (name, taken, files) VALUES (?, ?, ?)",
+          (name, taken.isoformat(), len(manifest))).lastrowid
+      self.db.execute(
+          "CREATE TEMP TABLE current (path TEXT PRIMARY KEY, digest TEXT, "
+          "size INTEGER, mtime_ns INTEGER, item TEXT, "
+          "bytes_transferred INTEGER)")
+      try:
+        self.db.executemany(
+            "INSERT INTO current VALUES (?, ?, ?, ?, ?, ?)",
+            ((p, e.digest, e.size, e.mtime_ns) + transfers.get(p, (None, None))
+             for p, e in manifest.items()))
+        # Versions still present are now also in this backup
+        self.db.execute(
+            "UPDATE versions SET last = ? WHERE last = ? AND EXISTS ("
+            "SELECT 1 FROM current c WHERE c.path = versions.path AND "
+            "c.digest = versions.digest)", (cur, prev))
+        self.db.execute(
+            "INSERT INTO versions (path, digest, size, mtime_ns, first, last, "
+            "item, bytes_transferred) SELECT c.path, c.digest, c.size, "
+            "c.mtime_ns, ?, ?, c.item, c.bytes_transferred FROM current c "
+            "WHERE NOT EXISTS (SELECT 1 FROM versions v WHERE "
+            "v.path = c.path AND v.last = ?)", (cur, cur, cur))
+      finally:
+        self.db.execute("DROP TABLE current")
+
+  def update(self, drive, current=None):
+    """
+      Brings the catalog up to date with the backups in "drive": adds the
+      completed backups (with a manifest) that are newer than every
+      cataloged one, oldest first, and marks the cataloged backups that were
+      deleted (e.g. by Backup.Prune()) as pruned. Returns the names of the
+      backups added.
+
+      Keyword arguments:
+      current -- (name, manifest, transfers) for a backup that has just been
+          taken, so that its manifest isn't read back and its rsync output is
+          cataloged (see add())
+          (Default value = None)
+    """
+    drive = abspath(drive)
+    snapshots = list(reversed(Backup._list_snapshots(drive)))
+    names = set(os.path.basename(p) for t, p in snapshots)
+    with self.db:
+      for (name,) in self.db.execute(
+          "SELECT name FROM snapshots WHERE NOT pruned").fetchall():
+        if name not in names:
+          self.db.execute("UPDATE snapshots SET pruned = 1 WHERE name = ?",
+                          (name,))
+    latest = self.db.execute("SELECT max(taken) FROM snapshots").fetchone()[0]
+    added = []
+    for t, path in snapshots:
+      name = os.path.basename(path)
+      if (latest and t.date().isoformat() <= latest) or \
+          not exists(join(path, Backup._DONE_FILE)):
+        continue
+      if current and current[0] == name:
+        manifest, transfers = current[1], current[2]
+      else:
+        manifest = _load_manifest(join(path, Backup._MANIFEST_FILE))
+        transfers = None
+      if manifest is None: continue
+      self.add(name, t.date(), manifest, transfers)
+      added.append(name)
+    return added
+
+  def versions(self, path):
+    """
+      Returns every cataloged version of "path" (relative to the backed up
+      directory), oldest first: dicts with its "digest", "size", "mtime_ns",
+      the "first" and "last" backup holding it, and the "item" (rsync's
+      itemized changes) and "bytes_transferred" of its first backup, if known
+    """
+    rows = self.db.execute(
+        "SELECT v.digest, v.size, v.mtime_ns, f.name, l.name, v.item, "
+        "v.bytes_transferred FROM versions v JOIN snapshots f ON f.id = v.first "
+        "JOIN snapshots l ON l.id = v.last WHERE v.path = ? ORDER BY v.first",
+        (path,))
+    keys = ["digest", "size", "mtime_ns", "first", "last", "item",
+            "bytes_transferred"]
+    return [dict(zip(keys, row)) for row in rows]
+
+  def snapshots(self, path=None, digest=None):
+    """
+      Returns (backup, path) for every backup that hasn't been pruned and that
+      holds "path", or (if "digest" is set) a file with the content hash
+      "digest", oldest first
+    """
+    assert (path is None) != (digest is None), \
+        "exactly one of path and digest must be set"
+    column, value = ("path", path) if path is not None else ("digest", digest)
+    return [tuple(row) for row in self.db.execute(
+        "SELECT s.name, v.path FROM versions v JOIN snapshots s "
+        "ON s.id BETWEEN v.first AND v.last WHERE v.{} = ? AND NOT s.pruned "
+        "ORDER BY s.id, v.path".format(column), (value,))]
+
+  def changes(self, start, end):
+    """
+      Returns (backup, path, change) for every file that was "added",
+      "modified" or "deleted" in a backup taken after the date "start" and no
+      later than the date "end", compared with the backup cataloged before
+      it, ordered by backup and path
+    """
+    return [tuple(row[:3]) for row in self.db.execute(
+        "WITH w AS (SELECT s.id, s.name, (SELECT max(p.id) FROM snapshots p "
+        "WHERE p.id < s.id) AS prev FROM snapshots s "
+        "WHERE s.taken > ? AND s.taken <= ?) "
+        "SELECT w.name, v.path, CASE WHEN EXISTS (SELECT 1 FROM versions o "
+        "WHERE o.path = v.path AND o.last = w.prev) THEN 'modified' "
+        "ELSE 'added' END, w.id FROM versions v JOIN w ON v.first = w.id "
+        "UNION ALL "
+        "SELECT w.name, v.path, 'deleted', w.id FROM versions v "
+        "JOIN w ON v.last = w.prev WHERE NOT EXISTS (SELECT 1 FROM versions n "
+        "WHERE n.path = v.path AND n.first = w.id) "
+        "ORDER BY 4, 2", (start.isoformat(), end.isoformat()))]
+
+def _dir_totals(root, rel, excluded):
+  """
+    Scans the directory join(root, rel) and returns a dict from every
+    directory under it (including "rel"; paths are relative to "root") to
+    [entries, bytes] for its whole subtree, where "entries" counts files,
+    directories, symlinks etc. as one each (like rsync's file list). Paths in
+    "excluded" are skipped
+  """
+  totals = {}
+  order = []
+  stack = [rel]
+  while stack:
+    d = stack.pop()
+    order.append(d)
+    entries = 1
+    size = 0
+    try:
+      it = os.scandir(join(root, d))
+    except OSError:
+      totals[d] = [entries, size]
+      continue
+    with it:
+      for e in it:
+        p = join(d, e.name) if d else e.name
+        if p in excluded: continue
+        try:
+          if e.is_dir(follow_symlinks=False):
+            stack.append(p)
+          else:
+            entries += 1
+            size += e.stat(follow_symlinks=False).st_size
+        except OSError:
+          continue
+    totals[d] = [entries, size]
+  # Children always come after their parents in "order"
+  for d in reversed(order):
+    if d == rel: continue
+    parent = totals[os.path.dirname(d)]
+    parent[0] += totals[d][0]
+    parent[1] += totals[d][1]
+  return totals
+
+def _plan_shards(root, rel, excluded, max_entries=None, max_bytes=None):
+  """
+    Splits the directory join(root, rel) into shards of at most "max_entries"
+    entries and "max_bytes" bytes (either may be None, for no limit), based on
+    a scandir pre-scan (see _dir_totals()). Each shard is a list of paths
+    relative to "root": directories, to be copied recursively, and individual
+    files of directories too big for one shard. A file bigger than
+    "max_bytes" gets a shard to itself. Paths in "excluded" are left out.
+
+    Returns None if the whole directory fits in one shard.
+  """
+  totals = _dir_totals(root, rel, excluded)
+  def fits(entries, size, used=(0, 0)):
+    return (max_entries is None or used[0] + entries <= max_entries) and \
+        (max_bytes is None or used[1] + size <= max_bytes)
+  if fits(*totals[rel]): return None
+
+  shards = []
+  current = []
+  used = [0, 0]
+  def add(path, entries, size):
+    if current and not fits(entries, size, used):
+      shards.append(list(current))
+      del current[:]
+      used[:] = [0, 0]
+    current.append(path)
+    used[0] += entries
+    used[1] += size
+
+  # Depth-first, in sorted order, splitting directories that don't fit
+  stack = [rel]
+  while stack:
+    d = stack.pop()
+    if d != rel and fits(*totals[d]):
+      add(d, *totals[d])
+      continue
+    try:
+      with os.scandir(join(root, d)) as it:
+        children = sorted(it, key=lambda e: e.name)
+    except OSError:
+      continue
+    subdirs = []
+    for e in children:
+      p = join(d, e.name) if d else e.name
+      if p in excluded: continue
+      try:
+        if e.is_dir(follow_symlinks=False):
+          subdirs.append(p)
+        else:
+          add(p, 1, e.stat(follow_symlinks=False).st_size)
+      except OSError:
+        continue
+    stack.extend(reversed(subdirs))
+  if current: shards.append(current)
+  return shards
+
+def _parallel_walk(top, visit, workers=16, skip_unreadable=False):
+  """
+    Walks the directory tree at "top" with "workers" threads, calling
+    visit(dir, entries) from the worker threads for every directory, where
+    "entries" is the list of os.DirEntry in "dir". Subdirectories are found
+    (and walked in parallel) after visit() returns, so visit() may e.g. change
+    a directory's permissions before it's entered, and may return False to
+    skip walking the directory's subdirectories. Metadata operations release
+    the GIL, so walks dominated by disk latency scale with "workers".
+
+    Returns the list of (depth, path) for every directory walked, in no
+    particular order. The first error raised by visit() (or while listing a
+    directory, unless "skip_unreadable" is set) is re-raised once the walk is
+    over.
+  """
+  dirs = []
+  errors = []
+  lock = threading.Lock()
+  idle = threading.Condition(lock)
+  pending = [0]
+  def walk(d, depth):
+    try:
+      try:
+        with os.scandir(d) as it:
+          entries = list(it)
+      except OSError:
+        if not skip_unreadable: raise
+        entries = None
+      if entries is not None and visit(d, entries) is not False:
+        for e in entries:
+          if e.is_dir(follow_symlinks=False):
+            with lock:
+              dirs.append((depth + 1, e.path))
+              pending[0] += 1
+            pool.submit(walk, e.path, depth + 1)
+    except Exception as e:
+      with lock: errors.append(e)
+    finally:
+      with lock:
+        pending[0] -= 1
+        if pending[0] == 0: idle.notify_all()
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    with lock:
+      dirs.append((0, top))
+      pending[0] += 1
+    pool.submit(walk, top, 0)
+    with lock:
+      while pending[0] > 0: idle.wait()
+  if errors: raise errors[0]
+  return dirs
+
+def _parallel_rmtree(path, workers=16):
+  """
+    Deletes the directory tree at "path", like "rm -r", but with "workers"
+    threads: removing a hardlink farm is almost all metadata I/O, so one
+    thread spends most of its time waiting on the disk. Directories are
+    listed and emptied in parallel (see _parallel_walk()), then removed
+    deepest first. Directories without write permission (rsync preserves
+    modes) are made writable first.
+  """
+  def make_writable(d):
+    st = os.lstat(d)
+    if st.st_mode & stat.S_IRWXU != stat.S_IRWXU:
+      os.chmod(d, st.st_mode | stat.S_IRWXU)
+  make_writable(path)
+  def empty_dir(d, entries):
+    for e in entries:
+      if e.is_dir(follow_symlinks=False):
+        make_writable(e.path)
+      else:
+        os.unlink(e.path)
+  dirs = _parallel_walk(path, empty_dir, workers)
+
+  # Remove directories one depth at a time, deepest first
+  by_depth = collections.defaultdict(list)
+  for depth, d in dirs: by_depth[depth].append(d)
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for depth in sorted(by_depth, reverse=True):
+      list(pool.map(os.rmdir, by_depth[depth]))
+
+def _snapshot_usage(path, workers=16):
+  """
+    Scans the backup at "path" (see _parallel_walk()) and returns
+    (overhead, inodes): "inodes" maps (st_dev, st_ino) of every regular file
+    to [bytes, links], where "bytes" is the space allocated to the file (as
+    reported by du) and "links" is the number of hardlinks to it inside the
+    backup. "overhead" is the space used by everything else (directories,
+    symlinks), which is never shared with other backups. Files and
+    directories that vanish during the scan (as they may in a backup that
+    is being taken) are left out.
+  """
+  inodes = {}
+  overhead = [os.lstat(path).st_blocks * 512]
+  lock = threading.Lock()
+  def visit(d, entries):
+    files = []
+    other = 0
+    for e in entries:
+      try:
+        st = e.stat(follow_symlinks=False)
+      except OSError:
+        continue
+      if stat.S_ISREG(st.st_mode):
+        files.append(((st.st_dev, st.st_ino), st.st_blocks * 512))
+      else:
+        other += st.st_blocks * 512
+    with lock:
+      overhead[0] += other
+      for key, size in files:
+        if key in inodes:
+          inodes[key][1] += 1
+        else:
+          inodes[key] = [size, 1]
+  _parallel_walk(path, visit, workers, skip_unreadable=True)
+  return overhead[0], inodes
+
+def _cached_snapshot_usage(path, cache_file, workers=16):
+  """
+    Like _snapshot_usage(), but if the backup is complete (and so won't change
+    any more), the result is saved to "cache_file", and read from there on
+    later calls, as long as the backup directory itself hasn't changed.
+    Returns (overhead, inodes, whether the cache was used)
+  """
+  st = os.lstat(path)
+  key = [st.st_ino, st.st_mtime_ns]
+  if exists(cache_file):
+    with gzip.open(cache_file, "rt") as f:
+      cached = json.load(f)
+    if cached["key"] == key:
+      inodes = dict(((dev, ino), [size, links])
+                    for dev, ino, size, links in cached["inodes"])
+      return cached["overhead"], inodes, True
+  overhead, inodes = _snapshot_usage(path, workers)
+  if exists(join(path, Backup._DONE_FILE)):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with gzip.open(cache_file + ".tmp", "wt") as f:
+      json.dump({"key": key, "overhead": overhead, "inodes": [
+          [dev, ino, size, links]
+          for (dev, ino), (size, links) in inodes.items()]}, f)
+    os.rename(cache_file + ".tmp", cache_file)
+  return overhead, inodes, False
+
+def _retained_snapshots(snapshots, daily, weekly, monthly):
+  """
+    Applies a retention policy to "snapshots" ((date, path) pairs, most recent
+    first, as returned by Backup._list_snapshots()), and returns the set of
+    paths to keep: the "daily" most recent backups, and the most recent
+    backup of each of the "weekly" most recent weeks and "monthly" most recent
+    months that have one. Only completed backups count towards the policy.
+
+    Regardless of the policy, the most recent completed backup and every
+    backup newer than it (in progress or waiting to be resumed) are kept.
+    Older incomplete backups are never kept.
+  """
+  done = [(t, p) for t, p in snapshots
+          if exists(join(p, Backup._DONE_FILE))]
+  keep = set()
+  if done:
+    newest = done[0][0]
+    keep.update(p for t, p in snapshots if t >= newest)
+  keep.update(p for t, p in done[:daily])
+  for period, n in [(lambda t: t.isocalendar()[:2], weekly),
+                    (lambda t: (t.year, t.month), monthly)]:
+    seen = []
+    for t, p in done:
+      if period(t) in seen: continue
+      if len(seen) >= n: break
+      seen.append(period(t))
+      keep.add(p)
+  return keep
+
+def _read_change_journal(path, root, since=None):
+  """
+    Reads the change journal at "path", written by backup_watch.py while it
+    watches the directory "root". The journal is a sequence of NUL-terminated
+    records: a header ("H" + JSON with the watcher run's "id" and "src"),
+    then "P" + the path (relative to "root") of each file or directory that
+    changed, and "O" wherever events were lost. The watcher holds an
+    exclusive flock on the journal while it runs.
+
+    Returns (position, changes): "position" is {"id": ..., "offset": ...},
+    the end of the journal, to be passed as "since" next time. "changes" is
+    the set of paths recorded after "since", or None if they may not be
+    complete: "since" is None or from another watcher run, the journal
+    overflowed, or the watcher isn't running (so changes may be going
+    unrecorded). Returns (None, None) if there is no journal for "root"
+  """
+  try:
+    f = open(path, "rb")
+  except OSError:
+    return None, None
+  with f:
+    try:
+      fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+      running = False
+    except BlockingIOError:
+      running = True
+    head = f.read(1 << 16)
+    if not head.startswith(b"H") or b"\0" not in head:
+      return None, None
+    header = json.loads(head[1:head.index(b"\0")])
+    if header.get("src") != root:
+      return None, None
+    start = head.index(b"\0") + 1
+    valid = running and since is not None and since.get("id") == header["id"]
+    f.seek(0, os.SEEK_END)
+    if valid and start <= since["offset"] <= f.tell(): start = since["offset"]
+    else: valid = False
+    f.seek(start)
+    data = f.read()
+  end = data.rfind(b"\0") + 1  # Ignore a record that's still being written
+  position = {"id": header["id"], "offset": start + end}
+  changes = set()
+  for record in data[:end].split(b"\0")[:-1]:
+    if record.startswith(b"P"):
+      changes.add(os.fsdecode(record[1:]))
+    elif record == b"O":
+      valid = False
+  return position, changes if valid else None
+
+def _changed_roots(changes, backup_order):
+  """
+    The paths that must be scanned and copied again to back up "changes"
+    (see _read_change_journal()) with "backup_order": the changed paths that
+    "backup_order" covers, plus the backup_order entries inside a changed
+    directory, with nested paths removed
+  """
+  trie = _OrderTrie(backup_order)
+  picked = set()
+  for c in changes:
+    if trie.owner(c) is not None: picked.add(c)
+    else: picked.update(trie.entries_under(c))
+  return _outermost(picked)
+
+def _under(path, paths):
+  """ True if "path" or one of its parent directories is in the set "paths" """
+  while path:
+    if path in paths: return True
+    path = os.path.dirname(path)
+  return False
+
+def _has_glob(entry):
+  """ True if the backup_order entry "entry" is a shell pattern """
+  return entry != "..." and re.search(r"[*?[]", entry) is not None
+
+def _escape_pattern(path):
+  """
+    Escapes the wildcard characters in "path", for an rsync filter rule.
+    rsync only reads "\\" as an escape in rules that have wildcards, so paths
+    without any are left as they are
+  """
+  if not re.search(r"[*?[]", path): return path
+  return re.sub(r"([*?[\\])", r"\\\1", path)
+
+def _literal_entry(root, entry):
+  """
+    The normalized backup_order entry "entry" (other than "..."). If it has
+    wildcard characters but names an existing file in "root" (e.g. "Photos
+    [2014]"), they are escaped, so that it's matched literally rather than
+    as a shell pattern
+  """
+  entry = normpath(entry)
+  if _has_glob(entry) and os.path.lexists(join(root, entry)):
+    entry = _escape_pattern(entry)
+  return entry
+
+def _glob_prefix(pattern):
+  """ The leading components of "pattern" that contain no wildcards """
+  prefix = []
+  for c in pattern.split("/"):
+    if _has_glob(c): break
+    prefix.append(c)
+  return "/".join(prefix)
+
+def _glob_regex(pattern):
+  """
+    Compiles the backup_order pattern "pattern" into a regex that matches
+    paths (relative to the source directory) as rsync's filter rules would:
+    "*" and "?" match anything but "/", "**" also matches "/", and "[...]"
+    is a character class
+  """
+  out = []
+  i = 0
+  while i < len(pattern):
+    c = pattern[i]
+    if pattern.startswith("**", i):
+      out.append(".*")
+      i += 2
+      continue
+    if c == "*":
+      out.append("[^/]*")
+    elif c == "?":
+      out.append("[^/]")
+    elif c == "[" and pattern.find("]", i + 2) > 0:
+      j = pattern.find("]", i + 2)
+      cls = pattern[i + 1:j].replace("\\", "\\\\")
+      out.append("[" + ("^" + cls[1:] if cls.startswith("!") else cls) + "]")
+      i = j + 1
+      continue
+    elif c == "\\" and i + 1 < len(pattern):
+      i += 1
+      out.append(re.escape(pattern[i]))
+    else:
+      out.append(re.escape(c))
+    i += 1
+  return re.compile("".join(out) + r"\Z")
+
+def _glob_filter_rules(pattern):
+  """
+    rsync filter rules that copy only what "pattern" matches (including the
+    contents of matching directories) in a transfer of the whole source
+    directory: the directories leading to the matches are included, and
+    everything else excluded. Used with --prune-empty-dirs, so that only the
+    leading directories that hold a match are created in the backup
+  """
+  parts = pattern.split("/")
+  rules = ["+ /{}/".format("/".join(parts[:k])) for k in range(1, len(parts))]
+  return rules + ["+ /" + pattern, "+ /{}/**".format(pattern), "- *"]
+
+class _OrderTrie:
+  """
+    A backup_order, compiled for planning. Plain paths are stored in a trie
+    of path components, where each node is [order, children] ("order" is the
+    index of the entry that ends at the node, or None), and shell patterns
+    in a list. Looking up a path takes time proportional to its depth (plus
+    the number of patterns), so planning stays linear in the number of
+    entries even for backup orders with thousands of them.
+
+    The entry that backs up a path is the first one in backup_order that
+    covers it: a plain entry that is the path or one of its parents, a
+    pattern that matches the path or one of its parents, or "..."
+  """
+
+  def __init__(self, backup_order):
+    self.entries = backup_order
+    self.root = [None, {}]
+    self.globs = []  # (order, compiled pattern), in backup_order order
+    self.rest = None  # The order of "...", if present
+    for i, f in enumerate(backup_order):
+      if f == "...":
+        self.rest = i
+      elif _has_glob(f):
+        self.globs.append((i, _glob_regex(f)))
+      else:
+        node = self._node(f, create=True)
+        if node[0] is None: node[0] = i
+
+  def _node(self, path, create=False):
+    """ The trie node for "path" ("" is the root), or None """
+    node = self.root
+    for c in path.split("/") if path else []:
+      if create: node = node[1].setdefault(c, [None, {}])
+      else: node = node[1].get(c)
+      if node is None: return None
+    return node
+
+  def owner(self, path):
+    """
+      The index in backup_order of the entry that backs up "path" (relative
+      to the source directory), or None if no entry does
+    """
+    best = None
+    node = self.root
+    for c in path.split("/"):
+      node = node[1].get(c)
+      if node is None: break
+      if node[0] is not None and (best is None or node[0] < best):
+        best = node[0]
+    if self.globs:
+      parents = [path[:i] for i, c in enumerate(path) if c == "/"] + [path]
+      for i, rx in self.globs:
+        if best is not None and i > best: break
+        if any(rx.match(p) for p in parents):
+          best = i
+          break
+    return self.rest if best is None else best
+
+  def entry_of(self, path):
+    """ The backup_order entry that backs up "path", or None """
+    i = self.owner(path)
+    return None if i is None else self.entries[i]
+
+  def covered(self, i):
+    """
+      True if entry "i" is a plain path inside an earlier entry, so that it
+      was already backed up and needs no command of its own
+    """
+    f = self.entries[i]
+    if f == "..." or _has_glob(f): return False
+    return self.owner(f) < i
+
+  def _topmost(self, path, before):
+    """
+      The plain entries with an index below "before" that are inside
+      "path" (but not "path" itself), leaving out ones inside another
+    """
+    start = self._node(path)
+    if start is None: return []
+    found = []
+    stack = [(join(path, c) if path else c, n) for c, n in start[1].items()]
+    while stack:
+      p, node = stack.pop()
+      if node[0] is not None and node[0] < before:
+        found.append(p)
+        continue
+      stack.extend((join(p, c), n) for c, n in node[1].items())
+    return found
+
+  def excluded(self, i):
+    """
+      Returns (paths, patterns): the plain and pattern entries before entry
+      "i" that its command would copy again, and so must exclude
+    """
+    f = self.entries[i]
+    within = "" if f == "..." or _has_glob(f) else f
+    return (self._topmost(within, i),
+            [self.entries[j] for j, _ in self.globs if j < i])
+
+  def entries_under(self, path):
+    """ The plain entries inside "path", leaving out ones inside another """
+    return self._topmost(path, len(self.entries))
+
+  def in_scope(self, path):
+    """
+      True if something under the directory "path" is backed up: "path" is
+      inside an entry, or leads to one
+    """
+    if self.owner(path) is not None or self._node(path) is not None:
+      return True
+    return any(_glob_prefix(self.entries[i]) in ("", path) or
+               _covers(path, _glob_prefix(self.entries[i])) or
+               _covers(_glob_prefix(self.entries[i]), path)
+               for i, _ in self.globs)
+
+def _order_roots(backup_order):
+  """
+    The paths (relative to the source directory) of the trees that
+    "backup_order" backs up, with nested entries removed. "" means the whole
+    source directory. For a shell pattern, that's the directory that all of
+    its matches are in (see _glob_prefix()), so not everything under these
+    paths is necessarily backed up (see _OrderTrie.owner())
+  """
+  if "..." in backup_order: return [""]
+  return _outermost(_glob_prefix(f) if _has_glob(f) else f
+                    for f in backup_order)
+
+def _outermost(paths):
+  """ "paths", sorted, leaving out the ones inside another ("" is the root) """
+  kept = []
+  # Sorting by components puts each path right before the paths inside it
+  for f in sorted(set(paths), key=lambda f: f.split("/")):
+    if kept and (kept[-1] == "" or _covers(kept[-1], f)): continue
+    kept.append(f)
+  return kept
+
+def _verify_file(rel, src, dst, src_digest):
+  """
+    Compares the file "rel" in the directories "src" and "dst" by content
+    hash, hashing the source file only if "src_digest" is None. Runs in a
+    worker process of Backup.Verify(). Returns (rel, problem), where
+    "problem" is None if the files match
+  """
+  try:
+    dst_digest = _hash_file(join(dst, rel))
+  except OSError as e:
+    return rel, "unreadable backup: {}".format(e)
+  try:
+    if src_digest is None: src_digest = _hash_file(join(src, rel))
+  except OSError:
+    return rel, None  # Vanished or unreadable since the backup was taken
+  return rel, None if src_digest == dst_digest else "contents differ"
+
+def _covers(a, b):
+  """
+    True if the backup_order entry "a" contains the entry "b" (i.e. backing up
+    "a" also backs up everything in "b")
+  """
+  if a == "..." or b == "...": return False
+  return b == a or b.startswith(a + "/")
+
+# ioctl that makes a file a copy-on-write clone of another, sharing its data
+# blocks (_IOW(0x94, 9, int) in linux/fs.h). Supported by btrfs, XFS (with
+# reflink=1) and a few others, within one filesystem
+_FICLONE = 0x40049409
+
+# Errors with which copy_file_range(2) refuses files that read() and write()
+# can still copy: e.g. files on different filesystems (before Linux 5.3, and
+# again since 5.19 for most filesystems), or no kernel support at all
+_COPY_FILE_RANGE_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP,
+                                errno.EINVAL)
+# (source st_dev, destination st_dev) pairs that copy_file_range refused, so
+# that it's only tried once per pair of filesystems
+_no_copy_file_range = set()
+
+def _remove(path):
+  """ Removes whatever "path" is (a directory tree, a file or a symlink) """
+  if isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path)
+  else:
+    os.remove(path)
+
+def _create_file(path):
+  """
+    Returns a descriptor (for writing) of a new, empty file at "path",
+    replacing whatever was there. The old file is unlinked rather than
+    truncated, as it may be a hardlink into an earlier backup
+  """
+  flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC
+  try:
+    return os.open(path, flags, 0o600)
+  except FileExistsError:
+    _remove(path)
+    return os.open(path, flags, 0o600)
+
+def _copy_data(src, fd):
+  """
+    Copies the contents of the file "src" to the empty file open as "fd".
+    copy_file_range(2) copies within the kernel (and itself clones or
+    offloads the copy where the filesystem can), and read() and write() are
+    used where it isn't supported. Returns the number of bytes copied
+  """
+  copied = 0
+  with open(src, "rb") as f:
+    key = (os.fstat(f.fileno()).st_dev, os.fstat(fd).st_dev)
+    if hasattr(os, "copy_file_range") and key not in _no_copy_file_range:
+      try:
+        while True:
+          n = os.copy_file_range(f.fileno(), fd, 1 << 30)
+          if n == 0: return copied
+          copied += n
+      except OSError as e:
+        if copied or e.errno not in _COPY_FILE_RANGE_UNSUPPORTED: raise
+        _no_copy_file_range.add(key)
+    while True:
+      buf = f.read(8 << 20)
+      if not buf: return copied
+      view = memoryview(buf)
+      while view:
+        view = view[os.write(fd, view):]
+      copied += len(buf)
+
+def _set_attrs(path, st):
+  """
+    Gives "path" the owner, permissions and times in "st" (a stat of the file
+    it's a copy of), like rsync -a. The owner is only set where the process
+    is allowed to
+  """
+  if (st.st_uid, st.st_gid) != (os.geteuid(), os.getegid()):
+    try:
+      os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+      pass
+  if not stat.S_ISLNK(st.st_mode):  # Linux can't chmod symlinks
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+  os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
 class Backup:
   """ Data structure with all information needed to create a backup """
 
@@ -39,8 +1639,34 @@ class Backup:
   _DATE_FORMAT = "%d-%b-%Y"
   _LOG_FILE = "rsync_backup.log"
   _DONE_FILE = "BACKUP_DONE"
+  _MANIFEST_FILE = "BACKUP_MANIFEST.gz"
+  _REPORT_FILE = "backup_report.json"
+  _METRICS_FILE = "backup_metrics.prom"
+  # Lives in the backup drive, next to the dated backups
+  _DEDUP_INDEX_FILE = "dedup_index.sqlite"
+  # Lives in the backup drive too (see Catalog)
+  _CATALOG_FILE = "catalog.sqlite"
+  # Commands that have finished, while a backup is in progress
+  _JOURNAL_FILE = "BACKUP_JOURNAL"
+  # Backups being deleted by Prune() are renamed to this prefix + their name
+  _PRUNE_PREFIX = ".pruning-"
+  # Cache of SpaceReport() scans, in the backup drive
+  _SPACE_CACHE_DIR = ".space_cache"
+  # Position in the change journal (see backup_watch.py) as of this backup
+  _CHANGES_FILE = "CHANGE_JOURNAL_POSITION"
+  # Files that this script adds to a backup, which aren't part of the source
+  _METADATA_FILES = (_LOG_FILE, _DONE_FILE, _MANIFEST_FILE, _REPORT_FILE,
+                     _METRICS_FILE, _JOURNAL_FILE, _CHANGES_FILE)
+  # First element of the "cmd" of the _RsyncJobs that the reflink engine
+  # runs in-process (see _copy_entry())
+  _REFLINK_CMD = "reflink"
+  # Empty file that _reflink_plan() tries to clone into
+  _REFLINK_PROBE = ".reflink_probe"
 
-  def __init__(self, src, dst, prev_backup=None, backup_order=["..."]):
+  def __init__(self, src, dst, prev_backup=None, backup_order=["..."],
+               dedup_index=None, shard_max_files=None, shard_max_bytes=None,
+               change_journal=None, throttle=None, file_classes=False,
+               engine="rsync", catalog=None):
     """
       Default constructor of Backup. A Backup will generate one or more rsync
       commands to backup the files in src, subject to the constraints of
@@ -53,18 +1679,67 @@ class Backup:
       prev_backup -- Directory where a previous backup has been stored. If a
           file in "src" is also in "prev_backup" and hasn't changed (i.e. they
           are checksum-equal) then a hard link will be created in "dst"
-          pointing to the copy in "prev_backup" to save space
+          pointing to the copy in "prev_backup" to save space. May also be a
+          list of up to 20 previous backups, most preferred first, in which
+          case unchanged files are linked to the first one that has them
           (Default value = None)
       backup_order -- List of files in "src" to be backed up, or "..." to back
           up all files not already mentioned. If "..." is not one of the
           elements of this list, files that are not listed will not be backed
-          up.
+          up. Entries may also be shell patterns, as in rsync's filter rules
+          (e.g. "*.kdb", "Documents/**/*.pdf"), which back up every matching
+          file or directory. An entry that names an existing file is never a
+          pattern, even if it has wildcard characters (see _literal_entry())
           (Default value = ["..."])
+      dedup_index -- Path of a content-hash index (see _dedup_files()). If
+          set, files that rsync copies are replaced with hardlinks to
+          identical files from earlier backups in the index (e.g. files that
+          were renamed or moved since the last backup)
+          (Default value = None)
+      shard_max_files, shard_max_bytes -- If either is set, directories in
+          "backup_order" with more files (or bytes) than this are split into
+          several rsync commands that are each below the limits (see
+          _plan_shards()), so that no single rsync process has to hold the
+          file list of a huge tree.
+          (Default value = None)
+      change_journal -- Path of the change journal written by backup_watch.py
+          for "src". If the journal holds every change made since
+          "prev_backup" was taken, the backup is built by hardlinking the
+          unchanged files from "prev_backup" and only the changed paths are
+          scanned and passed to rsync, instead of walking all of "src". If
+          not, the backup falls back to a full scan.
+          (Default value = None)
+      throttle -- a Throttle, which runs the rsync commands at a lower
+          priority and slows them down when the disks or CPUs are busy
+          (Default value = None)
+      file_classes -- if set, large files and VM images / databases in each
+          backup_order entry are copied by separate rsync commands, with
+          arguments tuned for them (see _FILE_CLASS_ARGS), right after the
+          entry's main command. Not used with "change_journal"
+          (Default value = False)
+      engine -- "rsync", or "reflink" to copy the files in-process instead
+          (see _copy_entry()): files that are unchanged since
+          `self.prev_backup` (according to its manifest) are cloned from it
+          with reflinks, which share its data blocks but not its inodes, and
+          other files are copied with copy_file_range(2). Falls back to rsync
+          if `self.dst` can't hold reflinks to `self.prev_backup` (e.g. it
+          isn't on btrfs or XFS), for dry runs, and when "change_journal" is
+          used
+          (Default value = "rsync")
+      catalog -- Path of a Catalog in the directory that holds "dst" (which
+          must be named after its date, as in FromBackupDrive()). Once the
+          backup is done, it's added to the catalog, with the itemized
+          changes of the files that rsync copied
+          (Default value = None)
     """
     src = abspath(src)
     dst = abspath(dst)
-    prev_backup = abspath(prev_backup) if prev_backup else None
-    # TODO fix shell pattern expansion
+    if not prev_backup:
+      prev_backups = []
+    elif isinstance(prev_backup, str):
+      prev_backups = [abspath(prev_backup)]
+    else:
+      prev_backups = [abspath(p) for p in prev_backup]
     clean_backup_order = []
     for i in range(len(backup_order)):
       f = backup_order[i]
@@ -73,6 +1748,13 @@ class Backup:
         assert i == (len(backup_order) - 1), \
             "\"...\" must be last in backup order"
         clean_backup_order.append(f)
+      elif _has_glob(_literal_entry(src, f)):
+        # Shell patterns are matched by rsync (see _OrderTrie)
+        f = _literal_entry(src, f)
+        assert exists(join(src, _glob_prefix(f))), \
+            "no file in {} can match {} in backup order".format(
+                join(src, _glob_prefix(f)), f)
+        clean_backup_order.append(f)
       else:
         f = normpath(f)
         assert exists(join(src, f)), \
@@ -81,8 +1763,12 @@ class Backup:
 
     # Validate & sanitize arguments
     assert isdir(src), "src({}) is not a dir".format(src)
-    assert prev_backup is None or isdir(prev_backup), \
-        "prev_backup ({}) is not a dir".format(prev_backup)
+    for p in prev_backups:
+      assert isdir(p), "prev_backup ({}) is not a dir".format(p)
+    assert len(prev_backups) <= _MAX_LINK_DESTS, \
+        "rsync accepts at most {} previous backups".format(_MAX_LINK_DESTS)
+    assert engine in ("rsync", "reflink"), \
+        "engine must be \"rsync\" or \"reflink\", not {}".format(engine)
     if not exists(dst):
       os.mkdir(dst)
     else:
@@ -93,14 +1779,29 @@ class Backup:
     # Assign instance vars
     self.src = src
     self.dst = dst
-    self.prev_backup = prev_backup
+    self.prev_backups = prev_backups
+    # The most preferred previous backup. Its manifest is used by _scan_src()
+    self.prev_backup = prev_backups[0] if prev_backups else None
     self.backup_order = clean_backup_order
+    self.dedup_index = abspath(dedup_index) if dedup_index else None
+    self.shard_max_files = shard_max_files
+    self.shard_max_bytes = shard_max_bytes
+    self.change_journal = abspath(change_journal) if change_journal else None
+    self.throttle = throttle
+    self.file_classes = file_classes
+    self.engine = engine
+    self.catalog = abspath(catalog) if catalog else None
 
   @staticmethod
-  def FromBackupDrive(src, drive, backup_order=["..."]):
+  def FromBackupDrive(src, drive, backup_order=["..."], dedup=False,
+                      catalog=False, **kwargs):
     """
       Initialize and return a Backup object from a directory containing
-      previous backups created by this script
+      previous backups created by this script. Up to 20 of the most recent
+      previous backups are used as link targets, preferring completed backups
+      (i.e. ones containing BACKUP_DONE), so that files restored to an older
+      version are still linked rather than copied (only the first one if
+      rsync has to checksum files, see _link_dests()).
 
       Keyword arguments:
       drive -- a global path to a directory where an external backup drive has
@@ -110,35 +1811,224 @@ class Backup:
           up all files not already mentioned. If "..." is not one of the
           elements of this list, files that are not listed will not be backed
           up.
+      dedup -- if set, deduplicate renamed and moved files against all backups
+          in "drive", using a content-hash index stored in "drive"
+      catalog -- if set, add the backup (and any earlier ones missing from it)
+          to the Catalog stored in "drive"
+
+      Any other keyword arguments are passed to the Backup constructor.
     """
     src = abspath(src)
     drive = abspath(drive)
     assert isdir(src), "src ({}) is not a dir".format(src)
     assert isdir(drive),  "drive ({}) is not a dir".format(drive)
 
-    # Scan previous backups and find the most recent
+    # Scan previous backups, most recent first. Completed backups come before
+    # incomplete ones (stable sort, so each group stays most-recent-first)
     today = datetime.combine(date.today(), time())  # Need plain date (for ==)
-    most_recent = None
+    snapshots = [path for t, path in Backup._list_snapshots(drive)
+                 if t != today]
+    snapshots.sort(key=lambda path: not exists(join(path, Backup._DONE_FILE)))
+    prev_backups = snapshots[:_MAX_LINK_DESTS]
+    if prev_backups:
+      print("Using {} as the previous backup dirs -- unchanged files will "
+            "point there".format(", ".join(prev_backups)))
+    dst = join(drive, datetime.today().strftime(Backup._DATE_FORMAT))
+    dedup_index = join(drive, Backup._DEDUP_INDEX_FILE) if dedup else None
+    catalog = join(drive, Backup._CATALOG_FILE) if catalog else None
+    return Backup(src=src, prev_backup=prev_backups, dst=dst,
+                  backup_order=backup_order, dedup_index=dedup_index,
+                  catalog=catalog, **kwargs)
+
+  @staticmethod
+  def _list_snapshots(drive):
+    """
+      Returns (date, path) for every backup directory in "drive" (i.e. every
+      directory named after a date in _DATE_FORMAT), most recent first
+    """
+    snapshots = []
     for d in os.listdir(drive):
-      if not isdir(d): continue
+      if not isdir(join(drive, d)): continue
       try:
         t = datetime.strptime(d.strip(), Backup._DATE_FORMAT)
-        if t == today: continue
-        if most_recent is None or t > most_recent:
-          most_recent = t
-      except:
+      except ValueError:
         # "d" is not a backup dir -- skip it
         continue
+      snapshots.append((t, join(drive, d)))
+    snapshots.sort(reverse=True)
+    return snapshots
 
-    # Convert most recent date from prev. backup directories back into dir name
-    most_recent_path = None
-    if most_recent:
-      print ("Using {} as the previous backup dir -- unchanged files will point "
-            + "there").format(most_recent)
-      most_recent_path = join(drive, most_recent.strftime(Backup._DATE_FORMAT))
-    dst = join(drive, datetime.today().strftime(Backup._DATE_FORMAT))
-    return Backup(src=src, prev_backup=most_recent_path, dst=dst,
-                  backup_order=backup_order)
+  @staticmethod
+  def Prune(drive, daily=7, weekly=4, monthly=12, dry_run=False, workers=16):
+    """
+      Deletes the backups in "drive" that a retention policy doesn't keep
+      (see _retained_snapshots()), and returns the paths of the deleted
+      backups, oldest first.
+
+      Files are hardlinked between backups, so deleting a backup never loses
+      the contents of a file that a remaining backup also holds. Each backup
+      is renamed before it's deleted (see _parallel_rmtree()), so that a
+      half-deleted backup is never mistaken for a real one. Leftovers of a
+      previous, interrupted prune are deleted too. If "drive" has a Catalog,
+      the deleted backups are marked as pruned in it.
+
+      Keyword arguments:
+      drive -- a directory containing backups created by this script
+      daily, weekly, monthly -- see _retained_snapshots()
+      dry_run -- if set, only return the backups that would be deleted
+      workers -- the number of threads used to delete each backup
+    """
+    drive = abspath(drive)
+    assert isdir(drive), "drive ({}) is not a dir".format(drive)
+    snapshots = Backup._list_snapshots(drive)
+    keep = _retained_snapshots(snapshots, daily, weekly, monthly)
+    doomed = [p for t, p in reversed(snapshots) if p not in keep]
+    if dry_run: return doomed
+    for p in doomed:
+      trash = join(drive, Backup._PRUNE_PREFIX + os.path.basename(p))
+      os.rename(p, trash)
+    for d in os.listdir(drive):
+      if d.startswith(Backup._PRUNE_PREFIX):
+        _parallel_rmtree(join(drive, d), workers)
+    if exists(join(drive, Backup._CATALOG_FILE)):
+      catalog = Catalog(join(drive, Backup._CATALOG_FILE))
+      try:
+        catalog.update(drive)
+      finally:
+        catalog.close()
+    return doomed
+
+  @staticmethod
+  def SpaceReport(drive, workers=16):
+    """
+      Works out how much space each backup in "drive" really uses, which du
+      can't tell because files are hardlinked between backups. Each file's
+      space is attributed according to which backups hold a link to it: it's
+      "exclusive" to a backup if no other backup links to it (so deleting the
+      backup would free it), and "shared" otherwise.
+
+      Backups are scanned with parallel scandir (see _snapshot_usage()), and
+      the scans of completed backups are cached in .space_cache in "drive",
+      so that after a new backup only the new directory is scanned.
+
+      Returns a dict: "backups" is a list with, for each backup (oldest
+      first), its "name", whether it's "complete", its number of "files",
+      "exclusive_bytes", "shared_bytes" and whether it was "cached";
+      "unique_bytes" is the total space used by all backups.
+    """
+    drive = abspath(drive)
+    assert isdir(drive), "drive ({}) is not a dir".format(drive)
+    cache_dir = join(drive, Backup._SPACE_CACHE_DIR)
+    snapshots = list(reversed(Backup._list_snapshots(drive)))
+    names = set(os.path.basename(p) for t, p in snapshots)
+    if isdir(cache_dir):
+      for f in os.listdir(cache_dir):
+        if f[:-len(".json.gz")] not in names:
+          os.remove(join(cache_dir, f))  # Backup was deleted
+
+    # (dev, ino) -> [bytes, number of backups linking to it, first backup]
+    owners = {}
+    backups = []
+    for i, (t, path) in enumerate(snapshots):
+      name = os.path.basename(path)
+      overhead, inodes, cached = _cached_snapshot_usage(
+          path, join(cache_dir, name + ".json.gz"), workers)
+      total = overhead
+      for key, (size, links) in inodes.items():
+        total += size
+        if key in owners:
+          owners[key][1] += 1
+        else:
+          owners[key] = [size, 1, i]
+      backups.append({
+        "name": name,
+        "complete": exists(join(path, Backup._DONE_FILE)),
+        "files": sum(links for size, links in inodes.values()),
+        "exclusive_bytes": overhead,
+        "shared_bytes": total - overhead,
+        "cached": cached,
+      })
+    unique = sum(b["exclusive_bytes"] for b in backups)
+    for size, count, i in owners.values():
+      unique += size
+      if count == 1:
+        backups[i]["exclusive_bytes"] += size
+        backups[i]["shared_bytes"] -= size
+    return {"backups": backups, "unique_bytes": unique}
+
+  @staticmethod
+  def Verify(src, dst, prev_backup=None, backup_order=["..."], workers=None):
+    """
+      Checks that the completed backup in "dst" matches "src", yielding
+      (path, problem) for each file that doesn't as soon as it's found.
+
+      Every file in "src" that "backup_order" covers must exist in "dst" with
+      the same size and content hash. Contents are hashed by a pool of
+      "workers" processes (default: one per CPU). The hash of a source file
+      is taken from the backup's manifest if the file's stat data hasn't
+      changed since. Files are skipped entirely when the backup holds the
+      same inode as "prev_backup" (i.e. rsync hardlinked it), and the source
+      file's inode and mtime match the previous backup's manifest: that data
+      was already hashed when the previous backup was taken.
+    """
+    src = abspath(src)
+    dst = abspath(dst)
+    manifest = _load_manifest(join(dst, Backup._MANIFEST_FILE)) or {}
+    prev = None
+    if prev_backup:
+      prev_backup = abspath(prev_backup)
+      prev = _load_manifest(join(prev_backup, Backup._MANIFEST_FILE))
+
+    backup_order = [f if f == "..." else _literal_entry(src, f)
+                    for f in backup_order]
+    trie = _OrderTrie(backup_order)
+    def to_check():
+      for root in _order_roots(backup_order):
+        for p, st in _walk_files(src, root):
+          if trie.globs and trie.owner(p) is None: continue
+          try:
+            dst_st = os.lstat(join(dst, p))
+          except OSError:
+            yield p, "missing from backup", None
+            continue
+          if not stat.S_ISREG(dst_st.st_mode) or dst_st.st_size != st.st_size:
+            yield p, "size or type differs", None
+            continue
+          old = prev.get(p) if prev else None
+          if old and (old.ino, old.mtime_ns) == (st.st_ino, st.st_mtime_ns):
+            try:
+              if os.lstat(join(prev_backup, p)).st_ino == dst_st.st_ino:
+                continue
+            except OSError:
+              pass
+          e = manifest.get(p)
+          if e and (e.size, e.mtime_ns, e.ctime_ns, e.ino) == \
+              (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino):
+            yield p, None, e.digest
+          else:
+            yield p, None, None
+
+    # Keep a bounded number of files in flight, so that problems are reported
+    # while the walk is still going, and memory doesn't grow with the tree
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      running = set()
+      for p, problem, digest in to_check():
+        if problem:
+          yield p, problem
+          continue
+        running.add(pool.submit(_verify_file, p, src, dst, digest))
+        if len(running) >= workers * 16:
+          done, running = wait(running, return_when=FIRST_COMPLETED)
+          for f in done:
+            if f.result()[1]: yield f.result()
+      for f in running:
+        if f.result()[1]: yield f.result()
+
+  def verify(self, workers=None):
+    """ Runs Verify() on this backup, once run_rsync_cmds() has finished """
+    return Backup.Verify(self.src, self.dst, self.prev_backup,
+                         self.backup_order, workers)
 
   def destination(self):
     return self.dst
@@ -151,58 +2041,1083 @@ class Backup:
 
       If `self.prev_backup` is unset, don't do any linking
     """
-    cmds = []
-    visited = []
-    for f in self.backup_order:
-      # Argument that apply to all backups (copy permissions, etc)
-      args = _fixed_rsync_args
-
-      # Define --exclude arguments
-      excluded_files = []
-      for v in visited:
-        if f == "...":
-          excluded_files = visited
-        elif v.startswith(f):
-          excluded_files.append(v) # Already backed up -- skip for now
-        elif f.startswith(v):
-          continue # Already backed up parent -- skip this
-        else:
-          pass # visited file has nothing to do with current backup
-      for ex in excluded_files:
-        args.append("--exclude={}".format(join(self.src, ex)))
+    classes = None
+    if self.file_classes:
+      classes = self._classify(
+          item for root in _order_roots(self.backup_order)
+          for item in _scan_files(self.src, root))
+    return [job.cmd for job in self._rsync_jobs(dry_run, classes=classes)]
+
+  def _classify(self, files):
+    """
+      Returns the "classes" argument of _rsync_jobs() for "files", a sequence
+      of (path, stat): a dict from backup_order entry to a dict from file
+      class to the paths of that class (the "default" class is left out)
+    """
+    classes = {}
+    trie = _OrderTrie(self.backup_order)
+    for p, st in files:
+      cls = _file_class(p, st)
+      entry = trie.entry_of(p)
+      if cls == "default" or entry is None: continue
+      classes.setdefault(entry, {}).setdefault(cls, []).append(p)
+    return classes
+
+  def _class_candidates(self, manifest):
+    """
+      Yields (path, stat) for the files in "manifest" that are big enough to
+      be outside the "default" file class, for _classify()
+    """
+    for p, e in manifest.items():
+      if e.size < min(_SPARSE_MIN_BYTES, _LARGE_FILE_BYTES): continue
+      try:
+        yield p, os.lstat(join(self.src, p))
+      except OSError:
+        continue  # Vanished -- rsync will report it
+
+  def _rsync_jobs(self, dry_run=False, forced=None, resume=False,
+                  classes=None):
+    """
+      Returns the _RsyncJobs for each entry in `self.backup_order`, in
+      priority order: usually one per entry, but see "forced" below and
+      `self.shard_max_files`. See rsync_cmds()
+
+      Keyword arguments:
+      forced -- None, in which case rsync compares files using --checksum.
+          Otherwise, files are compared by size and mtime (rsync's default),
+          and "forced" is a dict from backup_order entry to the files in that
+          entry which must be copied even though their size and mtime match
+          the previous backup (see _scan_src()). Those files are excluded from
+          the entry's command and copied by an extra command right after it.
+          (Default value = None)
+      resume -- if set, rsync appends to partially transferred files in
+          `self.dst` (--append-verify) instead of copying them again. See
+          _prepare_resume()
+          (Default value = False)
+      classes -- None, or a dict from backup_order entry to a dict from file
+          class to the files of that class in the entry (see _classify()).
+          The entry's main command copies the "default" class with its tuned
+          arguments, and excludes the others, which are copied by one command
+          per class. Some of the tuned arguments are left out when resuming
+          (see _file_class_args())
+          (Default value = None)
+    """
+    jobs = []
+    trie = _OrderTrie(self.backup_order)
+    # Directories that several commands may write into (see _shared_dirs())
+    self._implied_dirs = set()
+    for order, f in enumerate(self.backup_order):
+      if trie.covered(order): continue  # Backed up with an earlier entry
+      if f != "..." and not _has_glob(f):
+        _add_parent_dirs(self._implied_dirs, [f])
+
+      # Argument that apply to all backups (copy permissions, etc). Copied, so
+      # that per-command arguments don't leak into the next command
+      args = list(_fixed_rsync_args)
+      if forced is None: args.append(_checksum_rsync_arg)
+
+      # Filter rules that skip what earlier entries backed up, and for a
+      # shell pattern, everything it doesn't match. Rules starting with "/"
+      # are anchored at the root of the transfer, which (because of
+      # --relative below) is always `self.src`
+      excluded_files, excluded_patterns = trie.excluded(order)
+      rules = ["- /" + _escape_pattern(p) for p in excluded_files]
+      rules += ["- /" + p for p in excluded_patterns]
+      if _has_glob(f):
+        rules += _glob_filter_rules(f)
+        args.append("--prune-empty-dirs")
 
       # Create hardlinks to previous backup if file is unchanged
-      if self.prev_backup:
+      for d in self._link_dests(forced):
         args += [
-          "--link-dest={}".format(self.prev_backup)
+          "--link-dest={}".format(d)
         ]
       if dry_run: args += ["--dry-run"]
+      if resume: args += ["--append-verify"]
 
       # Define command
-      # Append a "/" to `self.src` (top-level copy), so rsync copies its
-      # contents instead of the directory itself
-      src = join(self.src, f) if f != "..." else self.src + "/"
-      cmd = ["rsync"] + args + [src, self.dst]
-      cmds.append(cmd)
-      visited.append(f)
-    return cmds
+      # --relative with a "/./" marker in the source path makes rsync recreate
+      # the part of the path after the marker under `self.dst`, so that
+      # "dir/file" is backed up to dst/dir/file rather than dst/file
+      root = join(self.src, ".") + "/"
+      src = root if f == "..." or _has_glob(f) else join(self.src, ".", f)
+      main_args = list(args)
+      forced_files = forced.get(f) if forced else None
+      excluded = list(forced_files or [])
+      if forced_files:
+        forced_list = self._plan_file("forced.{}".format(order))
+        _write_path_list(forced_list, forced_files)
+        _add_parent_dirs(self._implied_dirs, forced_files)
+      class_files = []
+      if classes is not None:
+        main_args += _file_class_args("default", resume)
+        skip = set(excluded)
+        for cls, paths in sorted(classes.get(f, {}).items()):
+          paths = [p for p in paths if p not in skip]
+          if paths: class_files.append((cls, paths))
+          excluded += paths
+      if excluded:
+        exclude_file = self._plan_file("exclude.{}".format(order))
+        _write_path_list(exclude_file, excluded, anchored=True)
+        main_args.append("--exclude-from={}".format(exclude_file))
+      if rules:
+        # A merge file keeps the command line short however many rules there
+        # are (rules are NUL-separated, see --from0)
+        filter_file = self._plan_file("filter.{}".format(order))
+        with open(filter_file, "wb") as ff:
+          ff.write(b"".join(os.fsencode(r) + b"\0" for r in rules))
+        main_args.append("--filter=merge {}".format(filter_file))
 
-  def run_rsync_cmds(self, dry_run=False, output_file=_LOG_FILE):
+      shards = None
+      if (self.shard_max_files or self.shard_max_bytes) and not _has_glob(f):
+        shards = _plan_shards(self.src, "" if f == "..." else f,
+                              set(excluded_files), self.shard_max_files,
+                              self.shard_max_bytes)
+      if shards:
+        # --files-from turns off the recursion implied by -a
+        for i, shard in enumerate(shards):
+          list_file = self._plan_file("shard.{}.{}".format(order, i))
+          _write_path_list(list_file, shard)
+          _add_parent_dirs(self._implied_dirs, shard)
+          digest = hashlib.sha1(b"\0".join(os.fsencode(p) for p in shard))
+          cmd = ["rsync", "--relative", "-r"] + main_args + [
+              "--files-from={}".format(list_file), root, self.dst]
+          jobs.append(_RsyncJob(
+              label="{} [shard {}]".format(f, digest.hexdigest()[:12]),
+              entry=f, order=order, cmd=cmd))
+      else:
+        cmd = ["rsync", "--relative"] + main_args + [src, self.dst]
+        jobs.append(_RsyncJob(label=f, entry=f, order=order, cmd=cmd))
+      for cls, paths in class_files:
+        list_file = self._plan_file("class.{}.{}".format(order, cls))
+        _write_path_list(list_file, paths)
+        _add_parent_dirs(self._implied_dirs, paths)
+        digest = hashlib.sha1(b"\0".join(os.fsencode(p) for p in paths))
+        cmd = ["rsync", "--relative"] + args + \
+            _file_class_args(cls, resume) + [
+                "--files-from={}".format(list_file), root, self.dst]
+        jobs.append(_RsyncJob(
+            label="{} [{} {}]".format(f, cls, digest.hexdigest()[:12]),
+            entry=f, order=order, cmd=cmd, file_class=cls))
+      if forced_files:
+        # Copy the forced files, skipping rsync's size+mtime check
+        cmd = ["rsync", "--relative"] + args + [
+            "--ignore-times", "--files-from={}".format(forced_list),
+            root, self.dst]
+        jobs.append(_RsyncJob(
+            label=f + " (forced)", entry=f, order=order, cmd=cmd))
+    return jobs
+
+  def _link_dests(self, forced):
+    """
+      The previous backups that rsync may link against. Without --checksum
+      (i.e. if "forced" isn't None), only previous backups with a manifest are
+      used, since _scan_src() can only catch rsync's quick check wrongly
+      matching a file in those. With --checksum, only the first one is used:
+      rsync would read a candidate file in every one of them to checksum it
+    """
+    if forced is None: return self.prev_backups[:1]
+    return [d for d in self.prev_backups
+            if exists(join(d, self._MANIFEST_FILE))]
+
+  def _plan_file(self, name):
+    """
+      Returns the path of a new file called "name" in a temporary directory
+      that holds the file lists passed to rsync. The directory is removed at
+      the end of run_rsync_cmds()
+    """
+    if getattr(self, "_plan_dir", None) is None:
+      self._plan_dir = tempfile.mkdtemp(prefix="rsync_backup.")
+    return join(self._plan_dir, name)
+
+  def _scan_src(self, changes=None):
+    """
+      Stats every regular file that `self.backup_order` backs up, and hashes
+      the ones whose size, mtime, ctime or inode differ from the manifest of
+      `self.prev_backup` (files whose stat data didn't change reuse the hash
+      from that manifest). Returns (manifest, forced), where "manifest" is the
+      manifest of this backup, and "forced" is None if the previous backup has
+      no manifest, or the "forced" argument of _rsync_jobs() otherwise:
+      files whose contents changed even though their size and mtime match the
+      copy in the first previous backup that rsync's quick check would pick,
+      which rsync would wrongly link.
+
+      If "changes" (see _read_changes()) is set, only the changed paths are
+      stat'ed, and every other file keeps its entry from the previous
+      backup's manifest.
+    """
+    prev = None
+    if self.prev_backup:
+      prev = _load_manifest(join(self.prev_backup, self._MANIFEST_FILE))
+    manifest = {}
+    to_hash = []
+    trie = _OrderTrie(self.backup_order)
+    roots = _order_roots(self.backup_order)
+    if changes is not None:
+      manifest = {p: e for p, e in prev.items() if not _under(p, changes)}
+      roots = _changed_roots(changes, self.backup_order)
+    for root in roots:
+      for p, st in _scan_files(self.src, root):
+        # Roots of shell patterns hold files that they don't match
+        if trie.globs and trie.owner(p) is None: continue
+        e = prev.get(p) if prev else None
+        if e and (e.size, e.mtime_ns, e.ctime_ns, e.ino) == \
+            (st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino):
+          manifest[p] = e
+        else:
+          to_hash.append((p, st))
+
+    def hash_one(item):
+      try:
+        return item, _hash_file(join(self.src, item[0]))
+      except OSError:
+        return item, None  # Vanished or unreadable -- rsync will report it
+    with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as pool:
+      for (p, st), digest in pool.map(hash_one, to_hash):
+        if digest is None: continue
+        manifest[p] = _ManifestEntry(
+            st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino, digest)
+    if prev is None:
+      return manifest, None
+
+    # Like rsync, find the first previous backup whose copy of each changed
+    # file passes the quick check (same size, and mtime to the second). Older
+    # manifests are streamed, as only the changed files need looking up
+    candidates = set(p for p, _ in to_hash if p in manifest)
+    forced = {}
+    for i, d in enumerate(self._link_dests(forced)):
+      if not candidates: break
+      if i == 0:
+        entries = [(p, prev[p]) for p in candidates if p in prev]
+      else:
+        entries = _iter_manifest(join(d, self._MANIFEST_FILE))
+      for p, old in entries:
+        e = manifest.get(p)
+        if p not in candidates or e.size != old.size or \
+            e.mtime_ns // 10**9 != old.mtime_ns // 10**9:
+          continue
+        candidates.discard(p)
+        if e.digest != old.digest:
+          forced.setdefault(trie.entry_of(p), []).append(p)
+    return manifest, forced
+
+  def _read_changes(self):
+    """
+      Reads `self.change_journal` (see _read_change_journal()) from the
+      position recorded in `self.prev_backup`. Returns (position, changes),
+      where "changes" is None unless it holds every path that changed since
+      `self.prev_backup` was taken: the previous backup must be complete,
+      have a manifest, and have been taken with the same backup_order
+    """
+    since = None
+    prev = self.prev_backup
+    if prev and exists(join(prev, self._DONE_FILE)) and \
+        exists(join(prev, self._MANIFEST_FILE)):
+      try:
+        with open(join(prev, self._CHANGES_FILE)) as f:
+          since = json.load(f)
+      except (IOError, OSError, ValueError):
+        pass
+    if since and since.get("backup_order") != self.backup_order:
+      since = None
+    # Changed paths are copied recursively, which shell patterns would need
+    # filtering (see _change_jobs())
+    if any(_has_glob(f) for f in self.backup_order):
+      since = None
+    return _read_change_journal(self.change_journal, self.src, since)
+
+  def _clone_prev(self, changes, workers=16):
+    """
+      Fills `self.dst` with hardlinks to the files in `self.prev_backup` that
+      `self.backup_order` covers and that aren't in "changes" (or in a changed
+      directory), recreating its directories. Together with rsync copying
+      the changed paths (see _change_jobs()), this gives the same backup as a
+      full run, without looking at the unchanged parts of `self.src`
+    """
+    trie = _OrderTrie(self.backup_order)
+    wanted = lambda p: trie.owner(p) is not None
+    prev = self.prev_backup
+    def clone_dir(d, entries):
+      rel = os.path.relpath(d, prev)
+      rel = "" if rel == "." else rel
+      if rel and (_under(rel, changes) or not trie.in_scope(rel)):
+        return False
+      if rel: os.makedirs(join(self.dst, rel), exist_ok=True)
+      for e in entries:
+        p = join(rel, e.name) if rel else e.name
+        if e.is_dir(follow_symlinks=False) or p in changes or not wanted(p) \
+            or (not rel and e.name in self._METADATA_FILES):
+          continue
+        try:
+          os.link(e.path, join(self.dst, p), follow_symlinks=False)
+        except OSError as err:
+          if err.errno != errno.EMLINK: raise
+          shutil.copy2(e.path, join(self.dst, p), follow_symlinks=False)
+    dirs = _parallel_walk(prev, clone_dir, workers)
+    # Adding entries changed the directories' mtimes, so copy them last.
+    # Directories with changed entries take their attributes from `self.src`
+    parents = set()
+    for c in changes:
+      while c:
+        c = os.path.dirname(c)
+        parents.add(c)
+    for _, d in sorted(dirs, reverse=True):
+      rel = os.path.relpath(d, prev)
+      if rel == "." or not isdir(join(self.dst, rel)): continue
+      if rel in parents and isdir(join(self.src, rel)): d = join(self.src, rel)
+      shutil.copystat(d, join(self.dst, rel), follow_symlinks=False)
+
+  def _change_jobs(self, changes, forced, dry_run=False):
+    """
+      Returns the _RsyncJobs that copy the paths in "changes" (see
+      _read_changes()) into a backup made by _clone_prev(): a single command
+      with the changed paths as its --files-from list, plus one for the
+      "forced" files (see _rsync_jobs()). Changed directories are copied
+      recursively
+    """
+    paths = [p for p in _changed_roots(changes, self.backup_order)
+             if os.path.lexists(join(self.src, p))]
+    if not paths: return []
+    args = list(_fixed_rsync_args)
+    for d in self._link_dests(forced):
+      args.append("--link-dest={}".format(d))
+    if dry_run: args.append("--dry-run")
+    root = join(self.src, ".") + "/"
+    forced_files = [p for files in forced.values() for p in files]
+    list_file = self._plan_file("changes")
+    _write_path_list(list_file, paths)
+    self._implied_dirs = set()
+    _add_parent_dirs(self._implied_dirs, paths + forced_files)
+    main_args = list(args)
+    if forced_files:
+      forced_list = self._plan_file("changes.forced")
+      _write_path_list(forced_list, forced_files)
+      _write_path_list(forced_list + ".exclude", forced_files, anchored=True)
+      main_args.append("--exclude-from={}.exclude".format(forced_list))
+    # --files-from turns off the recursion implied by -a
+    digest = hashlib.sha1(b"\0".join(os.fsencode(p) for p in paths))
+    jobs = [_RsyncJob(
+        label="... [changes {}]".format(digest.hexdigest()[:12]),
+        entry="...", order=0, cmd=["rsync", "--relative", "-r"] + main_args +
+        ["--files-from={}".format(list_file), root, self.dst])]
+    if forced_files:
+      jobs.append(_RsyncJob(
+          label="... [changes {}] (forced)".format(digest.hexdigest()[:12]),
+          entry="...", order=0, cmd=["rsync", "--relative"] + args + [
+              "--ignore-times", "--files-from={}".format(forced_list),
+              root, self.dst]))
+    return jobs
+
+  def _reflink_plan(self, manifest):
+    """
+      Returns the files in "manifest" that the reflink engine can clone from
+      `self.prev_backup`, as their contents haven't changed since it was
+      taken, or None if the engine can't be used: the previous backup has no
+      manifest, or `self.dst` can't hold reflinks to its files. Filesystems
+      only tell whether they support reflinks by refusing one, so one file
+      is cloned to find out
+    """
+    if not self.prev_backup: return set()
+    prev = _load_manifest(join(self.prev_backup, self._MANIFEST_FILE))
+    if prev is None: return None
+    clone = set(p for p, e in manifest.items()
+                if p in prev and prev[p].digest == e.digest)
+    probe = join(self.dst, self._REFLINK_PROBE)
+    for p in clone:
+      try:
+        f = open(join(self.prev_backup, p), "rb")
+      except OSError:
+        continue
+      with f:
+        fd = _create_file(probe)
+        try:
+          fcntl.ioctl(fd, _FICLONE, f.fileno())
+        except OSError:
+          return None
+        finally:
+          os.close(fd)
+          os.remove(probe)
+      break
+    return clone
+
+  def _reflink_jobs(self):
+    """
+      Returns one _RsyncJob per entry in `self.backup_order` for the reflink
+      engine, to be run by _copy_entry(). Their "cmd" is just the engine's
+      name, the directory that the entry's files are in, and `self.dst`
+    """
+    jobs = []
+    trie = _OrderTrie(self.backup_order)
+    for order, f in enumerate(self.backup_order):
+      if trie.covered(order): continue  # Backed up with an earlier entry
+      root = "" if f == "..." else _glob_prefix(f) if _has_glob(f) else f
+      jobs.append(_RsyncJob(
+          label="{} [{}]".format(f, self._REFLINK_CMD), entry=f, order=order,
+          cmd=[self._REFLINK_CMD, join(self.src, root), self.dst]))
+    return jobs
+
+  def _copy_entry(self, job, emit, workers=16):
+    """
+      Backs up the files of one backup_order entry (a job from
+      _reflink_jobs()) in-process: recreates its directories (for a shell
+      pattern, only those holding a copied file) and symlinks,
+      clones the files in `self._reflink_clone` (see _reflink_plan()) from
+      `self.prev_backup`, and copies the others from `self.src` (see
+      _copy_data()). Like rsync -a, owners, permissions and times are kept,
+      and special files are skipped. Each path is reported by calling
+      emit(line), with a line in rsync's --out-format (see _fixed_rsync_args)
+      whose itemized update is "cf" for a cloned file, so that _CommandStats
+      doesn't count it as transferred.
+
+      Directories take their attributes in _copy_dir_attrs(), once every
+      entry has been copied into them
+    """
+    trie = _OrderTrie(self.backup_order)
+    order = job.order
+    root = os.path.relpath(job.cmd[1], self.src)
+    root = "" if root == "." else root
+    # Directories that lead to a pattern's matches are walked, but (like in
+    # rsync, see _glob_filter_rules()) nothing else that it doesn't match.
+    # Only the directories that hold a copied file are created
+    leads = []
+    prune = _has_glob(job.entry)
+    if prune:
+      parts = job.entry.split("/")
+      leads = [_glob_regex("/".join(parts[:k])) for k in range(1, len(parts))]
+    lock = threading.Lock()
+    made = set()  # Directories created by this job
+
+    def add_dir(rel):
+      with lock:
+        self._reflink_dirs.add(rel)
+        while "/" in rel:
+          rel = os.path.dirname(rel)
+          self._reflink_dirs.add(rel)
+
+    def make_dir(rel):
+      os.makedirs(join(self.dst, rel), exist_ok=True)
+      new = []
+      with lock:
+        d = rel
+        while d and d not in made:
+          made.add(d)
+          new.append(d)
+          d = os.path.dirname(d)
+      if new: add_dir(rel)
+      for d in reversed(new):
+        if trie.owner(d) == order: emit("{}/ (0/0) cd+++++++++\n".format(d))
+
+    def copy(p, st):
+      src, dst = join(self.src, p), join(self.dst, p)
+      while self.throttle and self.throttle.paused: sleep(0.1)
+      if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(src)
+        try:
+          os.symlink(target, dst)
+        except FileExistsError:
+          _remove(dst)
+          os.symlink(target, dst)
+        _set_attrs(dst, st)
+        emit("{} (0/{}) cL+++++++++\n".format(p, st.st_size))
+        return
+      if not stat.S_ISREG(st.st_mode): return  # Devices etc. (see --no-D)
+      fd = _create_file(dst)
+      item = None
+      try:
+        if p in self._reflink_clone:
+          try:
+            with open(join(self.prev_backup, p), "rb") as f:
+              if os.fstat(f.fileno()).st_size == st.st_size:
+                fcntl.ioctl(fd, _FICLONE, f.fileno())
+                item, copied = "cf", 0
+          except OSError:
+            pass  # Copy it instead
+        if item is None:
+          item, copied = ">f", _copy_data(src, fd)
+      finally:
+        os.close(fd)
+      _set_attrs(dst, st)
+      if item == "cf":
+        with lock:
+          self._reflinked[0] += 1
+          self._reflinked[1] += st.st_size
+      emit("{} ({}/{}) {}+++++++++\n".format(p, copied, st.st_size, item))
+
+    def visit(d, entries):
+      rel = os.path.relpath(d, self.src)
+      rel = "" if rel == "." else rel
+      if rel:
+        o = trie.owner(rel)
+        if o is not None and o < order: return False  # An earlier entry's
+        if o != order and not any(rx.match(rel) for rx in leads):
+          return False
+        if not prune: make_dir(rel)
+      for e in entries:
+        if e.is_dir(follow_symlinks=False): continue
+        p = join(rel, e.name) if rel else e.name
+        if trie.owner(p) != order: continue
+        if prune and rel: make_dir(rel)
+        try:
+          copy(p, e.stat(follow_symlinks=False))
+        except FileNotFoundError:
+          # Vanished from `self.src` since it was listed, which rsync
+          # doesn't treat as an error either
+          if os.path.lexists(join(self.src, p)): raise
+          if os.path.lexists(join(self.dst, p)): _remove(join(self.dst, p))
+
+    if not isdir(job.cmd[1]) or os.path.islink(job.cmd[1]):
+      # An entry that is a single file
+      if os.path.dirname(root): make_dir(os.path.dirname(root))
+      copy(root, os.lstat(job.cmd[1]))
+      return
+    _parallel_walk(job.cmd[1], visit, workers)
+
+  def _shared_dirs(self, manifest):
+    """
+      Returns the directories of the backup that more than one of the
+      commands of _rsync_jobs() or _change_jobs() may write into: the
+      parents of backup_order entries, of shards and of the files listed
+      for a command, and the directories that lead to the files in
+      "manifest" that a shell pattern backs up
+    """
+    dirs = set(getattr(self, "_implied_dirs", ()))
+    if any(_has_glob(f) for f in self.backup_order):
+      trie = _OrderTrie(self.backup_order)
+      _add_parent_dirs(dirs, [p for p in manifest
+                              if _has_glob(trie.entry_of(p) or "")])
+    return dirs
+
+  def _copy_dir_attrs(self, dirs):
+    """
+      Gives the directories "dirs" of the backup the attributes of their
+      source directories, deepest first, as adding entries to a directory
+      changes its mtime
+    """
+    for rel in sorted(dirs, key=lambda d: d.count("/"), reverse=True):
+      try:
+        st = os.lstat(join(self.src, rel))
+      except FileNotFoundError:
+        continue  # Vanished since it was copied
+      _set_attrs(join(self.dst, rel), st)
+
+  def _progress_totals(self, manifest, changes, rsync_jobs):
+    """
+      Returns the "totals" argument of _Progress: the number and size of the
+      files in "manifest" that "rsync_jobs" will go through, by backup_order
+      entry. With a change journal (see _change_jobs()), that's only the
+      files under the changed paths
+    """
+    totals = collections.defaultdict(lambda: [0, 0])
+    entries = set(job.entry for job in rsync_jobs)
+    trie = _OrderTrie(self.backup_order)
+    changed = None
+    if changes is not None:
+      changed = set(_changed_roots(changes, self.backup_order))
+    for p, e in manifest.items():
+      if changed is not None:
+        if not _under(p, changed): continue
+        entry = "..."
+      else:
+        entry = trie.entry_of(p)
+      if entry not in entries: continue  # Already done (see "resume")
+      totals[entry][0] += 1
+      totals[entry][1] += e.size
+    return dict(totals)
+
+  def _prepare_resume(self, manifest, forced):
+    """
+      Makes `self.dst` safe to resume into with --append-verify, which skips
+      files that are at least as big in `self.dst` as in `self.src`, and
+      writes to the others in place. Deletes every file in `self.dst` that
+      doesn't match its source file's size and mtime (or that _scan_src()
+      forced a copy of), unless it's a partial copy made by this backup: a
+      file that is smaller than the source and not a hardlink (which would
+      be shared with an earlier backup)
+    """
+    forced_paths = set(p for paths in (forced or {}).values() for p in paths)
+    for p, e in manifest.items():
+      path = join(self.dst, p)
+      try:
+        st = os.lstat(path)
+      except OSError:
+        continue
+      if not stat.S_ISREG(st.st_mode): continue
+      if p not in forced_paths and st.st_size == e.size and \
+          st.st_mtime_ns // 10**9 == e.mtime_ns // 10**9:
+        continue  # Already backed up
+      if st.st_nlink == 1 and st.st_size < e.size and p not in forced_paths:
+        continue  # Partial copy -- append to it
+      os.remove(path)
+
+  def _read_journal(self):
+    """ Returns the labels of the commands recorded in the journal as done """
+    path = join(self.dst, self._JOURNAL_FILE)
+    if not exists(path): return set()
+    done = set()
+    with open(path) as f:
+      for line in f:
+        try:
+          done.add(json.loads(line))
+        except ValueError:
+          continue  # Torn write from an interrupted run
+    return done
+
+  def run_rsync_cmds(self, dry_run=False, output_file=_LOG_FILE, jobs=1,
+                     resume=False, progress=None):
     """
       Runs the commands returned by "rsync_cmd", piping the output to
       "rsync_backup.log"
+
+      Unlike rsync_cmds(), this first scans `self.src` (see _scan_src()), so
+      that if the previous backup has a manifest, only files whose stat data
+      changed are read, instead of rsync checksumming every file. The new
+      manifest is written to BACKUP_MANIFEST.gz next to BACKUP_DONE.
+
+      rsync's output is also parsed as it's produced, and per-command and
+      per-run statistics are written next to BACKUP_DONE, as JSON
+      (backup_report.json) and as OpenMetrics (backup_metrics.prom), except
+      on dry runs.
+
+      While the backup runs, each command that finishes is recorded in
+      BACKUP_JOURNAL in `self.dst`, which is removed once the backup is done.
+
+      If `self.change_journal` is set and covers everything since the
+      previous backup (see _read_changes()), only the changed paths are
+      scanned and copied, and the rest of the backup is hardlinked from the
+      previous one (see _clone_prev()). Resumed and dry runs always do a full
+      scan. The journal position is recorded next to BACKUP_DONE.
+
+      Keyword arguments:
+      jobs -- the maximum number of rsync commands to run at once. Commands are
+          started in "backup_order" priority order. BACKUP_DONE is only
+          written once every command has exited successfully.
+          (Default value = 1)
+      resume -- if set, continue an interrupted backup into `self.dst`:
+          commands recorded in its journal are skipped, and partially
+          transferred files are appended to rather than copied again.
+          (Default value = False)
+      progress -- a file (e.g. sys.stderr) to print live progress to while
+          rsync runs: bytes and files done out of the totals found by the
+          scan, throughput, and ETA (see _Progress)
+          (Default value = None)
     """
-    io_args = {}
+    assert jobs >= 1, "jobs ({}) must be at least 1".format(jobs)
+    start = monotonic()
+    finished = self._read_journal() if resume else set()
+    log = None
     if output_file:
-      io_args["stdout"] = open(join(self.dst, output_file), "w")
-      io_args["stderr"] = proc.STDOUT
-    for cmd in self.rsync_cmds(dry_run):
-      # We're logging -- append log command
-      if "stdout" in io_args:
-        io_args["stdout"].write(
-            "{0}\n{1}\n{0}\n".format("-"*80, "\n    ".join(cmd)))
-        io_args["stdout"].flush()
-      # Run rsync cmd
-      proc.call(cmd, **io_args)
+      log = open(join(self.dst, output_file), "a" if resume else "w")
+    journal = None
+    position = changes = None
+    extra_totals = {}
+    try:
+      if self.change_journal:
+        position, changes = self._read_changes()
+        if resume or dry_run: changes = None
+        extra_totals["change_journal_used"] = int(changes is not None)
+      manifest, forced = self._scan_src(changes)
+      self._reflink_clone = None
+      if self.engine == "reflink" and changes is None and not dry_run:
+        self._reflink_clone = self._reflink_plan(manifest)
+        extra_totals["reflink_engine_used"] = \
+            int(self._reflink_clone is not None)
+      if changes is not None:
+        extra_totals["changed_paths"] = len(changes)
+        self._clone_prev(changes)
+        rsync_jobs = self._change_jobs(changes, forced)
+      elif self._reflink_clone is not None:
+        self._reflink_dirs = set()
+        self._reflinked = [0, 0]  # files, bytes
+        rsync_jobs = [job for job in self._reflink_jobs()
+                      if job.label not in finished]
+      else:
+        classes = None
+        if self.file_classes:
+          classes = self._classify(self._class_candidates(manifest))
+        rsync_jobs = [job for job in
+                      self._rsync_jobs(dry_run, forced=forced, resume=resume,
+                                       classes=classes)
+                      if job.label not in finished]
+      scan_seconds = monotonic() - start
+      if progress:
+        self._progress = _Progress(
+            self._progress_totals(manifest, changes, rsync_jobs), progress)
+        self._progress.start()
+      if self.throttle: self.throttle.start([self.src, self.dst])
+      if not dry_run:
+        # The reflink engine replaces every file it writes (see
+        # _create_file()), so it can resume into anything
+        if resume and self._reflink_clone is None:
+          self._prepare_resume(manifest, forced)
+        journal = open(join(self.dst, self._JOURNAL_FILE), "a" if resume else "w")
+      if jobs == 1:
+        stats = []
+        for job in rsync_jobs:
+          stats.append(self._run_rsync_job(job, log))
+          self._record_done(journal, job)
+      else:
+        stats = self._run_rsync_jobs_concurrently(
+            rsync_jobs, log, jobs, journal)
+        if self._reflink_clone is None and not dry_run:
+          # A command may have added entries to a directory after another
+          # one set its mtime
+          self._copy_dir_attrs(self._shared_dirs(manifest))
+      if self._reflink_clone is not None:
+        self._copy_dir_attrs(self._reflink_dirs)
+        extra_totals["files_reflinked"] = self._reflinked[0]
+        extra_totals["bytes_reflinked"] = self._reflinked[1]
+    finally:
+      if self.throttle:
+        self.throttle.stop()
+        extra_totals["throttle_paused_seconds"] = self.throttle.paused_seconds
+      if getattr(self, "_progress", None):
+        self._progress.stop()
+        self._progress = None
+      if log: log.close()
+      if journal: journal.close()
+      if getattr(self, "_plan_dir", None):
+        shutil.rmtree(self._plan_dir, ignore_errors=True)
+        self._plan_dir = None
+    if self.dedup_index and not dry_run:
+      linked, saved = _dedup_files(self.dst, manifest, self.dedup_index)
+      extra_totals.update(
+          {"files_deduplicated": linked, "bytes_deduplicated": saved})
+    if not dry_run:
+      _save_manifest(join(self.dst, self._MANIFEST_FILE), manifest)
+    if position and not dry_run:
+      with open(join(self.dst, self._CHANGES_FILE), "w") as f:
+        json.dump(dict(position, backup_order=self.backup_order), f)
+    if not dry_run:
+      _write_report(join(self.dst, self._REPORT_FILE),
+                    join(self.dst, self._METRICS_FILE),
+                    stats, scan_seconds, monotonic() - start, extra_totals)
+    if journal: os.remove(join(self.dst, self._JOURNAL_FILE))
     # touch BACKUP_DONE
     with open(join(self.dst, self._DONE_FILE), "w") as donefile: pass
+    if self.catalog and not dry_run:
+      transfers = {}
+      for s in stats: transfers.update(s.transfers or {})
+      catalog = Catalog(self.catalog)
+      try:
+        catalog.update(os.path.dirname(self.dst), current=(
+            os.path.basename(self.dst), manifest, transfers))
+      finally:
+        catalog.close()
+
+  def _record_done(self, journal, job):
+    """ Records in "journal" (if set) that "job" finished successfully """
+    if not journal: return
+    journal.write(json.dumps(job.label) + "\n")
+    journal.flush()
+    os.fsync(journal.fileno())
+
+  def _run_rsync_job(self, job, log, log_lock=None):
+    """
+      Runs a single _RsyncJob, raising CalledProcessError if rsync fails.
+      rsync's output is read through a pipe, copied to "log" and parsed, and
+      the resulting _CommandStats is returned. rsync writes a line as it
+      finishes each file (see --outbuf in _fixed_rsync_args), so progress
+      is reported per file, not while a file is being copied.
+
+      If "log_lock" is set, other commands are writing to "log" at the same
+      time, so the command's output is collected in a temporary file and
+      written to "log" as a single section once the command exits.
+
+      Jobs of the reflink engine are run in-process by _copy_entry(), which
+      produces the same output
+    """
+    engine = job.cmd[0] == self._REFLINK_CMD
+    cmd = self.throttle.wrap(job.cmd) if self.throttle and not engine \
+        else job.cmd
+    header = "{0}\n{1}\n{0}\n".format("-"*80, "\n    ".join(cmd))
+    stats = _CommandStats(job.entry, job.cmd, getattr(self, "_progress", None))
+    stats.file_class = job.file_class
+    if self.catalog: stats.transfers = {}
+    section = None
+    if log and log_lock:
+      section = tempfile.TemporaryFile()
+    elif log:
+      # We're logging -- append log command
+      log.write(header)
+      log.flush()
+      section = log.buffer
+    output_lock = threading.Lock()
+    def emit(line):
+      if isinstance(line, str):
+        line = line.encode("utf-8", "surrogateescape")
+      with output_lock:
+        if section: section.write(line)
+        stats.feed(line)
+    stats.start = monotonic()
+    if engine:
+      self._copy_entry(job, emit)
+      retcode = 0
+    else:
+      # Run rsync cmd
+      p = proc.Popen(cmd, stdout=proc.PIPE, stderr=proc.STDOUT)
+      if self.throttle: self.throttle.register(p.pid)
+      try:
+        with p.stdout:
+          for line in p.stdout:
+            emit(line)
+        retcode = p.wait()
+      finally:
+        if self.throttle: self.throttle.unregister(p.pid)
+    stats.end = monotonic()
+    if log and log_lock:
+      with section, log_lock:
+        section.seek(0)
+        log.write(header)
+        log.flush()
+        shutil.copyfileobj(section, log.buffer)
+        log.buffer.flush()
+    elif log:
+      section.flush()
+    if retcode not in _RSYNC_OK_CODES:
+      raise proc.CalledProcessError(retcode, cmd)
+    return stats
+
+  def _run_rsync_jobs_concurrently(self, rsync_jobs, log, max_jobs,
+                                   journal=None):
+    """
+      Runs "rsync_jobs" on up to "max_jobs" threads, and returns their
+      _CommandStats. Jobs are started in order, without waiting for each
+      other: every path is backed up by exactly one entry (the first one in
+      backup_order that covers it, see _OrderTrie), and the commands of one
+      entry copy disjoint sets of files, so no two jobs copy the same file.
+      Jobs may still write into the same directories (see _shared_dirs()),
+      whose attributes the caller has to fix up afterwards. If any job
+      fails, no new jobs are started, and the first failure is re-raised
+      once the running jobs have exited. Finished jobs are recorded in
+      "journal" (see _record_done())
+    """
+    log_lock = threading.Lock()
+    pending = list(range(len(rsync_jobs)))
+    running = {}  # future -> index in rsync_jobs
+    stats = [None] * len(rsync_jobs)
+    error = None
+    with ThreadPoolExecutor(max_workers=max_jobs) as pool:
+      while running or (pending and error is None):
+        # Start jobs in priority order
+        while pending and error is None and len(running) < max_jobs:
+          j = pending.pop(0)
+          f = pool.submit(self._run_rsync_job, rsync_jobs[j], log, log_lock)
+          running[f] = j
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for f in done:
+          j = running.pop(f)
+          if f.exception() is not None:
+            error = error or f.exception()
+          else:
+            stats[j] = f.result()
+            self._record_done(journal, rsync_jobs[j])
+    if error is not None:
+      raise error
+    return stats
+
+class Restore:
+  """
+    Restores a backup taken by Backup, or some of the paths in it, into a
+    directory. Files are copied by several threads, in the priority order of
+    a backup_order (as in Backup, the files of its first entry come first),
+    so that the most needed files are back soonest. Files that are
+    hardlinked to each other within the restored paths are restored as
+    hardlinks again (links to files outside them, such as the links between
+    backups, are not). Owners, permissions and times are restored like rsync
+    -a would.
+  """
+
+  def __init__(self, snapshot, dst, backup_order=["..."], paths=None):
+    """
+      Keyword arguments:
+      snapshot -- the backup to restore (a directory written by Backup)
+      dst -- the directory to restore into (does not need to exist). Files
+          already in it are replaced
+      backup_order -- the order in which to restore files: a list of paths
+          and shell patterns (relative to "snapshot") and "...", as in
+          Backup. Unlike in Backup, files that it doesn't list are still
+          restored, last
+          (Default value = ["..."])
+      paths -- if set, only these files and directories (relative to
+          "snapshot") are restored
+          (Default value = None)
+    """
+    snapshot = abspath(snapshot)
+    dst = abspath(dst)
+    assert isdir(snapshot), "snapshot ({}) is not a dir".format(snapshot)
+    clean_backup_order = []
+    for i, f in enumerate(backup_order):
+      assert type(f) == str, "backup_order must be a list of strings"
+      if f == "...":
+        assert i == (len(backup_order) - 1), \
+            "\"...\" must be last in backup order"
+      clean_backup_order.append(
+          f if f == "..." else _literal_entry(snapshot, f))
+    clean_paths = None
+    if paths is not None:
+      clean_paths = []
+      for p in paths:
+        p = normpath(p)
+        assert not isabs(p) and not p.startswith(".."), \
+            "path {} to restore is outside the backup".format(p)
+        assert os.path.lexists(join(snapshot, p)), \
+            "path {} to restore is not in {}".format(p, snapshot)
+        clean_paths.append("" if p == "." else p)
+    if not exists(dst):
+      os.makedirs(dst)
+    assert isdir(dst), "dst exists and isn't dir: {}".format(dst)
+    assert not _covers(snapshot, dst) and not _covers(dst, snapshot), \
+        "dst ({}) and snapshot ({}) overlap".format(dst, snapshot)
+
+    self.snapshot = snapshot
+    self.dst = dst
+    self.backup_order = clean_backup_order
+    self.paths = clean_paths
+
+  @staticmethod
+  def FromBackupDrive(drive, dst, name=None, **kwargs):
+    """
+      Initialize and return a Restore of a backup in "drive" (see
+      Backup.FromBackupDrive()): the backup called "name" (e.g.
+      "30-Jan-2014"), or if it's None, the most recent completed backup.
+      Any other keyword arguments are passed to the Restore constructor.
+    """
+    drive = abspath(drive)
+    assert isdir(drive), "drive ({}) is not a dir".format(drive)
+    if name is None:
+      done = [p for t, p in Backup._list_snapshots(drive)
+              if exists(join(p, Backup._DONE_FILE))]
+      assert done, "no completed backup in {}".format(drive)
+      snapshot = done[0]
+    else:
+      snapshot = join(drive, name)
+      assert exists(join(snapshot, Backup._DONE_FILE)), \
+          "{} is not a completed backup".format(snapshot)
+    return Restore(snapshot, dst, **kwargs)
+
+  def _plan(self, workers=16):
+    """
+      Lists what to restore. Returns (dirs, items): the directories to
+      create (relative paths, with their stat), and the rest as (path, stat,
+      links) in priority order, where "links" are the other paths of a
+      hardlinked file, to be linked to it once it's restored. The files that
+      Backup adds to a backup (see Backup._METADATA_FILES) are left out
+    """
+    trie = _OrderTrie(self.backup_order)
+    roots = [""] if self.paths is None else _outermost(self.paths)
+    dirs = {}
+    found = []
+    lock = threading.Lock()
+    prefix = len(self.snapshot) + 1
+    def visit(d, entries):
+      rel = d[prefix:]
+      batch = []
+      for e in entries:
+        if e.is_dir(follow_symlinks=False): continue
+        if not rel and e.name in Backup._METADATA_FILES: continue
+        batch.append((e.path[prefix:], e.stat(follow_symlinks=False)))
+      with lock:
+        if rel: dirs[rel] = os.lstat(d)
+        found.extend(batch)
+    for root in roots:
+      # The directories leading to a restored path are recreated too
+      parent = os.path.dirname(root)
+      while parent:
+        dirs[parent] = os.lstat(join(self.snapshot, parent))
+        parent = os.path.dirname(parent)
+      path = join(self.snapshot, root) if root else self.snapshot
+      if os.path.islink(path) or not isdir(path):
+        found.append((root, os.lstat(path)))
+      else:
+        _parallel_walk(path, visit, workers)
+
+    last = len(self.backup_order)
+    def priority(item):
+      o = trie.owner(item[0])
+      return last if o is None else o
+    found.sort(key=priority)  # Stable, so each entry keeps walk order
+    items = []
+    groups = {}  # (dev, ino) -> the links of a hardlinked file
+    for p, st in found:
+      if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+        key = (st.st_dev, st.st_ino)
+        if key in groups:
+          groups[key].append(p)
+          continue
+        groups[key] = []
+        items.append((p, st, groups[key]))
+      elif stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+        items.append((p, st, []))
+    return sorted(dirs.items(), key=lambda d: d[0].count("/")), items
+
+  def run(self, workers=8):
+    """
+      Restores the backup. Directories are created first, then files and
+      symlinks are copied by "workers" threads, started in priority order,
+      and the directories' attributes are set last (adding entries changes
+      a directory's mtime). If any copy fails, no more are started and the
+      first error is re-raised. Returns a dict with the number of "files"
+      copied, "hardlinks" and "symlinks" created, "bytes" copied, and the
+      "wall_seconds" taken
+    """
+    assert workers >= 1, "workers ({}) must be at least 1".format(workers)
+    start = monotonic()
+    dirs, items = self._plan()
+    for rel, st in dirs:
+      path = join(self.dst, rel)
+      if os.path.lexists(path) and not isdir(path): _remove(path)
+      os.makedirs(path, exist_ok=True)
+    totals = {"files": 0, "hardlinks": 0, "symlinks": 0, "bytes": 0}
+    lock = threading.Lock()
+
+    def restore(p, st, links):
+      src, dst = join(self.snapshot, p), join(self.dst, p)
+      if stat.S_ISLNK(st.st_mode):
+        target = os.readlink(src)
+        try:
+          os.symlink(target, dst)
+        except FileExistsError:
+          _remove(dst)
+          os.symlink(target, dst)
+        _set_attrs(dst, st)
+        with lock: totals["symlinks"] += 1
+        return
+      fd = _create_file(dst)
+      try:
+        copied = _copy_data(src, fd)
+      finally:
+        os.close(fd)
+      _set_attrs(dst, st)
+      for q in links:
+        try:
+          os.link(dst, join(self.dst, q))
+        except FileExistsError:
+          _remove(join(self.dst, q))
+          os.link(dst, join(self.dst, q))
+      with lock:
+        totals["files"] += 1
+        totals["hardlinks"] += len(links)
+        totals["bytes"] += copied
+
+    # Only a few copies are queued at a time, so that they're started in
+    # priority order without holding a future for every file
+    errors = []
+    slots = threading.Semaphore(workers * 4)
+    def run_one(item):
+      try:
+        restore(*item)
+      except Exception as e:
+        with lock: errors.append(e)
+      finally:
+        slots.release()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      for item in items:
+        slots.acquire()
+        if errors: break
+        pool.submit(run_one, item)
+    if errors: raise errors[0]
+
+    for rel, st in reversed(dirs):
+      _set_attrs(join(self.dst, rel), st)
+    totals["wall_seconds"] = monotonic() - start
+    return totals
@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+from backup_lib import *
+import textwrap as tw
+
+# Keys of a job in the config file that are passed to Backup.FromBackupDrive
+# (with "backup_drive" as "drive"). A job may also have a "name", a
+# "priority" (lower runs first, default 0) and "jobs" (passed to
+# Backup.run_rsync_cmds). Jobs that share a backup_drive each keep their
+# backups in a directory of it named after the job
+_BACKUP_KEYS = ["src", "backup_drive", "backup_order", "dedup", "catalog",
+                "change_journal", "file_classes", "engine", "shard_max_files",
+                "shard_max_bytes"]
+
+# One backup run by the Scheduler. "backup_args" are the arguments of
+# Backup.FromBackupDrive, "devices" the disks that it reads and writes (see
+# _physical_device()), and "expected_seconds" how long its last completed run
+# took, or None if unknown
+_Job = collections.namedtuple(
+    "_Job", ["name", "priority", "backup_args", "rsync_jobs", "devices",
+             "expected_seconds"])
+
+def _physical_device(path):
+  """
+    The name of the disk that holds "path" (e.g. "sda" for a file on the
+    partition sda1), found through sysfs, so that partitions of one disk
+    share its concurrency limit. Falls back to the st_dev of "path" (as
+    "major:minor") where sysfs doesn't know the device
+  """
+  dev = os.stat(path).st_dev
+  name = "{}:{}".format(os.major(dev), os.minor(dev))
+  sys_path = join("/sys/dev/block", name)
+  if not exists(sys_path): return name
+  real = os.path.realpath(sys_path)
+  if exists(join(real, "partition")): real = os.path.dirname(real)
+  return os.path.basename(real)
+
+def _previous_seconds(drive):
+  """
+    The wall time of the most recent backup in "drive" that has a report
+    (see _write_report()), or None if there is none
+  """
+  for t, path in Backup._list_snapshots(drive):
+    try:
+      with open(join(path, Backup._REPORT_FILE)) as f:
+        return json.load(f)["totals"]["wall_seconds"]
+    except (IOError, OSError, ValueError, KeyError):
+      continue
+  return None
+
+class Scheduler:
+  """
+    Runs the backups of many source directories (each into its own backup
+    drive, see Backup.FromBackupDrive()), as many at once as the disks
+    allow: at most "per_device" backups read or write each physical disk at
+    a time, so that backups of independent disks overlap but backups
+    sharing a disk don't slow each other down.
+
+    Jobs are started by priority, and among jobs of equal priority, longest
+    first (by the wall time of their previous run, with jobs that never ran
+    counting as longest). Starting long jobs first keeps a short one from
+    being left to run alone at the end, so the whole run finishes sooner.
+    Whenever a backup finishes, the first job in that order whose disks
+    have room is started, even if a job before it is still waiting for its
+    disks.
+
+    A run holds an exclusive lock on "lock_file", so that runs (e.g. from
+    cron) never overlap.
+
+    Several jobs may back up to the same backup_drive. Each of them then
+    keeps its backups in its own directory of the drive, named after the job
+    (which needs an explicit "name" for that), so that their dated backups
+    don't collide.
+  """
+
+  def __init__(self, jobs, lock_file, per_device=1, max_jobs=None):
+    """
+      Keyword arguments:
+      jobs -- list of dicts, one per backup: see _BACKUP_KEYS
+      lock_file -- path of the file locked while the scheduler runs
+      per_device -- the maximum number of backups using a disk at once
+          (Default value = 1)
+      max_jobs -- the maximum number of backups running at once, or None for
+          no limit other than "per_device"
+          (Default value = None)
+    """
+    assert per_device >= 1, "per_device ({}) must be at least 1".format(
+        per_device)
+    assert max_jobs is None or max_jobs >= 1, \
+        "max_jobs ({}) must be at least 1".format(max_jobs)
+    self.lock_file = abspath(lock_file)
+    self.per_device = per_device
+    self.max_jobs = max_jobs
+    self.jobs = []
+    names = set()
+    drives = collections.Counter(abspath(spec["backup_drive"]) for spec in jobs
+                                 if "backup_drive" in spec)
+    for i, spec in enumerate(jobs):
+      for k in spec:
+        assert k in _BACKUP_KEYS + ["name", "priority", "jobs"], \
+            "unknown key {} in job {}".format(k, i)
+      assert "src" in spec and "backup_drive" in spec, \
+          "job {} must have a src and a backup_drive".format(i)
+      name = spec.get("name", spec["src"])
+      assert name not in names, "two jobs are called {}".format(name)
+      names.add(name)
+      src, drive = abspath(spec["src"]), abspath(spec["backup_drive"])
+      assert isdir(src), "src ({}) is not a dir".format(src)
+      assert isdir(drive), "backup_drive ({}) is not a dir".format(drive)
+      devices = sorted(set([_physical_device(src), _physical_device(drive)]))
+      if drives[drive] > 1:
+        assert name not in ["", ".", ".."] and "/" not in name, \
+            "job {} shares its backup_drive, so it needs a name that can " \
+            "be a directory name (not {})".format(i, name)
+        drive = join(drive, name)  # Created by _run_job()
+      backup_args = dict((k, v) for k, v in spec.items() if k in _BACKUP_KEYS)
+      backup_args.update(src=src, drive=drive)
+      del backup_args["backup_drive"]
+      self.jobs.append(_Job(
+          name=name, priority=spec.get("priority", 0),
+          backup_args=backup_args, rsync_jobs=spec.get("jobs", 1),
+          devices=devices,
+          expected_seconds=_previous_seconds(drive) if isdir(drive)
+                           else None))
+    self.jobs.sort(key=lambda j: (
+        j.priority, -(float("inf") if j.expected_seconds is None
+                      else j.expected_seconds)))
+
+  @staticmethod
+  def FromConfig(path):
+    """
+      Initialize and return a Scheduler from a JSON config file: an object
+      with the list of "jobs", and optionally "lock" (default: the config's
+      path + ".lock"), "per_device" and "max_jobs" (see the constructor)
+    """
+    with open(path) as f:
+      config = json.load(f)
+    return Scheduler(config["jobs"],
+                     config.get("lock", abspath(path) + ".lock"),
+                     per_device=config.get("per_device", 1),
+                     max_jobs=config.get("max_jobs"))
+
+  def _run_job(self, job):
+    """
+      Takes the backup of "job". Returns a dict saying whether it's "ok",
+      its "error" if not, its destination ("dst"), whether it was "skipped"
+      because today's backup in its drive is already complete, and
+      "wall_seconds"
+    """
+    start = monotonic()
+    result = {"ok": False, "error": None, "dst": None, "skipped": False}
+    dst = join(job.backup_args["drive"],
+               datetime.today().strftime(Backup._DATE_FORMAT))
+    if exists(join(dst, Backup._DONE_FILE)):
+      result.update(ok=True, dst=dst, skipped=True, wall_seconds=0)
+      return result
+    try:
+      if not isdir(job.backup_args["drive"]):
+        os.mkdir(job.backup_args["drive"])
+      backup = Backup.FromBackupDrive(**job.backup_args)
+      result["dst"] = backup.destination()
+      backup.run_rsync_cmds(jobs=job.rsync_jobs)
+      result["ok"] = True
+    except Exception as e:
+      result["error"] = "{}: {}".format(type(e).__name__, e)
+    result["wall_seconds"] = monotonic() - start
+    return result
+
+  def run(self):
+    """
+      Runs every job (see the class comment), and returns an OrderedDict
+      from job name to the result of the job (see _run_job()), in the order
+      they finished. A failed job doesn't stop the others. Raises
+      AssertionError if another run holds the lock
+    """
+    lock = os.open(self.lock_file, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        raise AssertionError(
+            "another scheduler run holds {}".format(self.lock_file))
+      results = collections.OrderedDict()
+      pending = list(self.jobs)
+      running = {}  # future -> job
+      busy = collections.Counter()  # device -> number of running jobs
+      with ThreadPoolExecutor(max_workers=self.max_jobs or
+                              max(1, len(self.jobs))) as pool:
+        while pending or running:
+          for job in list(pending):
+            if self.max_jobs and len(running) >= self.max_jobs: break
+            if any(busy[d] >= self.per_device for d in job.devices): continue
+            pending.remove(job)
+            busy.update(job.devices)
+            running[pool.submit(self._run_job, job)] = job
+          done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+          for f in done:
+            job = running.pop(f)
+            busy.subtract(job.devices)
+            results[job.name] = f.result()
+      return results
+    finally:
+      os.close(lock)
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+      description="Run the backups listed in a config file, overlapping "
+                  "backups of independent disks.",
+      epilog=tw.dedent("""\
+      Example config (JSON):
+          {
+            "per_device": 1,
+            "jobs": [
+              {"name": "home", "src": "/home", "backup_drive": "/mnt/b/home",
+               "priority": 0, "backup_order": ["mjs/Documents", "..."],
+               "dedup": true},
+              {"name": "srv", "src": "/srv", "backup_drive": "/mnt/b/srv",
+               "priority": 1, "engine": "reflink", "jobs": 4}
+            ]
+          }
+
+      Jobs sharing a backup_drive need a "name", and keep their backups in
+      that directory of the drive (e.g. /mnt/b/home/docs/30-Jan-2014).
+
+      Run it from cron as often as you like: a run exits at once if the
+      previous one is still going, and backups already completed today are
+      skipped.
+      """) + "\nJobs may set any of: {}.\n".format(
+          ", ".join(_BACKUP_KEYS + ["name", "priority", "jobs"])),
+      formatter_class=argparse.RawTextHelpFormatter)
+  arg_parser.add_argument('--config', type=str, required=True,
+      help="The config file listing the backups to run")
+  arg_parser.add_argument('--plan', action='store_true',
+      help="Only print the order in which jobs would start, and their disks")
+  args = arg_parser.parse_args()
+
+  scheduler = Scheduler.FromConfig(args.config)
+  if args.plan:
+    for job in scheduler.jobs:
+      print("{:20} priority {:3} {:>10} {}".format(
+          job.name, job.priority,
+          "?" if job.expected_seconds is None
+          else "{:.0f}s".format(job.expected_seconds),
+          ",".join(job.devices)))
+    return
+  failed = 0
+  for name, result in scheduler.run().items():
+    if result["skipped"]:
+      print("\033[1;33mSKIPPED\033[0m {}: already backed up today".format(name))
+    elif result["ok"]:
+      print("\033[1;32mDONE\033[0m {} ({:.0f}s)".format(
+          name, result["wall_seconds"]))
+    else:
+      print("\033[1;31mFAILED\033[0m {}: {}".format(name, result["error"]))
+      failed += 1
+  if failed: raise SystemExit(1)
+
+if __name__ == "__main__":
+  main()
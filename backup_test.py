@@ -2,10 +2,20 @@
 import unittest
 
 from backup_lib import *
+from backup_lib import _CommandStats, _ManifestEntry, _OrderTrie, _Progress, \
+    _disk_util, _escape_pattern, _order_roots, _read_change_journal, \
+    _save_manifest, _scan_files, _walk_files
 
+from datetime import datetime, timedelta
+import io
+import json
 import os
-from os.path import isdir, isfile, join, exists
+from os.path import abspath, isdir, isfile, join, exists
 import subprocess as proc
+import sys
+import threading
+import types
+from time import sleep
 
 def put(output_file, lines):
   """
@@ -23,6 +33,10 @@ class TestBackup(unittest.TestCase):
   """
   _test_files = ["regular_file", "~chars file", ".hidden file", "-flag file"]
   _test_dirs = ["regular_dir", "~chars dir", ".hidden dir", "-flag dir" ]
+  # Files that a completed backup adds to its destination directory
+  _backup_files = [
+      "rsync_backup.log", Backup._DONE_FILE, Backup._MANIFEST_FILE,
+      Backup._REPORT_FILE, Backup._METRICS_FILE]
 
   def setUp(self):
     # Create tmp dir for the test to take place in
@@ -89,7 +103,7 @@ class TestBackup(unittest.TestCase):
     b.run_rsync_cmds()
     # Inspect output
     self.assertBackupSame("source dir", "backup dir",
-      extra_files = ["rsync_backup.log", Backup._DONE_FILE])
+      extra_files = self._backup_files)
 
   def test_new_backup_to_drive(self):
     """
@@ -103,7 +117,7 @@ class TestBackup(unittest.TestCase):
     for d in os.listdir("."):
       if d != "source dir": backup_dir = d
     self.assertBackupSame("source dir", backup_dir,
-      extra_files = ["rsync_backup.log", Backup._DONE_FILE])
+      extra_files = self._backup_files)
 
   def test_existing_backup(self):
     """
@@ -138,12 +152,772 @@ class TestBackup(unittest.TestCase):
 
     # Check contents of backup directory
     self.assertBackupSame("source dir", backup_dir,
-      extra_files = ["rsync_backup.log", Backup._DONE_FILE])
+      extra_files = self._backup_files)
     # Make sure rsync linked files whose contents didn't change from source to
     # old_dest (by comparing inode numbers)
     self.assertEqual(
         os.stat(join(backup_dir, "same contents")).st_ino,
         os.stat("30-Jan-2000/same contents").st_ino)
+    # Make sure the report counted the linked and copied files
+    with open(join(backup_dir, Backup._REPORT_FILE)) as f:
+      totals = json.load(f)["totals"]
+    self.assertEqual(totals["files_seen"], 3)
+    self.assertEqual(totals["files_transferred"], 2)
+    self.assertEqual(totals["files_hardlinked"], 1)
+
+  def test_multiple_link_dests(self):
+    """
+      FromBackupDrive should link against several previous backups, trying
+      completed ones first, so that a file reverted to an older version is
+      linked to the older backup instead of copied. Without manifests, rsync
+      checksums files, and only links against the first one.
+    """
+    os.mkdir("source dir")
+    for d, contents, t in [("30-Jan-2000", "v1", 1e9),
+                           ("31-Jan-2000", "v2", 2e9),
+                           ("01-Feb-2000", "v2", 2e9)]:
+      os.mkdir(d)
+      put(join(d, "reverted"), [contents + "\n"] * 3)
+      os.utime(join(d, "reverted"), (t, t))
+    put("30-Jan-2000/" + Backup._DONE_FILE, [])
+    put("31-Jan-2000/" + Backup._DONE_FILE, [])
+    put("02-Feb-2000", ["not a backup\n"])
+    put("source dir/reverted", ["v1\n"] * 3)
+    os.utime("source dir/reverted", (1e9, 1e9))
+
+    b = Backup.FromBackupDrive(src="source dir", drive=".")
+    self.assertEqual(b.prev_backups, [
+        abspath("31-Jan-2000"), abspath("30-Jan-2000"), abspath("01-Feb-2000")])
+    self.assertEqual(b._link_dests(None), [abspath("31-Jan-2000")])
+    for d in b.prev_backups:
+      _save_manifest(join(d, Backup._MANIFEST_FILE), {})
+    self.assertEqual(b._link_dests({}), b.prev_backups)
+    b.run_rsync_cmds()
+    self.assertBackupSame("source dir", b.destination(),
+      extra_files = self._backup_files)
+    self.assertEqual(
+        os.stat(join(b.destination(), "reverted")).st_ino,
+        os.stat("30-Jan-2000/reverted").st_ino)
+
+  def test_dedup_moved_file(self):
+    """
+      With dedup enabled, a file that was moved since the last backup should
+      be linked to its copy in the last backup instead of copied.
+    """
+    os.mkdir("source dir")
+    put("source dir/big file", ["BIG\n"] * 1000)
+    Backup(src="source dir", dst="30-Jan-2000",
+           dedup_index=Backup._DEDUP_INDEX_FILE).run_rsync_cmds()
+
+    os.mkdir("source dir/new dir")
+    os.rename("source dir/big file", "source dir/new dir/big file")
+    b = Backup.FromBackupDrive(src="source dir", drive=".", dedup=True)
+    b.run_rsync_cmds()
+    self.assertBackupSame("source dir", b.destination(),
+      extra_files = self._backup_files)
+    self.assertEqual(
+        os.stat(join(b.destination(), "new dir/big file")).st_ino,
+        os.stat("30-Jan-2000/big file").st_ino)
+
+  def test_resume_backup(self):
+    """
+      Simulates an interrupted backup: the journal says the first entry in
+      backup_order is done, and a large file was only partially copied.
+      Resuming should skip the first entry and finish the large file.
+    """
+    self.createDefaultSourceDir("source dir")
+    put("source dir/large file", ["large file data\n"] * 10000)
+    os.mkdir("backup dir")
+    put(join("backup dir", Backup._JOURNAL_FILE),
+        [json.dumps(self._test_dirs[0]) + "\n"])
+    put("backup dir/large file", ["large file data\n"] * 100)
+
+    b = Backup(src="source dir", dst="backup dir",
+               backup_order=[self._test_dirs[0], "..."])
+    b.run_rsync_cmds(resume=True)
+    self.assertFalse(exists(join("backup dir", self._test_dirs[0])))
+    self.assertFalse(exists(join("backup dir", Backup._JOURNAL_FILE)))
+    self.assertTrue(exists(join("backup dir", Backup._DONE_FILE)))
+    self.assertBackupSame("source dir/large file", "backup dir/large file")
+    for f in self._test_files:
+      self.assertBackupSame(join("source dir", f), join("backup dir", f))
+
+  def test_plan_shards(self):
+    """
+      Every file should be in exactly one shard, and shards should respect
+      the size limits
+    """
+    from backup_lib import _plan_shards
+    self.createDefaultSourceDir("source dir")
+    shards = _plan_shards("source dir", "", set([self._test_dirs[1]]),
+                          max_entries=4)
+    self.assertTrue(all(0 < len(shard) <= 4 for shard in shards))
+    covered = []
+    for shard in shards:
+      for p in shard:
+        if isdir(join("source dir", p)):
+          covered += [join(p, f) for f in os.listdir(join("source dir", p))]
+        else:
+          covered.append(p)
+    expected = [f for f in self._test_files] + [
+        join(d, f) for d in self._test_dirs if d != self._test_dirs[1]
+                   for f in self._test_files]
+    self.assertEqual(sorted(covered), sorted(expected))
+    self.assertIsNone(_plan_shards("source dir", "", set(), max_entries=100))
+
+  def test_sharded_backup(self):
+    """ Runs a backup whose "..." entry is split into many small shards """
+    self.createDefaultSourceDir("source dir")
+    b = Backup(src="source dir", dst="backup dir",
+               backup_order=[self._test_dirs[0], "..."], shard_max_files=3)
+    self.assertGreater(len(b.rsync_cmds()), 4)
+    b.run_rsync_cmds(jobs=4)
+    self.assertBackupSame("source dir", "backup dir",
+      extra_files = self._backup_files)
+
+  def test_bench_tree_is_reproducible(self):
+    """
+      The benchmark's synthetic trees must be identical for the same spec, so
+      that results can be compared with a stored baseline
+    """
+    import backup_bench
+    spec = backup_bench.TreeSpec(small_files=50, small_file_size=100,
+                                 huge_files=1, huge_file_size=3 << 20,
+                                 depth=2, fanout=3, seed=7)
+    files = backup_bench.generate_tree("tree 1", spec)
+    self.assertEqual(backup_bench.generate_tree("tree 2", spec), files)
+    for p in files:
+      with open(join("tree 1", p), "rb") as f1, \
+          open(join("tree 2", p), "rb") as f2:
+        self.assertEqual(f1.read(), f2.read(), p)
+    self.assertEqual(os.path.getsize(join("tree 1", "huge00")), 3 << 20)
+    files = backup_bench.mutate_tree("tree 1", files, 0.1)
+    self.assertEqual(
+        sorted(p for p, _ in _walk_files("tree 1")), sorted(files))
+
+  def test_scan_files(self):
+    """ The parallel scan must find the same files as _walk_files() """
+    self.createDefaultSourceDir("src")
+    os.symlink("regular_file", "src/symlink")
+    for rel in ["", "regular_dir", "regular_file", "missing"]:
+      self.assertEqual(
+          sorted((p, st.st_ino) for p, st in _scan_files("src", rel, 4)),
+          sorted((p, st.st_ino) for p, st in _walk_files("src", rel)))
+
+  def test_progress(self):
+    """
+      Feeds rsync output lines to _CommandStats with a _Progress attached,
+      and checks the totals, throughput and ETA that it reports
+    """
+    out = io.StringIO()
+    progress = _Progress({"docs": (3, 3000), "...": (1, 7000)}, out,
+                         window=10.0)
+    self.assertEqual(progress.status(now=100.0)["eta_seconds"], None)
+    stats = _CommandStats("docs", ["rsync"], progress)
+    stats.feed(b"docs/a (1000/1000) >f+++++++++\n")
+    stats.feed(b"docs/b (0/1000) hf\n")
+    stats.feed(b"docs/ (0/0) cd+++++++++\n")
+    st = progress.status(now=102.0)
+    self.assertEqual(
+        (st["files_done"], st["files_total"], st["bytes_done"],
+         st["bytes_total"]), (2, 4, 2000, 10000))
+    self.assertEqual(st["bytes_per_second"], 1000.0)
+    self.assertEqual(st["transferred_bytes_per_second"], 500.0)
+    self.assertEqual(st["eta_seconds"], 8.0)
+    self.assertIn("2/4 files", progress.line(now=104.0))
+    progress.stop()
+    self.assertTrue(out.getvalue().endswith("\n"))
+
+  @unittest.skipUnless(sys.platform.startswith("linux"), "needs /proc")
+  def test_throttle(self):
+    """
+      Checks how Throttle wraps rsync commands, and adapts --bwlimit and
+      pauses running commands as the disk utilisation and load change
+    """
+    t = Throttle(max_bwlimit=8000, min_bwlimit=2000, max_disk_util=50.0,
+                 max_load=2.0)
+    self.assertEqual(t.wrap(["rsync", "-a", "src/", "dst"]), [
+        "nice", "-n", "10", "ionice", "-c", "2", "-n", "7",
+        "rsync", "-a", "--bwlimit=8000", "src/", "dst"])
+    p = proc.Popen(["sleep", "30"])
+    try:
+      t.register(p.pid)
+      def state(expected):
+        # Signals are delivered asynchronously
+        for _ in range(100):
+          with open("/proc/{}/stat".format(p.pid)) as f:
+            st = f.read().split()[2]
+          if st == expected: break
+          sleep(0.01)
+        return st
+      t.adjust(util=90.0, load=None, now=0.0)
+      self.assertEqual((t.bwlimit, t.paused), (4000, False))
+      t.adjust(util=10.0, load=3.0, now=1.0)
+      self.assertEqual((t.bwlimit, t.paused), (2000, False))
+      t.adjust(util=90.0, load=3.0, now=2.0)
+      self.assertEqual((t.bwlimit, t.paused), (2000, True))
+      self.assertEqual(state("T"), "T")
+      t.adjust(util=10.0, load=0.5, now=5.0)
+      self.assertEqual((t.bwlimit, t.paused, t.paused_seconds),
+                       (2000, False, 3.0))
+      self.assertEqual(state("S"), "S")
+      t.adjust(util=None, load=None, now=6.0)
+      self.assertEqual(t.bwlimit, 2800)
+      t.unregister(p.pid)
+    finally:
+      p.kill()
+      p.wait()
+    # Utilisation is that of the busiest disk, not the sum over disks
+    self.assertEqual(_disk_util({(8, 0): 0, (8, 16): 100},
+                                {(8, 0): 600, (8, 16): 900}, 1.0), 80.0)
+    self.assertIsNone(_disk_util(None, {(8, 0): 600}, 1.0))
+
+  def test_file_classes(self):
+    """
+      With file_classes, large and sparse files should be copied by their own
+      tuned rsync commands, which the entry's main command excludes
+    """
+    self.createDefaultSourceDir("src")
+    with open("src/regular_dir/disk.qcow2", "wb") as f:
+      f.truncate(4 << 20)  # Sparse
+    big = types.SimpleNamespace(st_size=2 << 30, st_blocks=(2 << 30) // 512)
+    b = Backup(src="src", dst="dst", backup_order=["regular_dir", "..."],
+               file_classes=True)
+    self.assertEqual(
+        b._classify([("huge file", big), ("regular_dir/f.db", big)] +
+                    list(b._class_candidates(b._scan_src()[0]))),
+        {"...": {"large": ["huge file"]},
+         "regular_dir": {"sparse": ["regular_dir/f.db",
+                                    "regular_dir/disk.qcow2"]}})
+
+    jobs = b._rsync_jobs(classes=b._classify(b._class_candidates(
+        b._scan_src()[0])))
+    self.assertEqual([(j.entry, j.file_class) for j in jobs], [
+        ("regular_dir", "default"), ("regular_dir", "sparse"),
+        ("...", "default")])
+    main, sparse = jobs[0].cmd, jobs[1].cmd
+    self.assertIn("--whole-file", main)
+    exclude = [a for a in main if a.startswith("--exclude-from=")]
+    with open(exclude[0].split("=", 1)[1], "rb") as f:
+      self.assertEqual(f.read(), b"/regular_dir/disk.qcow2\0")
+    self.assertIn("--sparse", sparse)
+    self.assertEqual(len(b.rsync_cmds()), 3)
+    # Files that may be hardlinks into earlier backups are never --inplace,
+    # and rsync refuses --whole-file with --append-verify
+    jobs = b._rsync_jobs(resume=True, classes={"...": {"large": ["x"]}})
+    self.assertEqual(jobs[-1].file_class, "large")
+    self.assertNotIn("--inplace", jobs[-1].cmd)
+    for job in jobs:
+      self.assertIn("--append-verify", job.cmd)
+      self.assertNotIn("--whole-file", job.cmd)
+
+  def test_resume_file_classes(self):
+    """
+      Resuming a backup with file_classes should finish a partially copied
+      file of a tuned class
+    """
+    self.createDefaultSourceDir("src")
+    with open("src/disk.qcow2", "wb") as f:
+      f.seek(4 << 20)
+      f.write(b"end of disk\n")
+    os.mkdir("dst")
+    with open("dst/disk.qcow2", "wb") as f:
+      f.write(b"\0" * 4096)
+    b = Backup(src="src", dst="dst", file_classes=True)
+    b.run_rsync_cmds(resume=True)
+    self.assertBackupSame("src", "dst", extra_files=self._backup_files)
+
+  def test_reflink_engine(self):
+    """
+      The reflink engine should build a first backup without rsync, keeping
+      symlinks, permissions, mtimes and backup_order
+    """
+    self.createDefaultSourceDir("src")
+    os.symlink("regular_dir/regular_file", "src/link")
+    os.chmod("src/regular_dir/regular_file", 0o640)
+    os.utime("src/regular_dir/regular_file", (1e9, 1e9))
+    os.utime("src/regular_dir", (1e9, 1e9))
+    b = Backup(src="src", dst="backup 1", backup_order=["regular_dir", "..."],
+               engine="reflink")
+    b.run_rsync_cmds(jobs=2)
+    self.assertBackupSame("src", "backup 1", extra_files=self._backup_files)
+    self.assertEqual(os.readlink("backup 1/link"), "regular_dir/regular_file")
+    st = os.stat("backup 1/regular_dir/regular_file")
+    self.assertEqual((stat.S_IMODE(st.st_mode), st.st_mtime), (0o640, 1e9))
+    self.assertEqual(os.stat("backup 1/regular_dir").st_mtime, 1e9)
+    with open(join("backup 1", Backup._REPORT_FILE)) as f:
+      report = json.load(f)
+    self.assertEqual([c["entry"] for c in report["commands"]],
+                     ["regular_dir", "..."])
+    self.assertEqual(report["totals"]["reflink_engine_used"], 1)
+    self.assertEqual(report["totals"]["files_transferred"], 20)
+    self.assertEqual(report["totals"]["files_reflinked"], 0)
+
+  def test_reflink_engine_clone(self):
+    """
+      The reflink engine should clone the unchanged files of the next backup
+      from the previous one
+    """
+    self.createDefaultSourceDir("src")
+    Backup(src="src", dst="backup 1", engine="reflink").run_rsync_cmds()
+    put("src/regular_file", ["changed\n"])
+    b = Backup(src="src", dst="backup 2", prev_backup="backup 1",
+               engine="reflink")
+    if b._reflink_plan(b._scan_src()[0]) is None:
+      self.skipTest("filesystem can't reflink")
+    b.run_rsync_cmds()
+    self.assertBackupSame("src", "backup 2", extra_files=self._backup_files)
+    with open(join("backup 2", Backup._REPORT_FILE)) as f:
+      totals = json.load(f)["totals"]
+    self.assertEqual((totals["files_transferred"], totals["files_reflinked"]),
+                     (1, 19))
+    # Clones share data blocks, not inodes
+    self.assertEqual(os.stat("backup 2/regular_dir/regular_file").st_nlink, 1)
+
+  def test_reflink_engine_pattern(self):
+    """
+      The reflink engine should only create the directories that lead to the
+      files matched by a shell pattern in backup_order, like rsync
+      --prune-empty-dirs
+    """
+    for d in ["src/a/empty", "src/a/b", "src/c"]:
+      os.makedirs(d)
+    put("src/a/b/pw.kdb", ["secret\n"])
+    put("src/c/notes", ["notes\n"])
+    Backup(src="src", dst="dst", backup_order=["**/*.kdb"],
+           engine="reflink").run_rsync_cmds(jobs=2)
+    self.assertEqual(sorted(os.listdir("dst")),
+                     sorted(["a"] + self._backup_files))
+    self.assertEqual(os.listdir("dst/a"), ["b"])
+    self.assertEqual(os.listdir("dst/a/b"), ["pw.kdb"])
+
+  def test_backup_order_compiler(self):
+    """
+      Checks which entry backs up each path, and the rsync commands and
+      filter rules compiled from a backup_order with nested entries and a
+      shell pattern
+    """
+    os.makedirs("src/docs/a/b")
+    put("src/pw.kdb", ["secret\n"])
+    order = ["docs/a", "docs", "*.kdb", "docs/a/b", "..."]
+    trie = _OrderTrie(order)
+    for path, entry in [("docs/a/x", "docs/a"), ("docs/a/b/y", "docs/a"),
+                        ("docs/y", "docs"), ("docs/z.kdb", "docs"),
+                        ("pw.kdb", "*.kdb"), ("docs a", "..."),
+                        ("other/x", "...")]:
+      self.assertEqual(trie.entry_of(path), entry, path)
+    self.assertIsNone(_OrderTrie(["docs/a", "*.kdb"]).entry_of("docs/y"))
+    self.assertEqual(_order_roots(["docs/a", "docs", "notes/*.txt"]),
+                     ["docs", "notes"])
+
+    b = Backup(src="src", dst="dst", backup_order=order)
+    jobs = b._rsync_jobs(forced={})
+    # "docs/a/b" was already backed up with "docs/a"
+    self.assertEqual([j.entry for j in jobs],
+                     ["docs/a", "docs", "*.kdb", "..."])
+    def rules(job):
+      merge = [a for a in job.cmd if a.startswith("--filter=merge ")]
+      if not merge: return []
+      with open(merge[0].split(" ", 1)[1], "rb") as f:
+        return f.read().decode().split("\0")[:-1]
+    self.assertEqual([rules(j) for j in jobs], [
+        [], ["- /docs/a"],
+        ["- /docs", "+ /*.kdb", "+ /*.kdb/**", "- *"],
+        ["- /docs", "- /*.kdb"]])
+    self.assertEqual(jobs[2].cmd[-2], join(abspath("src"), ".") + "/")
+    # Leading directories without matches aren't recreated
+    self.assertEqual([j.label for j in jobs if "--prune-empty-dirs" in j.cmd],
+                     ["*.kdb"])
+    # Only files that the pattern matches are scanned
+    self.assertEqual(sorted(Backup(src="src", dst="dst",
+        backup_order=["*.kdb"])._scan_src()[0]), ["pw.kdb"])
+    # Existing files whose names have wildcard characters aren't patterns
+    for d in ["Photos [2014]", "Photos 2"]:
+      os.mkdir(join("src", d))
+    put("src/Photos [2014]/a.jpg", ["jpg\n"])
+    put("src/Photos 2/b.jpg", ["jpg\n"])
+    b = Backup(src="src", dst="dst", backup_order=["Photos [2014]"],
+               engine="reflink")
+    self.assertEqual(b.backup_order, ["Photos \\[2014]"])
+    self.assertEqual(sorted(b._scan_src()[0]), ["Photos [2014]/a.jpg"])
+    b.run_rsync_cmds()
+    self.assertTrue(isfile("dst/Photos [2014]/a.jpg"))
+    self.assertFalse(exists("dst/Photos 2"))
+    # rsync reads backslashes literally in rules without wildcards
+    self.assertEqual(_escape_pattern("a\\b"), "a\\b")
+    self.assertEqual(_escape_pattern("a\\b?"), "a\\\\b\\?")
+
+  def test_prune(self):
+    """
+      Creates fake daily backups for two months and prunes them with a
+      retention policy
+    """
+    start = datetime(2000, 1, 1)
+    for i in range(60):
+      d = (start + timedelta(days=i)).strftime(Backup._DATE_FORMAT)
+      self.createDefaultSourceDir(d)
+      # The last two backups didn't finish
+      if i < 58: put(join(d, Backup._DONE_FILE), [])
+    # Read-only directories (which rsync preserves) must be deleted too
+    os.chmod(join("01-Jan-2000", self._test_dirs[0]), 0o555)
+    # Incomplete backups older than the newest complete one are pruned
+    os.remove(join("10-Feb-2000", Backup._DONE_FILE))
+
+    doomed = Backup.Prune(".", daily=3, weekly=2, monthly=2, dry_run=True)
+    self.assertEqual(len(doomed), 60 - 7)
+    self.assertEqual(os.path.basename(doomed[0]), "01-Jan-2000")
+    Backup.Prune(".", daily=3, weekly=2, monthly=2, workers=4)
+    self.assertEqual(sorted(os.listdir("."), key=lambda d:
+        datetime.strptime(d, Backup._DATE_FORMAT)), [
+        # Newest of January (the newest month is covered by the daily ones)
+        "31-Jan-2000",
+        # Newest of the 2nd newest week (the newest is covered too)
+        "20-Feb-2000",
+        # Daily
+        "25-Feb-2000", "26-Feb-2000", "27-Feb-2000",
+        # Incomplete, but newer than the newest complete backup
+        "28-Feb-2000", "29-Feb-2000"])
+
+  def test_space_report(self):
+    """
+      Builds two fake backups that share a hardlinked file, and checks that
+      each backup's space is split into exclusive and shared bytes
+    """
+    for d in ["30-Jan-2000", "31-Jan-2000"]:
+      os.mkdir(d)
+      put(join(d, Backup._DONE_FILE), [])
+    put("30-Jan-2000/old only", ["x" * 999 + "\n"] * 20)
+    put("30-Jan-2000/shared", ["y" * 999 + "\n"] * 30)
+    os.link("30-Jan-2000/shared", "31-Jan-2000/shared")
+    os.mkdir("31-Jan-2000/dir")
+    put("31-Jan-2000/dir/new only", ["z" * 999 + "\n"] * 40)
+    os.link("31-Jan-2000/dir/new only", "31-Jan-2000/dir/link")
+    usage = lambda f: os.lstat(f).st_blocks * 512
+
+    report = Backup.SpaceReport(".", workers=2)
+    old, new = report["backups"]
+    self.assertEqual((old["name"], old["cached"]), ("30-Jan-2000", False))
+    self.assertEqual(new["files"], 4)
+    self.assertEqual(old["shared_bytes"], usage("30-Jan-2000/shared"))
+    self.assertEqual(new["shared_bytes"], usage("30-Jan-2000/shared"))
+    self.assertEqual(old["exclusive_bytes"], sum(usage(f) for f in [
+        "30-Jan-2000", "30-Jan-2000/old only",
+        join("30-Jan-2000", Backup._DONE_FILE)]))
+    self.assertEqual(new["exclusive_bytes"], sum(usage(f) for f in [
+        "31-Jan-2000", "31-Jan-2000/dir", "31-Jan-2000/dir/new only",
+        join("31-Jan-2000", Backup._DONE_FILE)]))
+    self.assertEqual(report["unique_bytes"],
+        old["exclusive_bytes"] + new["exclusive_bytes"] +
+        usage("30-Jan-2000/shared"))
+
+    # A second report should come from the cache, and give the same figures
+    cached = Backup.SpaceReport(".", workers=2)
+    self.assertTrue(all(b["cached"] for b in cached["backups"]))
+    for b in cached["backups"]: b["cached"] = False
+    self.assertEqual(cached, report)
+
+  def test_catalog(self):
+    """
+      Builds fake backups from manifests, and checks the catalog's answers
+      about versions, backups holding a file, and changes. A real backup
+      (with the reflink engine, which needs no rsync for a first backup)
+      should also record rsync-style itemized changes
+    """
+    entry = lambda digest: _ManifestEntry(2, 0, 0, 0, digest)
+    manifests = [
+        ("01-Jan-2020", {"a": entry("1"), "b": entry("2")}),
+        ("02-Jan-2020", {"a": entry("1"), "b": entry("3"), "c": entry("4")}),
+        ("03-Jan-2020", {}),  # Incomplete
+        ("04-Jan-2020", {"a": entry("1"), "c": entry("4")})]
+    os.mkdir("drive")
+    for name, manifest in manifests:
+      os.mkdir(join("drive", name))
+      _save_manifest(join("drive", name, Backup._MANIFEST_FILE), manifest)
+      if manifest: put(join("drive", name, Backup._DONE_FILE), [])
+    catalog = Catalog(join("drive", Backup._CATALOG_FILE))
+    self.assertEqual(catalog.update("drive"),
+                     ["01-Jan-2020", "02-Jan-2020", "04-Jan-2020"])
+    self.assertEqual(
+        [(v["digest"], v["first"], v["last"]) for v in catalog.versions("b")],
+        [("2", "01-Jan-2020", "01-Jan-2020"),
+         ("3", "02-Jan-2020", "02-Jan-2020")])
+    self.assertEqual(catalog.snapshots(digest="4"),
+                     [("02-Jan-2020", "c"), ("04-Jan-2020", "c")])
+    self.assertEqual(
+        catalog.changes(datetime(2020, 1, 1).date(),
+                        datetime(2020, 1, 4).date()),
+        [("02-Jan-2020", "b", "modified"), ("02-Jan-2020", "c", "added"),
+         ("04-Jan-2020", "b", "deleted")])
+    # Pruned backups are left out
+    proc.check_call(["rm", "-r", "drive/01-Jan-2020"])
+    self.assertEqual(catalog.update("drive"), [])
+    self.assertEqual([s for s, _ in catalog.snapshots(path="a")],
+                     ["02-Jan-2020", "04-Jan-2020"])
+    catalog.close()
+
+    os.mkdir("src")
+    put("src/file", ["data\n"])
+    os.mkdir("drive2")
+    b = Backup.FromBackupDrive(src="src", drive="drive2", catalog=True,
+                               engine="reflink")
+    b.run_rsync_cmds()
+    catalog = Catalog(join("drive2", Backup._CATALOG_FILE))
+    [v] = catalog.versions("file")
+    self.assertEqual((v["first"], v["item"], v["bytes_transferred"]),
+                     (os.path.basename(b.dst), ">f+++++++++", 5))
+    catalog.close()
+
+  def test_restore(self):
+    """
+      Builds a fake backup, and restores it: files should come back in
+      backup_order priority, with hardlinks within the backup kept, and only
+      the requested paths if any
+    """
+    self.createDefaultSourceDir("01-Jan-2020")
+    os.link("01-Jan-2020/regular_file", "01-Jan-2020/regular_dir/linked")
+    os.link("01-Jan-2020/~chars file", "outside link")
+    os.symlink("regular_file", "01-Jan-2020/link")
+    os.chmod("01-Jan-2020/regular_dir", 0o750)
+    put(join("01-Jan-2020", Backup._LOG_FILE), [])
+    put(join("01-Jan-2020", Backup._DONE_FILE), [])
+
+    r = Restore.FromBackupDrive(".", "restored",
+                                backup_order=["regular_dir", "*file", "..."])
+    self.assertEqual(r.snapshot, abspath("01-Jan-2020"))
+    dirs, items = r._plan()
+    order = [p for p, _, _ in items]
+    # "regular_file" is restored as a link to "regular_dir/linked", which
+    # comes first
+    self.assertTrue(all(p.startswith("regular_dir/") for p in order[:5]))
+    self.assertEqual(set(order[5:8]),
+                     set(["~chars file", ".hidden file", "-flag file"]))
+    self.assertEqual(
+        [links for p, _, links in items if p == "regular_dir/linked"],
+        [["regular_file"]])
+    totals = r.run(workers=3)
+    self.assertEqual((totals["files"], totals["hardlinks"], totals["symlinks"]),
+                     (20, 1, 1))
+    os.remove(join("01-Jan-2020", Backup._LOG_FILE))  # Not restored
+    os.remove(join("01-Jan-2020", Backup._DONE_FILE))
+    self.assertBackupSame("01-Jan-2020", "restored")
+    self.assertEqual(os.stat("restored/regular_file").st_ino,
+                     os.stat("restored/regular_dir/linked").st_ino)
+    self.assertEqual(os.stat("restored/~chars file").st_nlink, 1)
+    self.assertEqual(os.readlink("restored/link"), "regular_file")
+    self.assertEqual(stat.S_IMODE(os.stat("restored/regular_dir").st_mode),
+                     0o750)
+
+    r = Restore("01-Jan-2020", "subset", paths=["~chars dir/regular_file",
+                                                "regular_dir"])
+    r.run()
+    self.assertEqual(sorted(os.listdir("subset")), ["regular_dir", "~chars dir"])
+    self.assertEqual(os.listdir("subset/~chars dir"), ["regular_file"])
+    self.assertEqual(len(os.listdir("subset/regular_dir")), 5)
+
+  def test_scheduler(self):
+    """
+      The scheduler should order jobs by priority, then longest previous run
+      first, run them all (with the reflink engine, first backups need no
+      rsync), skip them when run again the same day, and refuse to run while
+      another run holds the lock
+    """
+    import backup_schedule
+    for name in ["a", "b", "c"]:
+      os.mkdir("src " + name)
+      put(join("src " + name, "file"), [name + "\n"])
+      os.mkdir("drive " + name)
+    # "c" took longer than "b" last time. Its previous backup has an (empty)
+    # manifest, so the reflink engine can be used
+    old = join("drive c", "01-Jan-2000")
+    os.mkdir(old)
+    with open(join(old, Backup._REPORT_FILE), "w") as f:
+      json.dump({"totals": {"wall_seconds": 100.0}}, f)
+    _save_manifest(join(old, Backup._MANIFEST_FILE), {})
+    put(join(old, Backup._DONE_FILE), [])
+    jobs = [{"name": n, "src": "src " + n, "backup_drive": "drive " + n,
+             "engine": "reflink"} for n in ["a", "b", "c"]]
+    jobs[0]["priority"] = 1
+    with open("config.json", "w") as f:
+      json.dump({"jobs": jobs, "per_device": 2}, f)
+
+    scheduler = backup_schedule.Scheduler.FromConfig("config.json")
+    self.assertEqual([j.name for j in scheduler.jobs], ["b", "c", "a"])
+    self.assertEqual(len(scheduler.jobs[0].devices), 1)  # All on one disk
+    results = scheduler.run()
+    self.assertEqual(sorted(results), ["a", "b", "c"])
+    for name, result in results.items():
+      self.assertTrue(result["ok"], result["error"])
+      self.assertTrue(exists(join(result["dst"], Backup._DONE_FILE)))
+      self.assertFalse(result["skipped"])
+    # Running again the same day skips the completed backups
+    for name, result in scheduler.run().items():
+      self.assertTrue(result["ok"], result["error"])
+      self.assertTrue(result["skipped"])
+
+    lock = os.open("config.json.lock", os.O_WRONLY)
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      self.assertRaises(AssertionError, scheduler.run)
+    finally:
+      os.close(lock)
+
+  def test_scheduler_shared_drive(self):
+    """
+      Jobs sharing a backup drive should each back up into their own
+      directory of it, and need a name for it
+    """
+    import backup_schedule
+    os.mkdir("drive")
+    for name in ["a", "b"]:
+      os.mkdir("src " + name)
+      put(join("src " + name, name), [name + "\n"])
+    jobs = [{"src": abspath("src " + n), "backup_drive": "drive",
+             "engine": "reflink"} for n in ["a", "b"]]
+    # The default names (the paths of the sources) can't be directory names
+    self.assertRaises(AssertionError, backup_schedule.Scheduler, jobs, "lock")
+    for job in jobs:
+      job["name"] = job["src"][-1]
+    results = backup_schedule.Scheduler(jobs, "lock", per_device=2).run()
+    for name in ["a", "b"]:
+      self.assertTrue(results[name]["ok"], results[name]["error"])
+      self.assertFalse(results[name]["skipped"])
+      self.assertEqual(os.path.dirname(results[name]["dst"]),
+                       abspath(join("drive", name)))
+      self.assertTrue(isfile(join(results[name]["dst"], name)))
+
+  def test_verify(self):
+    """
+      Builds a fake backup by copying the source dir, and checks that Verify()
+      reports exactly the files that were damaged or lost
+    """
+    self.createDefaultSourceDir("src")
+    shutil.copytree("src", "dst")
+    self.assertEqual(list(Backup.Verify("src", "dst", workers=2)), [])
+    put("dst/regular_dir/regular_file", ["regular_dir/regular_file DATA\n"] * 3)
+    put("dst/-flag file", ["short\n"])
+    os.remove("dst/.hidden dir/~chars file")
+    self.assertEqual(sorted(Backup.Verify("src", "dst", workers=2)), [
+        ("-flag file", "size or type differs"),
+        (".hidden dir/~chars file", "missing from backup"),
+        ("regular_dir/regular_file", "contents differ")])
+    # Only the files in backup_order are checked
+    self.assertEqual(list(Backup.Verify("src", "dst",
+        backup_order=["~chars dir", "regular_file"], workers=2)), [])
+
+  def test_verify_cli(self):
+    """
+      Checks that backup.py --verify on a completed backup only verifies it,
+      and exits non-zero if the backup doesn't match the source
+    """
+    self.createDefaultSourceDir("src")
+    backup_py = [sys.executable, join(self.start_dir, "backup.py"),
+                 "--src=src", "--dst=dst", "--engine=reflink"]
+    proc.check_output(backup_py)
+    out = proc.check_output(backup_py + ["--verify"]).decode()
+    self.assertIn("VERIFIED", out)
+    self.assertNotIn("DONE!", out)
+    put("dst/regular_dir/regular_file", ["regular_dir/regular_file DATA\n"] * 3)
+    with self.assertRaises(proc.CalledProcessError) as e:
+      proc.check_output(backup_py + ["--verify"])
+    self.assertIn("MISMATCH regular_dir/regular_file: contents differ",
+                  e.exception.output.decode().replace("\033[1;31m", "")
+                  .replace("\033[0m", ""))
+
+  def watch(self, src, journal):
+    """
+      Starts a backup_watch.Watcher for "src" in a thread, waits until it's
+      watching, and returns a function that stops it
+    """
+    import backup_watch
+    stop = threading.Event()
+    t = threading.Thread(target=backup_watch.Watcher(src, journal).run,
+                         args=(stop, 0.05))
+    t.start()
+    for _ in range(100):
+      if _read_change_journal(journal, abspath(src))[0]: break
+      stop.wait(0.05)
+    def stop_watching():
+      stop.set()
+      t.join()
+    return stop_watching
+
+  def changes_since(self, journal, src, position, expected):
+    """
+      Waits for the journal to record the "expected" changes since
+      "position", and returns all the changes recorded
+    """
+    for _ in range(100):
+      changes = _read_change_journal(journal, abspath(src), position)[1]
+      if changes is None or expected <= changes: break
+      sleep(0.05)
+    return changes
+
+  @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+  def test_change_journal(self):
+    """
+      Runs the watcher while changing the source dir, and checks the paths
+      that it journals, and that the journal is only trusted while the same
+      watcher is running
+    """
+    self.createDefaultSourceDir("src")
+    stop_watching = self.watch("src", "changes")
+    try:
+      position, changes = _read_change_journal("changes", abspath("src"))
+      self.assertEqual((position["offset"] > 0, changes), (True, None))
+      put("src/regular_dir/regular_file", ["changed\n"])
+      os.remove("src/-flag file")
+      os.rename("src/~chars dir", "src/moved dir")
+      os.mkdir("src/new dir")
+      put("src/new dir/new file", ["new\n"])
+      expected = set(["regular_dir/regular_file", "-flag file", "~chars dir",
+                      "moved dir", "new dir"])
+      changes = self.changes_since("changes", "src", position, expected)
+      # The new file may be created before "new dir" is watched, but it's
+      # backed up with "new dir" either way
+      self.assertEqual(changes - set(["new dir/new file"]), expected)
+      # A journal for another directory is ignored
+      self.assertEqual(_read_change_journal("changes", abspath("regular_dir")),
+                       (None, None))
+    finally:
+      stop_watching()
+    # Changes made from now on won't be journaled
+    self.assertIsNone(
+        _read_change_journal("changes", abspath("src"), position)[1])
+
+  @unittest.skipUnless(sys.platform.startswith("linux"), "needs inotify")
+  def test_change_journal_backup(self):
+    """
+      Takes a backup with a change journal, changes the source dir, and checks
+      that the next backup only copies the journaled changes and hardlinks
+      the rest from the previous backup
+    """
+    self.createDefaultSourceDir("source dir")
+    stop_watching = self.watch("source dir", "changes")
+    try:
+      b = Backup(src="source dir", dst="30-Jan-2000", change_journal="changes")
+      b.run_rsync_cmds()
+      put("source dir/regular_dir/regular_file", ["changed\n"])
+      os.remove("source dir/-flag file")
+      os.mkdir("source dir/new dir")
+      put("source dir/new dir/new file", ["new\n"])
+      with open(join("30-Jan-2000", Backup._CHANGES_FILE)) as f:
+        self.changes_since("changes", "source dir", json.load(f),
+                           set(["regular_dir/regular_file", "new dir"]))
+      b = Backup.FromBackupDrive(src="source dir", drive=".",
+                                 change_journal="changes")
+      b.run_rsync_cmds()
+    finally:
+      stop_watching()
+    self.assertBackupSame("source dir", b.destination(),
+      extra_files = self._backup_files + [Backup._CHANGES_FILE])
+    with open(join(b.destination(), Backup._REPORT_FILE)) as f:
+      totals = json.load(f)["totals"]
+    self.assertEqual(totals["change_journal_used"], 1)
+    self.assertEqual(totals["files_transferred"], 2)
+    self.assertEqual(
+        os.stat(join(b.destination(), "~chars dir/regular_file")).st_ino,
+        os.stat("30-Jan-2000/~chars dir/regular_file").st_ino)
+    self.assertEqual(list(b.verify(workers=2)), [])
 
   def test_ordered_backup(self):
     """
@@ -163,7 +937,7 @@ class TestBackup(unittest.TestCase):
     b.run_rsync_cmds()
     ### Inspect output
     self.assertBackupSame("source dir", "backup dir",
-      extra_files = ["rsync_backup.log", Backup._DONE_FILE])
+      extra_files = self._backup_files)
 
   def test_ordered_backup_with_prev(self):
     """ Similar to test_existing_backup, but tests backup_order option """
@@ -190,7 +964,7 @@ class TestBackup(unittest.TestCase):
 
     # Check contents of backup directory
     self.assertBackupSame("source dir", backup_dir,
-      extra_files = ["rsync_backup.log", Backup._DONE_FILE])
+      extra_files = self._backup_files)
     # Make sure rsync linked files whose contents didn't change from source to
     # old_dest (by comparing inode numbers)
     self.assertEqual(
@@ -223,5 +997,117 @@ class TestBackup(unittest.TestCase):
     for f in to_back_up:
       self.assertBackupSame(join("source dir", f), join("backup dir", f))
 
+  def test_concurrent_backup(self):
+    """
+      Same as test_ordered_backup, but runs several rsync commands at once.
+      Nested entries (e.g. a file inside a directory that's also listed) must
+      still end up in the right place.
+    """
+    self.createDefaultSourceDir("source dir")
+    b = Backup(src="source dir", dst="backup dir", backup_order=[
+      join(self._test_dirs[0], self._test_files[0]),
+      self._test_dirs[0], self._test_files[0],
+      self._test_dirs[1], self._test_files[1],
+      "..."])
+    b.run_rsync_cmds(jobs=3)
+    ### Inspect output
+    self.assertBackupSame("source dir", "backup dir",
+      extra_files = self._backup_files)
+    # Every command should have its own section in the log
+    with open(join("backup dir", "rsync_backup.log")) as log:
+      self.assertEqual(
+          sum(1 for line in log if line.startswith("rsync")), 6)
+
+  def test_concurrent_backup_dir_times(self):
+    """
+      Directories that several concurrent commands write into (here "a",
+      written by the commands of "a/b" and "...", and "x", by those of
+      "x/*.kdb" and "...") should still get the mtime of their source
+    """
+    os.makedirs("src/a/b")
+    os.makedirs("src/x")
+    for f in ["a/b/file", "a/file", "x/pw.kdb", "x/file"]:
+      put(join("src", f), [f + "\n"])
+    for d in ["src/a", "src/x"]:
+      os.utime(d, (1e9, 1e9))
+    b = Backup(src="src", dst="dst", backup_order=["a/b", "x/*.kdb", "..."])
+    b._rsync_jobs(forced={})
+    self.assertEqual(b._shared_dirs({"x/pw.kdb": None, "a/file": None}),
+                     set(["a", "x"]))
+    b.run_rsync_cmds(jobs=3)
+    self.assertBackupSame("src", "dst", extra_files=self._backup_files)
+    for d in ["dst/a", "dst/x"]:
+      self.assertEqual(os.stat(d).st_mtime, 1e9, d)
+
+  def test_failed_backup_not_done(self):
+    """
+      If any rsync command fails, BACKUP_DONE must not be written
+    """
+    self.createDefaultSourceDir("source dir")
+    b = Backup(src="source dir", dst="backup dir", backup_order=[
+      self._test_dirs[0], self._test_files[0], "..."])
+    # Make the second command fail
+    os.remove(join("source dir", self._test_files[0]))
+    with self.assertRaises(proc.CalledProcessError):
+      b.run_rsync_cmds(jobs=2)
+    self.assertFalse(exists(join("backup dir", Backup._DONE_FILE)))
+
+  def test_manifest_backup(self):
+    """
+      Takes a backup, then a second one linking against it. The second backup
+      uses the first one's manifest instead of --checksum, so it must still
+      copy a file that changed without changing size or mtime.
+    """
+    os.mkdir("source dir")
+    put("source dir/same contents", ["SAME\n"] * 3)
+    put("source dir/sneaky change", ["old\n"] * 3)
+    Backup(src="source dir", dst="30-Jan-2000").run_rsync_cmds()
+    self.assertTrue(exists(join("30-Jan-2000", Backup._MANIFEST_FILE)))
+
+    # Change the file's contents, then put its size and mtime back
+    st = os.stat("source dir/sneaky change")
+    os.rename("source dir/sneaky change", "old file")
+    put("source dir/sneaky change", ["new\n"] * 3)
+    os.utime("source dir/sneaky change", ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    b = Backup.FromBackupDrive(src="source dir", drive=".")
+    _, forced = b._scan_src()
+    self.assertEqual(forced, {"...": ["sneaky change"]})
+    b.run_rsync_cmds()
+    self.assertBackupSame("source dir", b.destination(),
+      extra_files = self._backup_files)
+    self.assertEqual(
+        os.stat(join(b.destination(), "same contents")).st_ino,
+        os.stat("30-Jan-2000/same contents").st_ino)
+
+  def test_dry_run_report(self):
+    """
+      A dry run shouldn't leave a report or metrics in the destination
+    """
+    self.createDefaultSourceDir("src")
+    Backup(src="src", dst="dst").run_rsync_cmds(dry_run=True)
+    self.assertFalse(exists(join("dst", Backup._REPORT_FILE)))
+    self.assertFalse(exists(join("dst", Backup._METRICS_FILE)))
+
+  def test_rsync_output_stats(self):
+    """
+      Feeds sample rsync output to the parser behind backup_report.json
+    """
+    stats = _CommandStats("...", ["rsync"])
+    for line in [
+        b"sending incremental file list\n",
+        b"./ (0/4096) .d..t......\n",
+        b"new file (12/12) >f+++++++++\n",
+        b"dir/linked (0/30) hf..........\n",
+        b"dir/unchanged (0/5) .f..........\n",
+        # Older logs quote the whole line
+        b'"odd (name) (3/3) >f+++++++++"\n',
+        b"sent 1,024 bytes  received 35 bytes  2,118.00 bytes/sec\n"]:
+      stats.feed(line)
+    self.assertEqual(
+        (stats.files_seen, stats.files_transferred, stats.files_hardlinked,
+         stats.bytes_transferred, stats.bytes_logical),
+        (4, 2, 1, 15, 50))
+
 if __name__ == "__main__":
   unittest.main()
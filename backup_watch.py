@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+from backup_lib import *
+import ctypes
+import ctypes.util
+import select
+import struct
+import textwrap as tw
+import uuid
+
+# inotify(7) event masks
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_DONT_FOLLOW = 0x2000000
+_IN_EXCL_UNLINK = 0x4000000
+_IN_ISDIR = 0x40000000
+
+# Events that mean the named entry of a watched directory changed
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_ONLYDIR |
+               _IN_DONT_FOLLOW | _IN_EXCL_UNLINK)
+
+# struct inotify_event, without the name that follows it
+_EVENT = struct.Struct("iIII")
+
+class Watcher:
+  """
+    Records every path that changes under a directory tree in a change
+    journal, which Backup (see its "change_journal" argument) uses to copy
+    only those paths instead of scanning the whole tree. See
+    _read_change_journal() for the journal's format.
+
+    Each Watcher run starts a new journal with a new id, so that changes
+    made while no watcher was running are never mistaken for "no changes":
+    a backup only trusts the journal if it was written by the same run that
+    was watching when the previous backup was taken.
+  """
+
+  def __init__(self, src, journal):
+    """
+      Keyword arguments:
+      src -- the directory to watch (the "src" of the backups that will use
+          the journal)
+      journal -- path of the change journal. It's truncated when the watcher
+          starts
+    """
+    self.src = abspath(src)
+    self.journal = abspath(journal)
+    assert isdir(self.src), "src ({}) is not a dir".format(self.src)
+    self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    self._dirs = {}  # watch descriptor -> directory (relative to self.src)
+
+  def _check(self, ret):
+    if ret < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err))
+    return ret
+
+  def _watch_tree(self, rel):
+    """ Watches the directory "rel" and every directory below it """
+    stack = [rel]
+    while stack:
+      d = stack.pop()
+      try:
+        wd = self._check(self._libc.inotify_add_watch(
+            self._fd, os.fsencode(join(self.src, d)), _WATCH_MASK))
+      except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES): continue
+        raise  # e.g. ENOSPC: fs.inotify.max_user_watches is too low
+      self._dirs[wd] = d
+      try:
+        with os.scandir(join(self.src, d)) as it:
+          for e in it:
+            if e.is_dir(follow_symlinks=False):
+              stack.append(join(d, e.name) if d else e.name)
+      except OSError:
+        continue
+
+  def _append(self, records):
+    """ Appends NUL-terminated "records" (bytes) to the journal """
+    if records:
+      os.write(self._journal_fd, b"".join(r + b"\0" for r in records))
+
+  def _events(self, buf):
+    """ Yields (wd, mask, name) for each inotify_event in "buf" """
+    offset = 0
+    while offset < len(buf):
+      wd, mask, _, length = _EVENT.unpack_from(buf, offset)
+      offset += _EVENT.size
+      name = buf[offset:offset + length].rstrip(b"\0")
+      offset += length
+      yield wd, mask, os.fsdecode(name)
+
+  def _handle(self, buf):
+    """ Journals the events in "buf", a chunk read from the inotify fd """
+    changed = []
+    for wd, mask, name in self._events(buf):
+      if mask & _IN_Q_OVERFLOW:
+        # Events were lost, possibly including the creation of directories
+        # that now need watching
+        changed.append(None)
+        self._watch_tree("")
+        continue
+      if mask & _IN_IGNORED:
+        self._dirs.pop(wd, None)
+        continue
+      if wd not in self._dirs or not name: continue
+      d = self._dirs[wd]
+      p = join(d, name) if d else name
+      changed.append(p)
+      if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+        # Entries may have been added before the watch existed, but the whole
+        # directory is journaled, so they're copied anyway
+        self._watch_tree(p)
+    records = []
+    for p in dict.fromkeys(changed):
+      records.append(b"O" if p is None else b"P" + os.fsencode(p))
+    self._append(records)
+
+  def run(self, stop=None, poll_seconds=1.0):
+    """
+      Watches `self.src` and journals changes until "stop" (a
+      threading.Event) is set, or forever if it's None
+    """
+    self._journal_fd = os.open(
+        self.journal, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+      try:
+        fcntl.flock(self._journal_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        raise AssertionError(
+            "another watcher is writing to {}".format(self.journal))
+      os.ftruncate(self._journal_fd, 0)
+      self._fd = self._check(self._libc.inotify_init1(os.O_CLOEXEC))
+      try:
+        self._watch_tree("")
+        # Only now can a backup rely on the journal
+        header = {"id": uuid.uuid4().hex, "src": self.src}
+        self._append([b"H" + json.dumps(header).encode()])
+        while stop is None or not stop.is_set():
+          ready, _, _ = select.select([self._fd], [], [], poll_seconds)
+          if ready: self._handle(os.read(self._fd, 1 << 20))
+      finally:
+        os.close(self._fd)
+    except Exception:
+      self._append([b"O"])
+      raise
+    finally:
+      os.close(self._journal_fd)
+
+def main():
+  arg_parser = argparse.ArgumentParser(
+      description="Journal changes to a directory tree, to speed up backups.",
+      epilog=tw.dedent("""\
+      Example:
+          ./backup_watch.py --src=/home/mjs --journal=/var/tmp/mjs.changes &
+          ./backup.py --src=/home/mjs --backup_drive=/mnt/backup \\
+              --change_journal=/var/tmp/mjs.changes
+
+      Backups fall back to scanning all of --src whenever the journal can't
+      be trusted (e.g. the watcher was restarted since the last backup).
+      Watching large trees may require raising fs.inotify.max_user_watches.
+      """),
+      formatter_class=argparse.RawTextHelpFormatter)
+  arg_parser.add_argument('--src', type=str, required=True,
+      help="The directory to watch (the --src of backup.py)")
+  arg_parser.add_argument('--journal', type=str, required=True,
+      help="Where to write the change journal (the --change_journal of "
+           "backup.py)")
+  args = arg_parser.parse_args()
+  Watcher(args.src, args.journal).run()
+
+if __name__ == "__main__":
+  main()
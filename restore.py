@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+from backup_lib import *
+import textwrap as tw
+
+def main():
+  # Parse flags (which are used to initialize a Restore instance)
+  arg_parser = argparse.ArgumentParser(
+      description="Restore a backup taken by backup.py, most important files "
+                  "first.",
+      epilog=tw.dedent("""\
+      Examples:
+          ./restore.py --backup_drive="/Volumes/Backup Drive/Macbook/" \\
+              --dst=/Users/msteffen --backup_order="Documents,my_passwords.kdb,..."
+          (Restores the most recent completed backup, starting with "Documents"
+          and "my_passwords.kdb")
+
+          ./restore.py --backup=/net/backups/today --dst=/tmp/restored \\
+              --paths="Documents/taxes,Pictures/2014"
+      """),
+      formatter_class=argparse.RawTextHelpFormatter)
+  arg_parser.add_argument('--backup', type=str,
+      help="The backup directory to restore")
+  arg_parser.add_argument('--backup_drive', type=str,
+      help=tw.fill(tw.dedent("""\
+      A directory of dated backups, as written by backup.py --backup_drive.
+      The backup named by --date is restored, or the most recent completed one.
+      If this is set, don't set --backup.""")))
+  arg_parser.add_argument('--date', type=str,
+      help="With --backup_drive, the backup to restore (e.g. 30-Jan-2014)")
+  arg_parser.add_argument('--dst', type=str,
+      help=tw.fill(tw.dedent("""\
+      The directory to restore into. Files that are already there and are
+      also in the backup are replaced.""")))
+  arg_parser.add_argument('--backup_order', type=str,
+      help=tw.fill(tw.dedent("""\
+      A comma-separated list of files, directories and shell patterns in the
+      backup, or the special name \"...\", as in backup.py. Files are
+      restored in this order. Files that aren't listed are still restored,
+      last.""")))
+  arg_parser.add_argument('--paths', type=str,
+      help=tw.fill(tw.dedent("""\
+      A comma-separated list of files and directories in the backup. If set,
+      only these are restored.""")))
+  arg_parser.add_argument('--jobs', type=int, default=8,
+      help="The number of files to copy at once (default: 8)")
+  args = arg_parser.parse_args()
+
+  # Validate flag values
+  assert args.dst, "Must specify --dst. Run `./restore.py --help` for usage info"
+  assert bool(args.backup) != bool(args.backup_drive), \
+      "Must specify exactly one of --backup or --backup_drive. Run " \
+      "`./restore.py --help` for usage info"
+  assert args.backup_drive or not args.date, \
+      "--date requires --backup_drive. Run `./restore.py --help` for usage info"
+  assert args.jobs >= 1, "--jobs must be at least 1"
+
+  restore_args = {"dst": args.dst}
+  backup_order = [
+      s for s in (args.backup_order or "").strip().split(",") if len(s) > 0 ]
+  if len(backup_order) > 0:
+    restore_args["backup_order"] = backup_order
+  if args.paths:
+    restore_args["paths"] = [s for s in args.paths.split(",") if len(s) > 0]
+
+  if args.backup_drive:
+    restore = Restore.FromBackupDrive(drive=args.backup_drive, name=args.date,
+                                      **restore_args)
+  else:
+    restore = Restore(snapshot=args.backup, **restore_args)
+  print("Restoring {} to {}".format(restore.snapshot, restore.dst))
+  totals = restore.run(workers=args.jobs)
+  print("{} files ({:.2f} GB), {} hardlinks and {} symlinks in {:.1f}s".format(
+      totals["files"], totals["bytes"] / 1e9, totals["hardlinks"],
+      totals["symlinks"], totals["wall_seconds"]))
+  print("\033[1;32mDONE!\033[0m")
+
+if __name__ == "__main__":
+  main()